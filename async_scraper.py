@@ -0,0 +1,231 @@
+import asyncio
+import logging
+
+from sqlalchemy import false
+from sqlalchemy.orm import load_only
+
+from parsers import ComposerPage, PiecePage, PageRequestFailure, PageParseFailure
+from db import Composer, Piece, Score
+from requester import AsyncRequester, RippingError
+from scraper import WebScraper, download_file
+from settings import LOG_NAME, MAX_CONCURRENCY
+from globals import DEFAULT_REQUESTER
+from retry import RetryScheduler
+from itertools import chain
+from normalize import load_metadata
+
+
+def _parse_piece_page(url, raw_html):
+    """Parse a downloaded piece page. Returns a (piece_page, scores, metadata) tuple."""
+    piece_page = PiecePage(url, raw_html)
+    metadata, scores = piece_page.extract()
+    return piece_page, scores, metadata
+
+
+class AsyncWebScraper:
+    """Asyncio version of the WebScraper pipeline.
+
+    Keeps up to max_concurrency pages or scores in flight at once. Network
+    waits happen on the event loop, parsing and file writes happen in the
+    requester's thread pool, and all database work stays on the event loop
+    thread so the session is never shared between threads.
+    """
+
+    def __init__(self, db_session, requester=None, max_concurrency=MAX_CONCURRENCY, revision_api=None):
+        """Create an AsyncWebScraper
+
+        Args:
+            db_session: the SQLAlchemy session to save results with.
+            requester: the ProxiedFuzzedRequester to make requests with.
+            max_concurrency: how many requests to keep in flight.
+            revision_api: a mwapi.MediaWikiAPI to record the wiki revision of
+                the pages with, see WebScraper.
+        """
+        self._session = db_session
+        requester = requester if requester else DEFAULT_REQUESTER
+        self._scraper = WebScraper(db_session, requester, revision_api=revision_api)
+        self._requester = AsyncRequester(requester, max_concurrency)
+        self._max_concurrency = max_concurrency
+        self._downloads_done = 0
+        self._score_metadata = {}
+        self._piece_revisions = {}
+        self._logger = logging.getLogger(LOG_NAME)
+
+    def run(self, coroutine):
+        """Run one of the scrape coroutines to completion on a fresh event loop.
+
+        ex: AsyncWebScraper(session).run(scraper.scrape_all_pieces())
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            return loop.run_until_complete(coroutine)
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def close(self):
+        self._requester.close()
+
+    async def scrape_all_composers(self):
+        """Async version of WebScraper.scrape_all_composers()."""
+        composers = RetryScheduler.eligible(self._session.query(Composer), Composer)\
+            .filter(Composer.all_scraped == false())\
+            .options(load_only(Composer.id, Composer.name, Composer.url))
+        await self._run_workers(self.scrape_composer, self._iter_claims(composers, Composer),
+                                "Failed to scrape composer {}")
+
+    async def scrape_all_pieces(self):
+        """Async version of WebScraper.scrape_all_pieces()."""
+        pieces = RetryScheduler.eligible(self._session.query(Piece), Piece)\
+            .filter(Piece.scraped == false())\
+            .options(load_only(Piece.id, Piece.name, Piece.url, Piece.composer_id))
+        await self._run_workers(self.scrape_piece, self._iter_pieces(pieces),
+                                "Failed to scrape piece {}")
+
+    async def download_all_scores(self):
+        """Async version of WebScraper.download_all_scores()."""
+        scores = RetryScheduler.eligible(self._session.query(Score), Score)\
+            .filter(Score.downloaded == false())\
+            .options(load_only(Score.id, Score.url, Score.piece_id))
+        await self._run_workers(self.download_score, self._iter_scores(scores),
+                                "Failed to download score {}")
+        self._session.commit()
+
+    async def scrape_composer(self, db_composer):
+        """Get all pieces related to a composer into the database."""
+        piece_count = 0
+        async for page_links in self._iter_category(db_composer.url):
+            self._scraper._add_composer_pieces(db_composer, page_links)
+            piece_count += len(page_links)
+        self._scraper._finish_composer(db_composer, piece_count)
+
+    async def scrape_piece(self, db_piece):
+        """Scrape a piece page associated with a database piece entry."""
+        revisions = self._piece_revisions.pop(db_piece.id, None)
+        revision = (await revisions).get(db_piece.url) if revisions else None
+        try:
+            resp = await self._get_page(db_piece.url)
+            piece_page, scores, metadata = await self._requester.run_blocking(
+                _parse_piece_page, db_piece.url, resp.text)
+        except (PageRequestFailure, PageParseFailure) as e:
+            self._scraper._save_piece_failure(db_piece, e)
+            return
+        self._scraper._save_piece(db_piece, piece_page, scores, metadata, revision)
+
+    async def download_score(self, score):
+        """Download a single score and record the result on it.
+
+        The download runs in the thread pool on plain values. The score itself
+        is only touched here, on the event loop thread.
+        """
+        if score.id in self._score_metadata:
+            metadata = self._score_metadata.pop(score.id)
+        else:
+            metadata = load_metadata(self._session, [score.piece_id]).get(score.piece_id, {})
+        file_path, download_rate, resume_count = await self._requester.run_blocking(
+            download_file, score.url, metadata, self._requester.requester)
+        if download_rate is not None:
+            score.download_rate = download_rate
+        score.resume_count = resume_count
+        self._scraper._save_download(score, metadata, file_path)
+        self._downloads_done += 1
+        if self._downloads_done % 10 == 0:
+            self._session.commit()
+
+    def _iter_claims(self, query, model):
+        """Yield the rows of query one by one, claiming them a batch at a time with the scraper's leases."""
+        return chain.from_iterable(self._claim_batches(query, model))
+
+    def _iter_pieces(self, query):
+        """Like _iter_claims(), looking up the wiki revisions of each batch in the thread pool for scrape_piece()."""
+        for batch in self._claim_batches(query, Piece):
+            revisions = asyncio.ensure_future(self._requester.run_blocking(
+                self._scraper._fetch_revisions, [piece.url for piece in batch]))
+            for piece in batch:
+                self._piece_revisions[piece.id] = revisions
+            yield from batch
+
+    def _iter_scores(self, query):
+        """Like _iter_claims(), loading the metadata of the pieces of each batch at once for download_score()."""
+        for batch in self._claim_batches(query, Score):
+            metadata = load_metadata(self._session, {score.piece_id for score in batch})
+            for score in batch:
+                self._score_metadata[score.id] = metadata.get(score.piece_id, {})
+            yield from batch
+
+    def _claim_batches(self, query, model):
+        """Claim and yield the batches of query with the scraper's leases.
+
+        Rows are still in flight in other workers when the next batch is
+        claimed, so they are not expunged from the session, which only weakly
+        references them once saved, nor released: _run_workers() keeps the
+        leases renewed until every worker is done, then releases them all.
+        """
+        return self._scraper.leases.iter_claims(query, model, expunge=False, release=False, renew=False)
+
+    async def _iter_category(self, url):
+        """Async version of CategoryPage.iter_category()."""
+        resp = await self._get_page(url)
+        html, counter = resp.text, 1
+        category_page = ComposerPage(url, html)
+        while html:
+            next_url = category_page._scan_next_page_url(html)
+            prefetch = asyncio.ensure_future(self._get_page(next_url)) if next_url else None
+            try:
+                links, parsed_next_url = await self._requester.run_blocking(category_page.parse_links_page, html)
+            except BaseException:
+                if prefetch:
+                    prefetch.cancel()
+                raise
+            if parsed_next_url != next_url:
+                # The parsed page has the last word, as in CategoryPage.iter_category().
+                if prefetch:
+                    prefetch.cancel()
+                prefetch = asyncio.ensure_future(self._get_page(parsed_next_url)) if parsed_next_url else None
+
+            self._logger.info("Scraped {} pages of links from {}".format(counter, url))
+            counter += 1
+            yield links
+            html = (await prefetch).text if prefetch else None
+
+    async def _get_page(self, url):
+        """GET a page, wrapping failures other than ripping in PageRequestFailure."""
+        try:
+            return await self._requester.get(url)
+        except RippingError:
+            raise
+        except Exception as e:
+            raise PageRequestFailure("Failed to GET page at {}".format(url), original=e)
+
+    async def _run_workers(self, coroutine_func, items, failure_message):
+        """Await coroutine_func(item) for every item with at most max_concurrency running.
+
+        A RippingError cancels all the workers and is re-raised. Any other
+        exception is logged and the item skipped, as in WebScraper. The
+        scraper's leases are renewed meanwhile, and released at the end
+        either way.
+        """
+        items = iter(items)
+        heartbeat = self._scraper.leases.keep_alive()
+
+        async def worker():
+            for item in items:
+                try:
+                    await coroutine_func(item)
+                except RippingError:
+                    raise
+                except Exception as e:
+                    self._logger.warning(failure_message.format(item))
+                    self._scraper._save_failure(item, e)
+
+        workers = [asyncio.ensure_future(worker()) for _ in range(self._max_concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        except BaseException:
+            for w in workers:
+                w.cancel()
+            raise
+        finally:
+            heartbeat.stop()
+            self._scraper.leases.release()
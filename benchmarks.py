@@ -0,0 +1,737 @@
+"""Offline checks and benchmarks of the parsers over the fixture corpus in fixtures/.
+
+Usage:
+    python benchmarks.py equivalence
+    python benchmarks.py parsers [--repeat N]
+    python benchmarks.py suite [--repeat N] [--parser P] [--output FILE]
+    python benchmarks.py compare OLD_REPORT NEW_REPORT
+    python benchmarks.py url-index [--rows N] [--lookups N]
+    python benchmarks.py bulk-insert [--rows N]
+    python benchmarks.py queue-select [--rows N]
+    python benchmarks.py keyset [--rows N]
+    python benchmarks.py metadata-tables [--rows N]
+    python benchmarks.py migration [--rows N]
+    python benchmarks.py leases [--rows N]
+    python benchmarks.py pipeline
+
+Results are printed as JSON. Save suite reports with --output and compare
+them to spot regressions between commits.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from sqlalchemy import create_engine, false
+from sqlalchemy.orm import sessionmaker
+
+import scraper
+from parsers import PiecePage, ComposerPage, HTML_PARSERS, PageParseFailure, EXTENSION_SUFFIXES
+from db import Base, Composer, Piece, Score, CompressedText
+from db_setup import configure_engine, create_partial_indexes
+from retry import RetryScheduler
+from scraper import WebScraper
+from settings import HTML_PARSER
+from url_index import UrlIndex
+from bulk import insert_ignore
+from keyset import iter_rows
+from normalize import backfill_metadata, load_metadata, pieces_with_field
+from migrations import MigrationContext
+from lease import Leases
+from pipeline import Pipeline
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+class FixtureRequester:
+    """Stands in for ProxiedFuzzedRequester, answering from the fixture corpus."""
+
+    def __init__(self, fixture_dir=FIXTURE_DIR):
+        self._fixture_dir = fixture_dir
+        with open(os.path.join(fixture_dir, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.requests = 0
+
+    def read(self, url):
+        with open(os.path.join(self._fixture_dir, self.manifest['pages'][url]), 'rb') as f:
+            return f.read()
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        resp = Response()
+        resp.status_code = 200
+        resp.headers = CaseInsensitiveDict({'Content-Type': 'text/html; charset=UTF-8'})
+        resp.encoding = 'utf-8'
+        resp.url = url
+        resp._content = self.read(url)
+        return resp
+
+
+def parse_piece(url, html, parser):
+    """Return everything extracted from a piece page, or the name of the exception raised."""
+    page = PiecePage(url, html, parser=parser)
+    result = {}
+    for name, method in (('metadata', page.parse_metadata),
+                         ('scores', page.parse_scores),
+                         ('movements', page._parse_movement_metadata)):
+        try:
+            result[name] = method()
+        except Exception as e:
+            result[name] = type(e).__name__
+    return result
+
+
+def parse_category(url, requester, parser):
+    """Return every link in a category, following its 'next 200' pages."""
+    page = ComposerPage(url, requester.get(url).text, requester=requester, parser=parser)
+    try:
+        return page.get_all_in_category()
+    except Exception as e:
+        return type(e).__name__
+
+
+def check_parser_equivalence(requester=None, parsers=HTML_PARSERS, reference='html5lib'):
+    """Compare the output of every tree builder against the reference one.
+
+    Returns: a list of {'url', 'parser'} dicts, one for each page where a parser
+        disagrees with the reference. Empty if all parsers are equivalent.
+    """
+    requester = requester if requester else FixtureRequester()
+    mismatches = []
+    for url in requester.manifest['pieces']:
+        html = requester.read(url).decode('utf-8')
+        expected = parse_piece(url, html, reference)
+        for parser in parsers:
+            if parse_piece(url, html, parser) != expected:
+                mismatches.append({'url': url, 'parser': parser})
+    for url in requester.manifest['categories']:
+        expected = parse_category(url, requester, reference)
+        for parser in parsers:
+            if parse_category(url, requester, parser) != expected:
+                mismatches.append({'url': url, 'parser': parser})
+    return mismatches
+
+
+def benchmark_parsers(requester=None, parsers=HTML_PARSERS, repeat=20):
+    """Time building and parsing every fixture piece page with each tree builder.
+
+    Returns: {parser: pages/sec}
+    """
+    requester = requester if requester else FixtureRequester()
+    pages = [(url, requester.read(url).decode('utf-8')) for url in requester.manifest['pieces']]
+    results = {}
+    for parser in parsers:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for url, html in pages:
+                parse_piece(url, html, parser)
+        results[parser] = round(repeat * len(pages) / (time.perf_counter() - start), 2)
+    return results
+
+
+def _piece_method_benchmark(method_name):
+    """Benchmark calling a PiecePage method on a fresh page for every fixture piece."""
+    def benchmark(requester, parser):
+        def setup():
+            return [(url, requester.read(url).decode('utf-8')) for url in requester.manifest['pieces']]
+
+        def run(pages):
+            failures = 0
+            for url, html in pages:
+                try:
+                    getattr(PiecePage(url, html, parser=parser), method_name)()
+                except PageParseFailure:
+                    failures += 1
+            return len(pages), failures
+        return setup, run
+    return benchmark
+
+
+def _category_benchmark(requester, parser):
+    """Benchmark collecting every link of each fixture category, following its pagination."""
+    def setup():
+        return [(url, requester.get(url).text) for url in requester.manifest['categories']]
+
+    def run(categories):
+        requests_before = requester.requests
+        for url, html in categories:
+            ComposerPage(url, html, requester=requester, parser=parser).get_all_in_category()
+        # Every "next 200" page followed is a request.
+        return len(categories) + requester.requests - requests_before, 0
+    return setup, run
+
+
+def _scrape_piece_benchmark(requester, parser):
+    """Benchmark WebScraper.scrape_piece() on every fixture piece against an in-memory database."""
+    def setup():
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        composer = Composer(name='Fixtures', url='/wiki/index.php/Category:Fixtures')
+        pieces = [Piece(name=url, url=url, composer=composer) for url in requester.manifest['pieces']]
+        session.add_all(pieces)
+        session.commit()
+        return WebScraper(session, requester), pieces
+
+    def run(state):
+        scraper, pieces = state
+        for piece in pieces:
+            scraper.scrape_piece(piece)
+        return len(pieces), sum(1 for piece in pieces if not piece.scraped)
+    return setup, run
+
+
+# name -> function(requester, parser) returning a (setup, run) pair. run(setup()) does
+# one pass over the corpus and returns a (pages, failures) tuple. Only run is measured.
+SUITE = {
+    'parse_metadata': _piece_method_benchmark('parse_metadata'),
+    'parse_scores': _piece_method_benchmark('parse_scores'),
+    'parse_movement_metadata': _piece_method_benchmark('_parse_movement_metadata'),
+    'extract': _piece_method_benchmark('extract'),
+    'get_all_in_category': _category_benchmark,
+    'scrape_piece': _scrape_piece_benchmark,
+}
+
+
+def run_suite(requester=None, parser=HTML_PARSER, repeat=20, names=None):
+    """Run the benchmarks in SUITE.
+
+    Every benchmark is timed over repeat passes, then run once more under
+    tracemalloc for its peak memory, since tracing slows everything down.
+
+    Returns: a report dict, with {'pages', 'failures', 'pages_per_sec',
+        'peak_memory_kib'} for each benchmark under 'benchmarks'.
+    """
+    requester = requester if requester else FixtureRequester()
+    results = {}
+    for name in names if names else SUITE:
+        setup, run = SUITE[name](requester, parser)
+        elapsed, pages, failures = 0.0, 0, 0
+        for _ in range(repeat):
+            state = setup()
+            start = time.perf_counter()
+            pass_pages, failures = run(state)
+            elapsed += time.perf_counter() - start
+            pages += pass_pages
+
+        state = setup()
+        tracemalloc.start()
+        try:
+            run(state)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        results[name] = {'pages': pages // repeat,
+                         'failures': failures,
+                         'pages_per_sec': round(pages / elapsed, 2),
+                         'peak_memory_kib': round(peak / 1024.0, 1)}
+    return {'commit': _git_commit(), 'python': platform.python_version(), 'parser': parser,
+            'repeat': repeat, 'benchmarks': results}
+
+
+def compare_reports(old, new):
+    """Return {benchmark: {'speed': new/old pages per sec, 'memory': new/old peak memory}}."""
+    comparison = {}
+    for name, result in new['benchmarks'].items():
+        if name not in old['benchmarks']:
+            continue
+        before = old['benchmarks'][name]
+        comparison[name] = {'speed': round(result['pages_per_sec'] / before['pages_per_sec'], 3),
+                            'memory': round(result['peak_memory_kib'] / max(before['peak_memory_kib'], 0.1), 3)}
+    return comparison
+
+
+def benchmark_url_index(rows=500000, lookups=20000):
+    """Compare per-URL COUNT queries with UrlIndex on a synthetic database of rows pieces.
+
+    Half of the URLs looked up are in the database. Returns {approach:
+    {'load_sec', 'lookups_per_sec', 'peak_memory_kib'}}.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'url_index.sqlite')
+        engine = create_engine('sqlite:///' + path)
+        Base.metadata.create_all(engine)
+        conn = sqlite3.connect(path)
+        conn.executemany("INSERT INTO pieces (name, url) VALUES (?, ?);",
+                         (('Piece {}'.format(i), '/wiki/index.php/Piece_{}'.format(i)) for i in range(rows)))
+        conn.commit()
+        conn.close()
+
+        rng = random.Random(0)
+        urls = ['/wiki/index.php/Piece_{}'.format(rng.randrange(rows * 2)) for _ in range(lookups)]
+        session = sessionmaker(bind=engine)()
+
+        def count_query(url):
+            return session.query(Piece).filter(Piece.url == url).count() == 1
+
+        results = {}
+        for name, make_lookup in (('count_query', lambda: count_query),
+                                  ('set', lambda: UrlIndex(session, Piece).__contains__),
+                                  ('bloom_filter', lambda: UrlIndex(session, Piece, bloom_threshold=0).__contains__)):
+            # Loaded once under tracemalloc for its memory, then again for its speed.
+            tracemalloc.start()
+            try:
+                make_lookup()(urls[0])
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            start = time.perf_counter()
+            lookup = make_lookup()
+            lookup(urls[0])
+            load = time.perf_counter() - start
+
+            start = time.perf_counter()
+            found = sum(1 for url in urls if lookup(url))
+            elapsed = time.perf_counter() - start
+            results[name] = {'load_sec': round(load, 3), 'lookups_per_sec': round(lookups / elapsed, 1),
+                             'found': found, 'peak_memory_kib': round(peak / 1024.0, 1)}
+        session.close()
+        engine.dispose()
+    return results
+
+
+def benchmark_bulk_insert(rows=50000, batch_size=200):
+    """Compare inserting pieces batch_size at a time through the ORM and through bulk.insert_ignore().
+
+    Every approach inserts rows new pieces, then the same pieces again, as a
+    re-run would. The ORM has to check each URL first to do that. Returns
+    {approach: {'first_run_rows_per_sec', 'rerun_rows_per_sec'}}.
+    """
+    pieces = [{'name': 'Piece {}'.format(i), 'url': '/wiki/index.php/Piece_{}'.format(i), 'composer_id': 1}
+              for i in range(rows)]
+    batches = [pieces[i:i + batch_size] for i in range(0, rows, batch_size)]
+
+    def orm(session, batch):
+        known = {url for url, in session.query(Piece.url).filter(Piece.url.in_([p['url'] for p in batch]))}
+        session.add_all(Piece(**p) for p in batch if p['url'] not in known)
+
+    results = {}
+    for name, write in (('orm', orm), ('insert_ignore', lambda session, batch: insert_ignore(session, Piece, batch))):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine('sqlite:///' + os.path.join(directory, 'bulk.sqlite'))
+            Base.metadata.create_all(engine)
+            session = sessionmaker(bind=engine)()
+            result = {}
+            for run in ('first_run', 'rerun'):
+                start = time.perf_counter()
+                for batch in batches:
+                    write(session, batch)
+                    session.commit()
+                result[run + '_rows_per_sec'] = round(rows / (time.perf_counter() - start), 1)
+            result['rows'] = session.query(Piece.id).count()
+            results[name] = result
+            session.close()
+            engine.dispose()
+    return results
+
+
+def benchmark_queue_select(rows=500000, repeat=50, commits=500):
+    """Time selecting work before and after db_setup, on a synthetic database.
+
+    The database has rows pieces, 95% of them scraped, and rows scores, 90% of
+    them downloaded. As in a real run, the rows left are the newest ones.
+    'before' uses a default engine without the partial indexes, 'after' a
+    configured engine with them.
+
+    Returns: {'before': {...}, 'after': {...}} with the seconds to select the
+        next 100 pieces and scores to work on, to count them, and the commits/sec
+        of single-row updates.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'queue.sqlite')
+        Base.metadata.create_all(create_engine('sqlite:///' + path))
+        conn = sqlite3.connect(path)
+        conn.executemany("INSERT INTO pieces (id, url, scraped, failed_scrape) VALUES (?, ?, ?, 0);",
+                         ((i, '/p/{}'.format(i), int(i <= rows * 0.95)) for i in range(1, rows + 1)))
+        conn.executemany("INSERT INTO scores (id, url, downloaded, failed_scrape) VALUES (?, ?, ?, 0);",
+                         ((i, '/s/{}'.format(i), int(i <= rows * 0.9)) for i in range(1, rows + 1)))
+        conn.commit()
+        conn.close()
+
+        for name in ('before', 'after'):
+            engine = create_engine('sqlite:///' + path)
+            if name == 'after':
+                configure_engine(engine)
+                create_partial_indexes(engine)
+            session = sessionmaker(bind=engine)()
+            pieces = RetryScheduler.eligible(session.query(Piece.id), Piece).filter(Piece.scraped == false())
+            scores = RetryScheduler.eligible(session.query(Score.id), Score).filter(Score.downloaded == false())
+
+            start = time.perf_counter()
+            for _ in range(repeat):
+                pieces.limit(100).all()
+                scores.limit(100).all()
+            select = (time.perf_counter() - start) / repeat
+
+            start = time.perf_counter()
+            pieces.count()
+            scores.count()
+            count = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for i in range(commits):
+                session.query(Piece).filter(Piece.id == i + 1).update({Piece.attempts: i})
+                session.commit()
+            commit_rate = commits / (time.perf_counter() - start)
+
+            results[name] = {'select_next_100_sec': round(select, 5), 'count_queue_sec': round(count, 4),
+                             'commits_per_sec': round(commit_rate, 1)}
+            session.close()
+            engine.dispose()
+    return results
+
+
+def benchmark_keyset(rows=20000, html_bytes=8000):
+    """Compare a loop over every piece's html_dump through a Query and through keyset.iter_rows().
+
+    The 'query' loop is how scripts.re_parse_metadata() used to read pieces.
+    Returns {approach: {'seconds', 'peak_memory_kib'}}, the memory measured
+    in a second pass under tracemalloc.
+    """
+    html = ('<p>' + 'x' * 60 + '</p>\n') * (html_bytes // 68)
+
+    def query_loop(session):
+        for piece in session.query(Piece):
+            len(piece.html_dump)
+
+    def keyset_loop(session):
+        for piece in iter_rows(session.query(Piece.id, Piece.html_dump), Piece.id):
+            len(piece.html_dump)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'keyset.sqlite')
+        engine = create_engine('sqlite:///' + path)
+        Base.metadata.create_all(engine)
+        conn = sqlite3.connect(path)
+        conn.executemany("INSERT INTO pieces (id, url, html_dump) VALUES (?, ?, ?);",
+                         ((i, '/p/{}'.format(i), CompressedText.compress(html + str(i))) for i in range(1, rows + 1)))
+        conn.commit()
+        conn.close()
+
+        for name, loop in (('query', query_loop), ('keyset', keyset_loop)):
+            session = sessionmaker(bind=engine)()
+            start = time.perf_counter()
+            loop(session)
+            elapsed = time.perf_counter() - start
+            session.close()
+
+            session = sessionmaker(bind=engine)()
+            tracemalloc.start()
+            try:
+                loop(session)
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            session.close()
+            results[name] = {'seconds': round(elapsed, 2), 'peak_memory_kib': round(peak / 1024.0, 1)}
+        engine.dispose()
+    return results
+
+
+def benchmark_metadata_tables(rows=20000, lookups=20):
+    """Compare json_metadata with the normalize.py tables on a synthetic database of rows pieces.
+
+    Every piece gets the metadata of a fixture piece, in one of 20 languages.
+    Finding the pieces in a language scans and decodes json_metadata before,
+    and is an indexed query of piece_fields after. Reading the metadata of
+    the pieces of a batch of 500 scores decodes each piece's JSON before, and
+    is load_metadata() after.
+
+    Returns: {'backfill_pieces_per_sec', 'json': {...}, 'tables': {...}}.
+    """
+    requester = FixtureRequester()
+    fixtures = []
+    for url in requester.manifest['pieces']:
+        try:
+            metadata, scores = PiecePage(url, requester.read(url).decode('utf-8')).extract()
+        except PageParseFailure:
+            continue
+        fixtures.append(dict(metadata, scores=scores))
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'metadata.sqlite')
+        engine = create_engine('sqlite:///' + path)
+        Base.metadata.create_all(engine)
+        conn = sqlite3.connect(path)
+        pieces, scores = [], []
+        for i in range(1, rows + 1):
+            metadata = dict(fixtures[i % len(fixtures)], Language={'text': 'Language {}'.format(i % 20), 'links': []})
+            pieces.append((i, '/p/{}'.format(i), CompressedText.compress(json.dumps(metadata))))
+            scores.extend((len(scores) + 1, i, url, edition.get('meta', {}).get('CPDL#', ''))
+                          for edition in metadata['scores'] for url in set(edition.get('dl_links', [])))
+        conn.executemany("INSERT INTO pieces (id, url, json_metadata, scraped) VALUES (?, ?, ?, 1);", pieces)
+        conn.executemany("INSERT INTO scores (id, piece_id, url, name) VALUES (?, ?, ?, ?);",
+                         ((id, piece, '{}#{}'.format(url, piece), name) for id, piece, url, name in scores))
+        conn.commit()
+        conn.close()
+        session = sessionmaker(bind=engine)()
+        batch = [piece_id for piece_id, in session.query(Score.piece_id).order_by(Score.id).limit(500)]
+
+        def scan(language):
+            return [piece_id for piece_id, metadata in session.query(Piece.id, Piece.json_metadata)
+                    if json.loads(metadata)['Language']['text'] == language]
+
+        def decode(piece_ids):
+            rows = session.query(Piece.id, Piece.json_metadata).filter(Piece.id.in_(set(piece_ids)))
+            return {piece_id: json.loads(metadata) for piece_id, metadata in rows}
+
+        results = {}
+        start = time.perf_counter()
+        backfill_metadata(session)
+        results['backfill_pieces_per_sec'] = round(rows / (time.perf_counter() - start), 1)
+
+        for name, find, load in (('json', scan, decode),
+                                 ('tables', lambda language: [p.id for p in pieces_with_field(
+                                     session, 'Language', language)], lambda ids: load_metadata(session, ids))):
+            start = time.perf_counter()
+            found = sum(len(find('Language {}'.format(i % 20))) for i in range(lookups))
+            find_time = (time.perf_counter() - start) / lookups
+            start = time.perf_counter()
+            load(batch)
+            load_time = time.perf_counter() - start
+            results[name] = {'find_by_field_sec': round(find_time, 4), 'found': found,
+                             'score_batch_metadata_sec': round(load_time, 4)}
+        session.close()
+        engine.dispose()
+    return results
+
+
+def benchmark_migration(rows=200000):
+    """Compare setting a flag on every piece through the ORM and with MigrationContext.update_in_batches().
+
+    The 'orm' approach is how migration2 used to clear failed_scrape: load
+    every piece, set the attribute and commit once. Returns {approach:
+    {'seconds', 'peak_memory_kib'}}, the memory measured with tracemalloc
+    in the same run.
+    """
+    def orm(path):
+        engine = create_engine('sqlite:///' + path)
+        session = sessionmaker(bind=engine)()
+        for piece in session.query(Piece).all():
+            piece.failed_scrape = False
+        session.commit()
+        session.close()
+        engine.dispose()
+
+    def batched(path):
+        conn = sqlite3.connect(path)
+        MigrationContext(conn, False).update_in_batches('pieces', 'failed_scrape = 0', 'failed_scrape IS NOT 0')
+        conn.close()
+
+    results = {}
+    for name, migrate in (('orm', orm), ('update_in_batches', batched)):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'migration.sqlite')
+            Base.metadata.create_all(create_engine('sqlite:///' + path))
+            conn = sqlite3.connect(path)
+            conn.executemany("INSERT INTO pieces (id, url, failed_scrape) VALUES (?, ?, 1);",
+                             ((i, '/p/{}'.format(i)) for i in range(1, rows + 1)))
+            conn.commit()
+            conn.close()
+
+            tracemalloc.start()
+            try:
+                start = time.perf_counter()
+                migrate(path)
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+            results[name] = {'seconds': round(elapsed, 2), 'peak_memory_kib': round(peak / 1024.0, 1)}
+    return results
+
+
+def _lease_worker(path, owner, latency, results):
+    """Worker process of benchmark_leases(): claim and 'scrape' pieces, latency seconds each."""
+    engine = configure_engine(create_engine('sqlite:///' + path))
+    session = sessionmaker(bind=engine)()
+    pieces = RetryScheduler.eligible(session.query(Piece), Piece).filter(Piece.scraped == false())
+    scraped = []
+    for batch in Leases(session, owner).iter_claims(pieces, Piece, batch_size=20):
+        for piece in batch:
+            time.sleep(latency)
+            piece.scraped = True
+            scraped.append(piece.id)
+        session.commit()
+    results.put(scraped)
+
+
+def benchmark_leases(rows=2000, latency=0.01, worker_counts=(1, 2, 4, 8)):
+    """Time worker processes sharing one database through lease.Leases.
+
+    Each worker claims pieces 20 at a time and spends latency seconds on
+    each, standing in for the request. Returns {workers: {'pieces_per_sec',
+    'scraped', 'duplicates'}}.
+    """
+    results = {}
+    for workers in worker_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'leases.sqlite')
+            engine = configure_engine(create_engine('sqlite:///' + path))
+            Base.metadata.create_all(engine)
+            with engine.begin() as conn:
+                conn.execute(Piece.__table__.insert(), [{'url': '/p/{}'.format(i), 'scraped': False,
+                                                         'failed_scrape': False} for i in range(rows)])
+            queue = multiprocessing.Queue()
+            processes = [multiprocessing.Process(target=_lease_worker,
+                                                 args=(path, 'worker-{}'.format(i), latency, queue))
+                         for i in range(workers)]
+            start = time.perf_counter()
+            for process in processes:
+                process.start()
+            scraped = [piece_id for _ in processes for piece_id in queue.get()]
+            elapsed = time.perf_counter() - start
+            for process in processes:
+                process.join()
+            engine.dispose()
+        results[workers] = {'pieces_per_sec': round(len(scraped) / elapsed, 1), 'scraped': len(scraped),
+                            'duplicates': len(scraped) - len(set(scraped))}
+    return results
+
+
+class _SlowFixtureRequester(FixtureRequester):
+    """FixtureRequester taking latency seconds per request, with an answer to every URL.
+
+    Pages outside the corpus are answered with one of its piece pages, and
+    scores with a few bytes. Notes when the first score was requested.
+    """
+
+    def __init__(self, latency):
+        super().__init__()
+        self.latency = latency
+        self.first_score_at = None
+        self._lock = threading.Lock()
+
+    def read(self, url):
+        time.sleep(self.latency)
+        if url.endswith(EXTENSION_SUFFIXES):
+            with self._lock:
+                self.first_score_at = self.first_score_at or time.perf_counter()
+            return b'score'
+        if url in self.manifest['pages']:
+            return super().read(url)
+        pieces = self.manifest['pieces']
+        return super().read(pieces[zlib.crc32(url.encode()) % len(pieces)])
+
+    def get(self, url, **kwargs):
+        resp = super().get(url, **kwargs)
+        resp._content_consumed = True
+        return resp
+
+
+def benchmark_pipeline(latency=0.05):
+    """Time a whole scrape of the fixture composer, sequentially with WebScraper and with Pipeline.
+
+    Every request takes latency seconds. Returns {scraper: {'total_sec',
+    'first_download_sec', 'requests', 'pieces', 'downloaded'}}.
+    """
+    def sequential(session_factory, requester):
+        web_scraper = WebScraper(session_factory(), requester)
+        web_scraper.scrape_all_composers()
+        web_scraper.scrape_all_pieces()
+        web_scraper.download_all_scores()
+
+    def pipeline(session_factory, requester):
+        Pipeline(session_factory, requester, poll_interval=0.5).run()
+
+    results = {}
+    download_path = scraper.DOWNLOAD_PATH
+    for name, scrape in (('sequential', sequential), ('pipeline', pipeline)):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = configure_engine(create_engine('sqlite:///' + os.path.join(directory, 'pipeline.sqlite')))
+            Base.metadata.create_all(engine)
+            session_factory = sessionmaker(bind=engine)
+            session = session_factory()
+            requester = _SlowFixtureRequester(latency)
+            session.add_all(Composer(name=url, url=url) for url in requester.manifest['categories'])
+            session.commit()
+            scraper.DOWNLOAD_PATH = directory
+            try:
+                start = time.perf_counter()
+                scrape(session_factory, requester)
+                elapsed = time.perf_counter() - start
+            finally:
+                scraper.DOWNLOAD_PATH = download_path
+            results[name] = {
+                'total_sec': round(elapsed, 2),
+                'first_download_sec': round(requester.first_score_at - start, 2) if requester.first_score_at else None,
+                'requests': requester.requests,
+                'pieces': session.query(Piece).filter(Piece.scraped).count(),
+                'downloaded': session.query(Score).filter(Score.downloaded).count()}
+            session.close()
+            engine.dispose()
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline parser checks and benchmarks.")
+    parser.add_argument('benchmark', choices=('equivalence', 'parsers', 'suite', 'compare', 'url-index',
+                                              'bulk-insert', 'queue-select', 'keyset',
+                                              'metadata-tables', 'migration', 'leases', 'pipeline'))
+    parser.add_argument('reports', nargs='*', help="The old and new suite reports to compare.")
+    parser.add_argument('--repeat', type=int, default=20, help="Passes over the corpus.")
+    parser.add_argument('--parser', default=HTML_PARSER, choices=HTML_PARSERS, help="Tree builder for the suite.")
+    parser.add_argument('--only', nargs='+', choices=sorted(SUITE), help="Run only these benchmarks of the suite.")
+    parser.add_argument('--output', help="Also write the suite report to this file.")
+    parser.add_argument('--rows', type=int, help="Rows of the synthetic database. 50000 for bulk-insert, "
+                                                 "20000 for keyset and metadata-tables, 200000 for migration, "
+                                                 "2000 for leases and 500000 otherwise by default.")
+    parser.add_argument('--lookups', type=int, default=20000, help="URLs looked up in the url-index benchmark.")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.benchmark == 'equivalence':
+        mismatches = check_parser_equivalence()
+        print(json.dumps({'equivalent': not mismatches, 'mismatches': mismatches}, indent=4))
+        exit(1 if mismatches else 0)
+    elif args.benchmark == 'parsers':
+        print(json.dumps({'pages_per_sec': benchmark_parsers(repeat=args.repeat)}, indent=4))
+    elif args.benchmark == 'suite':
+        report = run_suite(parser=args.parser, repeat=args.repeat, names=args.only)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=4)
+        print(json.dumps(report, indent=4))
+    elif args.benchmark == 'compare':
+        old_path, new_path = args.reports
+        with open(old_path) as f, open(new_path) as g:
+            print(json.dumps(compare_reports(json.load(f), json.load(g)), indent=4))
+    elif args.benchmark == 'url-index':
+        print(json.dumps(benchmark_url_index(args.rows or 500000, args.lookups), indent=4))
+    elif args.benchmark == 'bulk-insert':
+        print(json.dumps(benchmark_bulk_insert(args.rows or 50000), indent=4))
+    elif args.benchmark == 'queue-select':
+        print(json.dumps(benchmark_queue_select(args.rows or 500000), indent=4))
+    elif args.benchmark == 'keyset':
+        print(json.dumps(benchmark_keyset(args.rows or 20000), indent=4))
+    elif args.benchmark == 'metadata-tables':
+        print(json.dumps(benchmark_metadata_tables(args.rows or 20000), indent=4))
+    elif args.benchmark == 'migration':
+        print(json.dumps(benchmark_migration(args.rows or 200000), indent=4))
+    elif args.benchmark == 'leases':
+        print(json.dumps(benchmark_leases(args.rows or 2000), indent=4))
+    elif args.benchmark == 'pipeline':
+        print(json.dumps(benchmark_pipeline(), indent=4))
@@ -0,0 +1,57 @@
+"""Set-based writes of many rows at once, keyed on the unique url column.
+
+The statements are executed with executemany through SQLAlchemy Core, so
+no ORM objects are built and no existence check is needed: rows whose URL
+is already in the table are skipped or updated by SQLite itself with
+INSERT ... ON CONFLICT(url), which needs SQLite 3.24 or later. Running the
+same write twice leaves the table as it was after the first.
+
+Column defaults declared on the models are filled in, since they are
+applied by SQLAlchemy rather than the database. The caller commits.
+"""
+from sqlalchemy import bindparam, text
+
+
+def insert_ignore(session, model, rows):
+    """Insert rows, skipping those whose url is already in the table.
+
+    Args:
+        session: the session to execute in.
+        model: the model whose table to insert into.
+        rows: dicts of column name to value, all with the same keys.
+
+    Returns: the number of rows inserted.
+    """
+    return _execute(session, model, rows, "DO NOTHING")
+
+
+def upsert(session, model, rows, update_columns):
+    """Insert rows, updating update_columns of those whose url is already in the table.
+
+    Returns: the number of rows inserted or updated.
+    """
+    updates = ', '.join('{0} = excluded.{0}'.format(column) for column in update_columns)
+    return _execute(session, model, rows, "DO UPDATE SET " + updates)
+
+
+def _execute(session, model, rows, conflict_action):
+    rows = _with_defaults(model, rows)
+    if not rows:
+        return 0
+    table = model.__table__
+    columns = list(rows[0])
+    statement = text("INSERT INTO {} ({}) VALUES ({}) ON CONFLICT(url) {};".format(
+        table.name, ', '.join(columns), ', '.join(':' + c for c in columns), conflict_action))
+    # Typed parameters, so values go through the column types, e.g. CompressedText.
+    statement = statement.bindparams(*[bindparam(c, type_=table.c[c].type) for c in columns])
+    return session.execute(statement, rows).rowcount
+
+
+def _with_defaults(model, rows):
+    """Return the rows with the scalar defaults of the columns they leave out."""
+    rows = list(rows)
+    if not rows:
+        return rows
+    defaults = {c.name: c.default.arg for c in model.__table__.columns
+                if c.default is not None and c.default.is_scalar and c.name not in rows[0]}
+    return [dict(defaults, **row) for row in rows]
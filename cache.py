@@ -0,0 +1,191 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+from settings import CACHE_TTL, CACHE_MAX_BYTES
+
+
+class ResponseCache:
+    """An on-disk cache of GET responses, keyed by URL.
+
+    Every entry is a pair of files named after the SHA-1 of its URL: '<key>.body'
+    holds the body and '<key>.json' the status, headers, encoding and the time
+    the entry was stored or last revalidated. Entries younger than ttl seconds
+    are served straight from disk. Older ones are revalidated with
+    If-None-Match/If-Modified-Since so an unchanged page costs a 304 rather than
+    a full download. The bodies are kept under max_bytes in total by evicting
+    the least recently used entries.
+    """
+
+    # Headers describing the transfer rather than the body we keep.
+    _DROPPED_HEADERS = ('Content-Encoding', 'Content-Length', 'Transfer-Encoding', 'Connection')
+
+    def __init__(self, directory, ttl=CACHE_TTL, max_bytes=CACHE_MAX_BYTES):
+        """Create a ResponseCache
+
+        Args:
+            directory: where to keep the cache files. Created if needed.
+            ttl: seconds an entry is served without revalidation.
+            max_bytes: the most bytes of bodies kept on disk.
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits, self.revalidations, self.misses = 0, 0, 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._index = self._scan()  # key -> [body size, time.time() of last use]
+        self._size = sum(size for size, _ in self._index.values())
+
+    def before_request(self, url, headers):
+        """Look url up before it is requested.
+
+        Returns: a (response, entry) tuple. response is the cached response if
+            the entry is fresh and no request is needed. Otherwise entry is the
+            stale entry (or None) and headers has been given its validators.
+        """
+        entry = self.lookup(url)
+        if entry is None:
+            self.misses += 1
+            return None, None
+        if self.is_fresh(entry):
+            self.hits += 1
+            return self.response(entry, url), entry
+        headers.update(self.conditional_headers(entry))
+        return None, entry
+
+    def after_request(self, url, entry, resp):
+        """Store or revalidate from the response to a request made after before_request().
+
+        Returns: the response the caller should use.
+        """
+        if entry is not None and resp.status_code == 304:
+            return self.revalidated(entry, url, resp)
+        self.store(url, resp)
+        return resp
+
+    def lookup(self, url):
+        """Return the stored entry for url as a dict, or None if there is none."""
+        key = self._key(url)
+        try:
+            with open(self._path(key, 'json')) as f:
+                entry = json.load(f)
+        except (IOError, ValueError):
+            return None
+        entry['key'] = key
+        self._touch(key)
+        return entry
+
+    def is_fresh(self, entry):
+        return time.time() - entry['stored'] < self.ttl
+
+    def conditional_headers(self, entry):
+        """Return the validator headers to revalidate entry with."""
+        headers = {}
+        etag = entry['headers'].get('ETag')
+        last_modified = entry['headers'].get('Last-Modified')
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+        return headers
+
+    def response(self, entry, url):
+        """Rebuild a requests Response from a stored entry."""
+        with open(self._path(entry['key'], 'body'), 'rb') as f:
+            body = f.read()
+        resp = Response()
+        resp.status_code = entry['status']
+        resp.reason = entry.get('reason')
+        resp.headers = CaseInsensitiveDict(entry['headers'])
+        resp.encoding = entry.get('encoding')
+        resp.url = url
+        resp._content = body
+        return resp
+
+    def revalidated(self, entry, url, not_modified):
+        """Mark entry fresh after a 304 and return the stored response."""
+        for header in ('ETag', 'Last-Modified'):
+            if not_modified.headers.get(header):
+                entry['headers'][header] = not_modified.headers[header]
+        entry['stored'] = time.time()
+        self._write_json(entry['key'], entry)
+        self.revalidations += 1
+        return self.response(entry, url)
+
+    def store(self, url, resp):
+        """Store a successful response. Anything but a 200 is ignored."""
+        if resp.status_code != 200:
+            return
+        key = self._key(url)
+        body = resp.content
+        headers = {k: v for k, v in resp.headers.items() if k not in self._DROPPED_HEADERS}
+        entry = {'url': url, 'status': resp.status_code, 'reason': resp.reason,
+                 'headers': headers, 'encoding': resp.encoding, 'stored': time.time()}
+
+        body_path = self._path(key, 'body')
+        with open(body_path + '.tmp', 'wb') as f:
+            f.write(body)
+        os.replace(body_path + '.tmp', body_path)
+        self._write_json(key, entry)
+
+        with self._lock:
+            old_size = self._index.get(key, [0])[0]
+            self._index[key] = [len(body), time.time()]
+            self._size += len(body) - old_size
+            self._evict()
+
+    def stats(self):
+        return {'hits': self.hits, 'revalidations': self.revalidations, 'misses': self.misses,
+                'entries': len(self._index), 'bytes': self._size}
+
+    def _evict(self):
+        """Drop least recently used entries until the cache fits in max_bytes."""
+        if self._size <= self.max_bytes:
+            return
+        for key in sorted(self._index, key=lambda k: self._index[k][1]):
+            if self._size <= self.max_bytes:
+                break
+            size, _ = self._index.pop(key)
+            self._size -= size
+            for ext in ('json', 'body'):
+                try:
+                    os.remove(self._path(key, ext))
+                except OSError:
+                    pass
+
+    def _touch(self, key):
+        now = time.time()
+        with self._lock:
+            if key in self._index:
+                self._index[key][1] = now
+
+    def _scan(self):
+        """Rebuild the size and last use index from the files on disk."""
+        index = {}
+        for name in os.listdir(self.directory):
+            if not name.endswith('.body'):
+                continue
+            path = os.path.join(self.directory, name)
+            stat = os.stat(path)
+            index[name[:-len('.body')]] = [stat.st_size, stat.st_atime]
+        return index
+
+    def _write_json(self, key, entry):
+        json_path = self._path(key, 'json')
+        entry = {k: v for k, v in entry.items() if k != 'key'}
+        with open(json_path + '.tmp', 'w') as f:
+            json.dump(entry, f)
+        os.replace(json_path + '.tmp', json_path)
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, '{}.{}'.format(key, ext))
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
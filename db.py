@@ -1,12 +1,47 @@
-import sqlite3
-from sqlalchemy import Column, Integer, String, Boolean, create_engine, ForeignKey, Float
-from sqlalchemy.orm import relationship, sessionmaker
+import zlib
+from sqlalchemy import Column, Integer, String, Boolean, create_engine, ForeignKey, Float, Index
+from sqlalchemy.orm import relationship, sessionmaker, deferred
 from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.types import TypeDecorator, LargeBinary
 
-from settings import SQLITE_FILE
+from settings import DATABASE_URL, DB_COMPRESSION_LEVEL
+from db_setup import configure_engine
 
 Base = declarative_base()
-engine = create_engine('sqlite:////{}'.format(SQLITE_FILE))
+engine = configure_engine(create_engine(DATABASE_URL))
+
+
+class CompressedText(TypeDecorator):
+    """A text column stored zlib compressed.
+
+    The compressed bytes go into the column as a BLOB. SQLite keeps BLOBs as
+    they are whatever the column's declared type, so the column stays a
+    STRING and rows written before compression, which hold plain text, are
+    read back unchanged.
+    """
+
+    impl = String
+
+    def load_dialect_impl(self, dialect):
+        # Other databases won't keep bytes in a text column.
+        if dialect.name == 'sqlite':
+            return dialect.type_descriptor(String())
+        return dialect.type_descriptor(LargeBinary())
+
+    def process_bind_param(self, value, dialect):
+        return self.compress(value)
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, bytes):
+            return zlib.decompress(value).decode('utf-8')
+        return value
+
+    @staticmethod
+    def compress(value):
+        """Compress a str. None and already compressed values are returned as they are."""
+        if isinstance(value, str):
+            return zlib.compress(value.encode('utf-8'), DB_COMPRESSION_LEVEL)
+        return value
 
 
 class Composer(Base):
@@ -23,6 +58,19 @@ class Composer(Base):
     all_downloaded = Column(Boolean, default=False)
     failed_scrape = Column(Boolean, default=False)
 
+    # Retry scheduling, see retry.RetryScheduler.
+    attempts = Column(Integer, default=0)
+    last_error = Column(String)
+    next_attempt_at = Column(Float)  # time.time() before which the row is not retried.
+
+    # Work leases, see lease.Leases.
+    lease_owner = Column(String, index=True)
+    lease_expires = Column(Float)  # time.time() after which the row can be claimed by another worker.
+
+    # Latest revision of the wiki page seen, see sync.WikiSync.
+    rev_id = Column(Integer)
+    rev_timestamp = Column(String)  # ISO 8601, as given by the MediaWiki API.
+
     def __repr__(self):
         st = '<Composer(name="{}", url="{}")>'
         return st.format(self.name, self.url)
@@ -39,13 +87,30 @@ class Piece(Base):
     composer = relationship('Composer', back_populates='pieces')
     scores = relationship("Score", back_populates='piece')
 
-    json_metadata = Column(String)
-    html_dump = Column(String)
+    # Deferred so queries over pieces don't read and decompress them unless asked to.
+    json_metadata = deferred(Column(CompressedText))
+    html_dump = deferred(Column(CompressedText))
+    parser_version = Column(String)  # parsers.parser_version_stamp() json_metadata was parsed with.
+    html_hash = Column(String)  # parsers.html_hash() of the html_dump json_metadata was parsed from.
+    metadata_normalized = Column(Boolean, default=False)  # Whether json_metadata is in the tables of normalize.py.
 
     scraped = Column(Boolean, default=False)
     all_downloaded = Column(Boolean, default=False)
     failed_scrape = Column(Boolean, default=False)
 
+    # Retry scheduling, see retry.RetryScheduler.
+    attempts = Column(Integer, default=0)
+    last_error = Column(String)
+    next_attempt_at = Column(Float)  # time.time() before which the row is not retried.
+
+    # Work leases, see lease.Leases.
+    lease_owner = Column(String, index=True)
+    lease_expires = Column(Float)  # time.time() after which the row can be claimed by another worker.
+
+    # Revision of the wiki page json_metadata was scraped from, see sync.WikiSync.
+    rev_id = Column(Integer)
+    rev_timestamp = Column(String)  # ISO 8601, as given by the MediaWiki API.
+
     def __repr__(self):
         st = '<Piece(name="{}", url="{}")>'
         return st.format(self.name, self.url)
@@ -59,7 +124,7 @@ class Score(Base):
     url = Column(String, nullable=False, unique=True)
 
     composer_id = Column(Integer, ForeignKey('composers.id'))
-    piece_id = Column(Integer, ForeignKey('pieces.id'))
+    piece_id = Column(Integer, ForeignKey('pieces.id'), index=True)
 
     piece = relationship('Piece', back_populates='scores')
     composer = relationship('Composer', back_populates='scores')
@@ -68,54 +133,141 @@ class Score(Base):
     failed_scrape = Column(Boolean, default=False)
     file_path = Column(String)
 
+    # Retry scheduling, see retry.RetryScheduler.
+    attempts = Column(Integer, default=0)
+    last_error = Column(String)
+    next_attempt_at = Column(Float)  # time.time() before which the row is not retried.
+
+    # Work leases, see lease.Leases.
+    lease_owner = Column(String, index=True)
+    lease_expires = Column(Float)  # time.time() after which the row can be claimed by another worker.
+
     rating_count = Column(Integer)
     rating = Column(Float)
     file_format = Column(String)
 
+    download_rate = Column(Float)  # Bytes/sec of the last download.
+    resume_count = Column(Integer)  # Range requests the last download needed.
+
     def __repr__(self):
         st = '<Score(name="{}", url="{}")>'
         return st.format(self.name, self.url)
 
-Base.metadata.create_all(engine)
-DB_SESSION = sessionmaker(bind=engine)
 
+class DeadLetter(Base):
+    """A composer, piece or score that failed more times than the retry budget allows."""
+    __tablename__ = 'dead_letters'
 
-def migration1():
-    """Add rating columns to scores, set bool defaults to false.
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    table_name = Column(String, nullable=False)
+    row_id = Column(Integer, nullable=False)
+    url = Column(String)
+    attempts = Column(Integer)
+    last_error = Column(String)
+    created = Column(Float)
 
-    This migration was applied after Composers were scraped but
-    before pieces had begun to be scraped.
-    """
-    conn = sqlite3.connect(SQLITE_FILE)
-    conn.execute("""ALTER TABLE scores ADD rating_count INT;""")
-    conn.execute("""ALTER TABLE scores ADD rating FLOAT;""")
-    conn.execute("""ALTER TABLE scores ADD file_format STRING;""")
+    def __repr__(self):
+        st = '<DeadLetter(table_name="{}", url="{}", attempts={})>'
+        return st.format(self.table_name, self.url, self.attempts)
 
-    session = DB_SESSION()
-    for piece in session.query(Piece).all():
-        piece.scraped = False
-        piece.all_downloaded = False
-    session.commit()
 
+class SyncState(Base):
+    """A named value kept between runs, such as the watermark of the last sync."""
+    __tablename__ = 'sync_state'
 
-def migration2():
-    """Add a 'failed_scrape' column to all models.
+    name = Column(String, primary_key=True)
+    value = Column(String)
 
-    This migration was applied after I found I needed a way to avoid getting in a cycle
-    of repeatedly trying to scrape things that were broken.
-    """
-    conn = sqlite3.connect(SQLITE_FILE)
-    conn.execute("""ALTER TABLE scores ADD failed_scrape BOOLEAN DEFAULT FALSE;""")
-    conn.execute("""ALTER TABLE pieces ADD failed_scrape BOOLEAN DEFAULT FALSE;""")
-    conn.execute("""ALTER TABLE composers ADD failed_scrape BOOLEAN DEFAULT FALSE;""")
-
-    session = DB_SESSION()
-    for piece in session.query(Piece).all():
-        piece.failed_scrape = False
-    session.commit()
-    for composer in session.query(Composer).all():
-        composer.failed_scrape = False
-    session.commit()
-    for score in session.query(Score).all():
-        score.failed_scrape = False
-    session.commit()
+    def __repr__(self):
+        return '<SyncState(name="{}", value="{}")>'.format(self.name, self.value)
+
+
+# The tables below hold the parsed metadata of pieces, one row per value, see
+# normalize.py. They are written alongside json_metadata and can be rebuilt
+# from it.
+
+class PieceField(Base):
+    """A field of the 'General Information' section of a piece page, e.g. Genre."""
+    __tablename__ = 'piece_fields'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    piece_id = Column(Integer, ForeignKey('pieces.id'), nullable=False, index=True)
+    name = Column(String, nullable=False)
+    value = Column(String)
+    structured = Column(Boolean, default=True)  # False if parsed as a bare string rather than text and links.
+
+    __table_args__ = (Index('ix_piece_fields_name_value', 'name', 'value'),)
+
+    def __repr__(self):
+        return '<PieceField(name="{}", value="{}")>'.format(self.name, self.value)
+
+
+class Edition(Base):
+    """An edition of a piece: one of the download tables of its page, in page order."""
+    __tablename__ = 'editions'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    piece_id = Column(Integer, ForeignKey('pieces.id'), nullable=False, index=True)
+
+    def __repr__(self):
+        return '<Edition(id="{}", piece_id="{}")>'.format(self.id, self.piece_id)
+
+
+class EditionLink(Base):
+    """A link of an edition's download table, in page order. Those to score files are scores' urls."""
+    __tablename__ = 'edition_links'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    edition_id = Column(Integer, ForeignKey('editions.id'), nullable=False, index=True)
+    url = Column(String, index=True)
+
+    def __repr__(self):
+        return '<EditionLink(url="{}")>'.format(self.url)
+
+
+class EditionField(Base):
+    """A field of an edition, e.g. its CPDL# or Editor."""
+    __tablename__ = 'edition_fields'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    edition_id = Column(Integer, ForeignKey('editions.id'), nullable=False, index=True)
+    name = Column(String, nullable=False)
+    value = Column(String)
+    structured = Column(Boolean, default=True)
+
+    __table_args__ = (Index('ix_edition_fields_name_value', 'name', 'value'),)
+
+    def __repr__(self):
+        return '<EditionField(name="{}", value="{}")>'.format(self.name, self.value)
+
+
+class Movement(Base):
+    __tablename__ = 'movements'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    piece_id = Column(Integer, ForeignKey('pieces.id'), nullable=False, index=True)
+    cpdl_number = Column(String, index=True)
+    name = Column(String)
+
+    def __repr__(self):
+        return '<Movement(cpdl_number="{}", name="{}")>'.format(self.cpdl_number, self.name)
+
+
+class MetadataLink(Base):
+    """A link in the value of a piece field, or of an edition field if edition_id is set."""
+    __tablename__ = 'metadata_links'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    piece_id = Column(Integer, ForeignKey('pieces.id'), nullable=False, index=True)
+    edition_id = Column(Integer, ForeignKey('editions.id'))
+    field = Column(String, nullable=False)
+    text = Column(String)
+    url = Column(String, index=True)
+
+    def __repr__(self):
+        return '<MetadataLink(field="{}", url="{}")>'.format(self.field, self.url)
+
+
+# Tables are created here, columns added to existing tables by migrations.py.
+Base.metadata.create_all(engine)
+DB_SESSION = sessionmaker(bind=engine)
@@ -0,0 +1,64 @@
+"""SQLite tuning applied to every connection of the scraper's database.
+
+configure_engine() hooks the connection event so each new connection gets
+the pragmas from settings:
+    journal_mode=WAL so readers don't block the writer and a commit appends
+        to the log instead of rewriting pages through a rollback journal,
+    synchronous, which at NORMAL only syncs the log at checkpoints under WAL,
+    cache_size, mmap_size and temp_store,
+    busy_timeout, so workers sharing the file wait their turn to write
+        rather than fail with 'database is locked'.
+
+create_partial_indexes(), run by migration 9 of migrations.py, adds an index
+over each work queue, holding only the rows still to be done. The queries that select work compare the flags
+to literal false()/true() rather than bound parameters, since SQLite only
+uses a partial index when the query's WHERE clause implies the index's.
+"""
+from sqlalchemy import event
+
+from settings import SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_CACHE_SIZE, SQLITE_MMAP_SIZE, \
+    SQLITE_TEMP_STORE, SQLITE_BUSY_TIMEOUT
+
+PRAGMAS = (
+    ('journal_mode', SQLITE_JOURNAL_MODE),
+    ('synchronous', SQLITE_SYNCHRONOUS),
+    ('cache_size', SQLITE_CACHE_SIZE),
+    ('mmap_size', SQLITE_MMAP_SIZE),
+    ('temp_store', SQLITE_TEMP_STORE),
+    ('busy_timeout', SQLITE_BUSY_TIMEOUT),
+)
+
+# (name, table, WHERE clause) of the index over each work queue.
+PARTIAL_INDEXES = (
+    ('ix_composers_to_scrape', 'composers', 'all_scraped = 0 AND failed_scrape = 0'),
+    ('ix_pieces_to_scrape', 'pieces', 'scraped = 0 AND failed_scrape = 0'),
+    ('ix_scores_to_download', 'scores', 'downloaded = 0 AND failed_scrape = 0'),
+)
+
+
+def apply_pragmas(dbapi_connection, connection_record=None):
+    """Set PRAGMAS on a new DB-API connection. Has the signature of a 'connect' listener."""
+    cursor = dbapi_connection.cursor()
+    for name, value in PRAGMAS:
+        cursor.execute("PRAGMA {} = {};".format(name, value))
+    cursor.close()
+
+
+def configure_engine(engine):
+    """Apply PRAGMAS to every connection the engine opens, if it is an SQLite engine."""
+    if engine.dialect.name == 'sqlite':
+        event.listen(engine, 'connect', apply_pragmas)
+    return engine
+
+
+def create_partial_indexes(engine):
+    """Create the work queue indexes that don't exist yet."""
+    with engine.begin() as conn:
+        for statement in partial_index_statements():
+            conn.execute(statement)
+
+
+def partial_index_statements():
+    """Return the CREATE INDEX IF NOT EXISTS statements of PARTIAL_INDEXES."""
+    return ["CREATE INDEX IF NOT EXISTS {} ON {} (id) WHERE {};".format(name, table, where)
+            for name, table, where in PARTIAL_INDEXES]
@@ -1,12 +1,23 @@
 import logging
 import datetime
+from sqlalchemy import func, true
 
 from emailer import Emailer
 from db import Piece
-from settings import EMAIL_ADRR, EMAIL_PASS, PROXY_LIST, FUZZ_RANGE
+from settings import EMAIL_ADRR, EMAIL_PASS, PROXY_LIST, FUZZ_RANGE, CACHE_DIR, ADAPTIVE_THROTTLE
 from requester import ProxiedFuzzedRequester
+from cache import ResponseCache
+from throttle import AdaptiveThrottle
 
-DEFAULT_REQUESTER = ProxiedFuzzedRequester(PROXY_LIST, FUZZ_RANGE)
+
+def make_requester(proxy_list):
+    """Return a ProxiedFuzzedRequester over proxy_list, configured from settings."""
+    return ProxiedFuzzedRequester(proxy_list, FUZZ_RANGE,
+                                  cache=ResponseCache(CACHE_DIR) if CACHE_DIR else None,
+                                  throttle=AdaptiveThrottle(FUZZ_RANGE) if ADAPTIVE_THROTTLE else None)
+
+
+DEFAULT_REQUESTER = make_requester(PROXY_LIST)
 EMAILER = Emailer(('smtp.mail.com', 587), EMAIL_ADRR, EMAIL_PASS)
 SHOULD_TERM = False  # Flag set to true when a TERM signal arrives.
 
@@ -20,12 +31,14 @@ def commit_session(session):
     session.commit()
 
     if (datetime.datetime.now() - EMAILER._last_status_email).days >= 1:
-        pieces_scraped = session.query(Piece).filter(Piece.scraped == True).count()
-        total_pieces = session.query(Piece).count()
+        pieces_scraped = session.query(func.count(Piece.id)).filter(Piece.scraped == true()).scalar()
+        total_pieces = session.query(func.count(Piece.id)).scalar()
         send_status_update_email(pieces_scraped, total_pieces)
         EMAILER._last_status_email = datetime.datetime.now()
     if SHOULD_TERM:
         logging.info("Received TERM signal. Shutting down.")
+        logging.info("HTTP connection stats: {}".format(DEFAULT_REQUESTER.connection_stats()))
+        DEFAULT_REQUESTER.close()
         exit(0)
 
 
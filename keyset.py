@@ -0,0 +1,55 @@
+"""Iterate over big tables a batch at a time, with memory that does not grow with the table.
+
+Each batch is a fresh query for the next batch_size rows after the last key
+seen (WHERE key > ? ORDER BY key LIMIT ?), so it is as fast at the end of a
+table as at the start, rows updated or committed along the way are neither
+skipped nor seen twice, and no cursor is left open across commits.
+
+Between batches the session is flushed and the rows of the batch before
+are expunged from it, so they are garbage collected as soon as the caller
+lets go of them. Other objects in the session are left alone. Callers
+select only the columns they need: query the columns themselves, or
+entities with load_only(), and leave the big deferred columns alone.
+"""
+from itertools import chain
+
+from sqlalchemy import inspect
+
+from settings import KEYSET_BATCH_SIZE
+
+
+def iter_batches(query, key, batch_size=KEYSET_BATCH_SIZE, expunge=True):
+    """Yield the rows of query in lists of up to batch_size, paging by key.
+
+    Args:
+        query: the query to page through. It must select key, either as a
+            column or as part of an entity, and must not be ordered or limited.
+        key: the unique, sortable column to page by, usually the primary key.
+        batch_size: the most rows loaded at once.
+        expunge: flush the session and expunge the rows of each batch before
+            loading the next. Pass False if they are still being worked on
+            once the next batch is asked for, e.g. by other coroutines.
+    """
+    last_key = None
+    while True:
+        page = query if last_key is None else query.filter(key > last_key)
+        batch = page.order_by(key).limit(batch_size).all()
+        if not batch:
+            return
+        last_key = getattr(batch[-1], key.key)
+        yield batch
+        if expunge:
+            expunge_batch(query.session, batch)
+
+
+def iter_rows(query, key, batch_size=KEYSET_BATCH_SIZE, expunge=True):
+    """Like iter_batches(), but yields the rows one by one."""
+    return chain.from_iterable(iter_batches(query, key, batch_size, expunge))
+
+
+def expunge_batch(session, rows):
+    """Flush the session and expunge the mapped objects among rows from it."""
+    session.flush()
+    for row in rows:
+        if inspect(row, raiseerr=False) is not None and row in session:
+            session.expunge(row)
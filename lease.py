@@ -0,0 +1,164 @@
+"""Work leases, so several worker processes can share one database.
+
+Before working on a batch of composers, pieces or scores, a worker claims
+it: a single UPDATE sets lease_owner and lease_expires on up to batch_size
+rows of the work queue that nobody holds, or whose lease has expired, and
+the worker then loads the rows it got. The UPDATE is atomic, in SQLite
+because there is only one writer at a time and in Postgres because the
+rows are picked with SELECT ... FOR UPDATE SKIP LOCKED, so no two workers
+ever get the same row.
+
+While a worker is busy a heartbeat thread pushes back the expiry of
+everything it holds, every third of the lease duration. A worker that
+dies stops renewing, and its rows go back to the queue once its leases
+expire. Leases still held when a worker stops are released.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+
+from sqlalchemy import and_, or_, select, true
+
+from db import Composer, Piece, Score
+from keyset import expunge_batch
+from settings import LOG_NAME, LEASE_DURATION, LEASE_BATCH_SIZE
+
+LEASED_MODELS = (Composer, Piece, Score)
+
+
+def default_owner():
+    """Return a lease owner name unique to this process, e.g. 'host:1234'."""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class Leases:
+    """Claims, renews and releases the work leases of one worker."""
+
+    def __init__(self, session, owner=None, duration=LEASE_DURATION):
+        """Create Leases
+
+        Args:
+            session: the session to claim rows in.
+            owner: the name the worker holds its leases under. Defaults to
+                default_owner().
+            duration: seconds a claim lasts without being renewed.
+        """
+        self._session = session
+        self.owner = owner if owner else default_owner()
+        self.duration = duration
+        self._logger = logging.getLogger(LOG_NAME)
+
+    def claim(self, query, model, batch_size=LEASE_BATCH_SIZE, after_id=0):
+        """Claim up to batch_size rows of query and return them, in id order.
+
+        Args:
+            query: a query of model whose filters select the work queue, e.g.
+                the rows not scraped yet. Its loader options are kept.
+            model: the model queried.
+            batch_size: the most rows claimed.
+            after_id: only claim rows with a greater id.
+        """
+        now = time.time()
+        expires = now + self.duration
+        available = and_(query.whereclause if query.whereclause is not None else true(),
+                         model.id > after_id,
+                         or_(model.lease_expires == None, model.lease_expires < now))
+        ids = select([model.id]).where(available).order_by(model.id).limit(batch_size)\
+            .with_for_update(skip_locked=True)
+        claimed = self._session.query(model).filter(model.id.in_(ids))\
+            .update({model.lease_owner: self.owner, model.lease_expires: expires}, synchronize_session=False)
+        self._session.commit()
+        if not claimed:
+            return []
+        return query.filter(model.lease_owner == self.owner, model.lease_expires == expires)\
+            .order_by(model.id).all()
+
+    def iter_claims(self, query, model, batch_size=LEASE_BATCH_SIZE, expunge=True, release=True, renew=True):
+        """Claim and yield batches of query until there is nothing left to claim.
+
+        Works like keyset.iter_batches(): batches are claimed in id order and
+        rows of a batch are expunged before the next is claimed, if expunge.
+        Once the end of the queue is reached, it is swept once more from the
+        start for rows of other workers whose leases expired in the meantime.
+        If renew, the leases are renewed by a heartbeat thread until the
+        iteration ends. They are then released if release. Pass False for
+        both if rows may still be worked on after the last batch was asked
+        for, renew the leases with keep_alive() meanwhile, and call release()
+        once done.
+        """
+        heartbeat = self.keep_alive() if renew else None
+        orphans = query.filter(model.lease_owner != None, model.lease_owner != self.owner)
+        try:
+            for pending in (query, orphans):
+                last_id = 0
+                while True:
+                    batch = self.claim(pending, model, batch_size, last_id)
+                    if not batch:
+                        break
+                    last_id = batch[-1].id
+                    yield batch
+                    if expunge:
+                        expunge_batch(self._session, batch)
+        finally:
+            if heartbeat is not None:
+                heartbeat.stop()
+            if release:
+                self.release(model)
+
+    def keep_alive(self):
+        """Start renewing every lease held in a heartbeat thread. Returns it: call its stop() once done."""
+        heartbeat = _Heartbeat(self)
+        heartbeat.start()
+        return heartbeat
+
+    def renew(self, bind=None):
+        """Push back the expiry of every lease held. Returns the number of rows renewed.
+
+        Args:
+            bind: the engine or connection to write with. Defaults to the
+                session's engine, through a connection of its own.
+        """
+        bind = bind if bind is not None else self._session.get_bind()
+        expires = time.time() + self.duration
+        renewed = 0
+        with bind.begin() as conn:
+            for model in LEASED_MODELS:
+                table = model.__table__
+                renewed += conn.execute(table.update().where(table.c.lease_owner == self.owner)
+                                        .values(lease_expires=expires)).rowcount
+        return renewed
+
+    def release(self, model=None):
+        """Give up the leases held on rows of model, or on all rows if model is None, and commit."""
+        if not self._session.is_active:
+            self._session.rollback()
+        for leased in (model,) if model is not None else LEASED_MODELS:
+            self._session.query(leased).filter(leased.lease_owner == self.owner)\
+                .update({leased.lease_owner: None, leased.lease_expires: None}, synchronize_session=False)
+        self._session.commit()
+
+
+class _Heartbeat:
+    """Thread renewing the leases of a Leases every third of their duration."""
+
+    def __init__(self, leases):
+        self._leases = leases
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lease-heartbeat', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self._leases.duration / 3.0):
+            try:
+                self._leases.renew()
+            except Exception as e:
+                # The leases then run out and the rows go back to the queue, which is only wasteful.
+                self._leases._logger.warning("Failed to renew the leases of {}: {}".format(self._leases.owner, e))
@@ -6,31 +6,41 @@ import os
 import json
 import datetime
 
-from settings import LOG_FILE, DOWNLOAD_PATH
+from settings import LOG_FILE, DOWNLOAD_PATH, PROXY_LIST
 from db import DB_SESSION
-from globals import set_should_term_true, EMAILER, DEFAULT_REQUESTER
+from globals import set_should_term_true, EMAILER, DEFAULT_REQUESTER, make_requester
 
 
 def start_shell():
-    """Opens up an IPython window and a DB session to browse the database."""
+    """Opens up an IPython window and a DB session to browse the database.
+
+    proxy_pool.format_stats() shows the health of each proxy.
+    """
     from scraper import WebScraper
     session = DB_SESSION()
     IS = WebScraper(session)
+    proxy_pool = DEFAULT_REQUESTER.proxy_pool
+    print(proxy_pool.format_stats())
     IPython.embed()
 
 
-def start_scrape():
-    """Searches for things to scrape and gets to work."""
+def start_scrape(requester=DEFAULT_REQUESTER):
+    """Searches for things to scrape and gets to work.
+
+    Any number of these can run against the same database, each claiming
+    its own work, see lease.py. The wiki revision of every page is recorded
+    through the MediaWiki API, for start_update().
+    """
     from scraper import WebScraper
-    from db import Composer
+    from mwapi import MediaWikiAPI
 
     logging.info("Starting to scrape.")
 
     session = DB_SESSION()
-    IS = WebScraper(session)
+    IS = WebScraper(session, requester, revision_api=MediaWikiAPI(requester=requester))
 
     # Get composers into DB
-    if session.query(Composer).count() < 2000:
+    if not _already_scraped_composers_list(session):
         IS.scrape_composer_list()
 
     # Scrape the pieces off composers.
@@ -42,22 +52,134 @@ def start_scrape():
     # Download all the scores.
     IS.download_all_scores()
     
+    logging.info("HTTP connection stats: {}".format(requester.connection_stats()))
+    logging.info("Done downloading!")
+
+
+def start_async_scrape(requester=DEFAULT_REQUESTER):
+    """Same as start_scrape(), but keeps many requests in flight at once."""
+    from scraper import WebScraper
+    from async_scraper import AsyncWebScraper
+    from mwapi import MediaWikiAPI
+
+    logging.info("Starting to scrape asynchronously.")
+
+    session = DB_SESSION()
+    if not _already_scraped_composers_list(session):
+        WebScraper(session, requester).scrape_composer_list()
+
+    AS = AsyncWebScraper(session, requester, revision_api=MediaWikiAPI(requester=requester))
+    try:
+        AS.run(AS.scrape_all_composers())
+        AS.run(AS.scrape_all_pieces())
+        AS.run(AS.download_all_scores())
+    finally:
+        AS.close()
+
+    logging.info("HTTP connection stats: {}".format(requester.connection_stats()))
+    logging.info("Done downloading!")
+
+
+def start_pipeline_scrape(requester=DEFAULT_REQUESTER):
+    """Same as start_scrape(), but scrapes composers, pieces and scores at the same
+    time, each with its own threads, see pipeline.py."""
+    from scraper import WebScraper
+    from pipeline import Pipeline
+    from mwapi import MediaWikiAPI
+
+    logging.info("Starting to scrape through the pipeline.")
+
+    session = DB_SESSION()
+    if not _already_scraped_composers_list(session):
+        WebScraper(session, requester).scrape_composer_list()
+    session.close()
+
+    Pipeline(DB_SESSION, requester, revision_api=MediaWikiAPI(requester=requester)).run()
+
+    logging.info("HTTP connection stats: {}".format(requester.connection_stats()))
     logging.info("Done downloading!")
 
 
+def start_api_scrape(requester=DEFAULT_REQUESTER):
+    """Same as start_scrape(), but lists composers' pieces and fetches piece pages
+    through the MediaWiki API, many at a time."""
+    from scraper import WebScraper
+    from mwapi import MediaWikiAPI
+
+    logging.info("Starting to scrape through the MediaWiki API.")
+
+    session = DB_SESSION()
+    IS = WebScraper(session, requester, api=MediaWikiAPI(requester=requester))
+
+    if not _already_scraped_composers_list(session):
+        IS.scrape_composer_list()
+    IS.scrape_all_composers()
+    IS.scrape_all_pieces()
+    IS.download_all_scores()
+
+    logging.info("HTTP connection stats: {}".format(requester.connection_stats()))
+    logging.info("Done downloading!")
+
+
+def start_update(requester=DEFAULT_REQUESTER):
+    """Scrape only what changed on the wiki since the last update, through the MediaWiki API."""
+    from scraper import WebScraper
+    from mwapi import MediaWikiAPI
+    from sync import WikiSync
+
+    logging.info("Starting an incremental update.")
+
+    session = DB_SESSION()
+    api = MediaWikiAPI(requester=requester)
+    WikiSync(session, api).sync()
+
+    IS = WebScraper(session, requester, api=api)
+    IS.scrape_all_composers()
+    IS.scrape_all_pieces()
+    IS.download_all_scores()
+
+    logging.info("HTTP connection stats: {}".format(requester.connection_stats()))
+    logging.info("Done updating!")
+
+
+def start_migrate():
+    """Bring the database schema up to date, see migrations.py."""
+    from db import engine
+    from migrations import migrate
+    if engine.dialect.name != 'sqlite':
+        logging.info("Not migrating {}, its schema is made by create_all().".format(engine.dialect.name))
+        return
+    version = migrate()
+    logging.info("Database is at schema version {}.".format(version))
+
+
 def _already_scraped_composers_list(session):
-    from db import Composer
-    composer_count = session.query(Composer).count()
-    return composer_count >= 14740
+    from sync import get_sync_state, COMPOSER_LIST_SCRAPED
+    return get_sync_state(session, COMPOSER_LIST_SCRAPED) is not None
 
 
 def parse_args():
     """Parse and return command line args."""
     parser = argparse.ArgumentParser(description="Rip stuff from websites dude.")
-    parser.add_argument('action', choices=('shell', 'scrape'))
+    parser.add_argument('action', choices=('shell', 'scrape', 'async-scrape', 'pipeline-scrape', 'api-scrape', 'update',
+                                           'migrate'))
+    parser.add_argument('--worker', type=int, default=0,
+                        help="Index of this worker, when running several on the same database.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of workers. Each uses every Nth proxy of PROXY_LIST, from its index.")
     return parser.parse_args()
 
 
+def worker_requester(worker, workers):
+    """Return the requester of a worker, over its share of PROXY_LIST."""
+    if workers <= 1:
+        return DEFAULT_REQUESTER
+    proxies = PROXY_LIST[worker::workers]
+    if PROXY_LIST and not proxies:
+        raise ValueError("Worker {} of {} has no proxies, there are only {}.".format(worker, workers, len(PROXY_LIST)))
+    return make_requester(proxies)
+
+
 def init_logging():
     """Initiate logging behaviour for project."""
     logging.basicConfig(filename=LOG_FILE, level=logging.INFO)
@@ -77,9 +199,23 @@ if __name__ == '__main__':
 
     if action == 'shell':
         start_shell()
-    elif action == 'scrape':
+    elif action == 'migrate':
+        start_migrate()
+    elif action in ('scrape', 'async-scrape', 'pipeline-scrape', 'api-scrape', 'update'):
+        # The scrape loops rely on the latest columns and indexes.
+        start_migrate()
+        requester = worker_requester(args.worker, args.workers)
         try:
-            start_scrape()
+            if action == 'scrape':
+                start_scrape(requester)
+            elif action == 'pipeline-scrape':
+                start_pipeline_scrape(requester)
+            elif action == 'api-scrape':
+                start_api_scrape(requester)
+            elif action == 'update':
+                start_update(requester)
+            else:
+                start_async_scrape(requester)
         except Exception as e:
             if isinstance(e, RippingError):
                 logging.error("Ripping detected. Exiting.")
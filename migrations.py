@@ -0,0 +1,304 @@
+"""Versioned schema migrations of the scraper's SQLite database.
+
+New tables are created by create_all() in db.py; migrations add the columns
+and indexes that create_all() can't add to existing tables, and fix up the
+data. The schema_version table records every migration started and
+finished, and migrate() runs the ones that haven't finished, in order.
+Workers started at the same time all call migrate(), so it holds a lock
+file beside the database while it runs: the others wait for it, then find
+every migration finished.
+
+Each migration is written to be run on any database, however old:
+columns are only added if missing, and data is only touched if the
+migration added a column, in this run or an interrupted one, which
+schema_version records. A new database, which create_all() made with the
+latest schema, goes through them without any change to its data, and so
+does a database whose migration was started by a worker of an older
+version that didn't record what it added.
+
+Data changes are set-based UPDATEs over MIGRATION_BATCH_SIZE ids at a time,
+committed after each range, so no row is loaded into Python, transactions
+stay small, and an interrupted migration picks up where it left off: the
+WHERE clause of each update skips rows already done.
+
+Migrations are for SQLite databases. Others are only ever created by
+create_all(), with the latest schema.
+
+Usage:
+    python main.py migrate
+"""
+import fcntl
+import logging
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from db import CompressedText, engine
+from db_setup import partial_index_statements
+from settings import LOG_NAME, MIGRATION_BATCH_SIZE
+
+
+class MigrationContext:
+    """What a migration runs with: the connection and helpers over it."""
+
+    def __init__(self, conn, version, added=(), batch_size=MIGRATION_BATCH_SIZE):
+        """Create a MigrationContext
+
+        Args:
+            conn: the sqlite3 connection to the database.
+            version: the version of the migration, its row in schema_version.
+            added: the 'table.column's an interrupted run of the migration added.
+            batch_size: the ids per UPDATE of update_in_batches().
+        """
+        self.conn = conn
+        self.version = version
+        self.added = set(added)
+        self.batch_size = batch_size
+        self._logger = logging.getLogger(LOG_NAME)
+
+    def add_column(self, table, column, definition):
+        """Add a column to table if it doesn't have it.
+
+        Returns: True if this migration added it, in this run or an
+            interrupted one, so its data still has to be set up.
+        """
+        name = '{}.{}'.format(table, column)
+        if column in self.columns(table):
+            return name in self.added
+        self.added.add(name)
+        # Recorded in the same transaction as the new column.
+        self.conn.execute("""UPDATE schema_version SET added_columns = ? WHERE version = ?;""",
+                          (','.join(sorted(self.added)), self.version))
+        self.conn.execute("""ALTER TABLE {} ADD {} {};""".format(table, column, definition))
+        self.conn.commit()
+        return True
+
+    def columns(self, table):
+        return {row[1] for row in self.conn.execute("""PRAGMA table_info({});""".format(table))}
+
+    def update_in_batches(self, table, assignments, where='1', params=()):
+        """Run UPDATE table SET assignments WHERE where, a range of ids at a time.
+
+        Args:
+            table: the table to update. It must have an integer id column.
+            assignments: the SET clause.
+            where: a condition that is False for rows already updated, so an
+                interrupted update can be run again.
+            params: parameters of assignments and where.
+
+        Returns: the number of rows updated.
+        """
+        max_id = self.conn.execute("""SELECT MAX(id) FROM {};""".format(table)).fetchone()[0] or 0
+        statement = """UPDATE {} SET {} WHERE id > ? AND id <= ? AND ({});""".format(table, assignments, where)
+        updated = 0
+        for start in range(0, max_id, self.batch_size):
+            updated += self.conn.execute(statement, tuple(params) + (start, start + self.batch_size)).rowcount
+            self.conn.commit()
+            self._logger.info("Updated {} rows of {} up to id {} of {}.".format(
+                updated, table, min(start + self.batch_size, max_id), max_id))
+        return updated
+
+
+def migration1(m):
+    """Add rating columns to scores, set bool defaults to false.
+
+    This migration was applied after Composers were scraped but
+    before pieces had begun to be scraped.
+    """
+    added = [m.add_column('scores', 'rating_count', 'INT'),
+             m.add_column('scores', 'rating', 'FLOAT'),
+             m.add_column('scores', 'file_format', 'STRING')]
+    if any(added):
+        m.update_in_batches('pieces', 'scraped = 0, all_downloaded = 0',
+                            'scraped IS NOT 0 OR all_downloaded IS NOT 0')
+
+
+def migration2(m):
+    """Add a 'failed_scrape' column to all models.
+
+    This migration was applied after I found I needed a way to avoid getting in a cycle
+    of repeatedly trying to scrape things that were broken.
+    """
+    for table in ('pieces', 'composers', 'scores'):
+        if m.add_column(table, 'failed_scrape', 'BOOLEAN DEFAULT 0'):
+            m.update_in_batches(table, 'failed_scrape = 0', 'failed_scrape IS NOT 0')
+
+
+def migration3(m):
+    """Add download statistics columns to scores.
+
+    This migration was applied when score downloads started streaming to disk
+    and resuming interrupted transfers.
+    """
+    m.add_column('scores', 'download_rate', 'FLOAT')
+    m.add_column('scores', 'resume_count', 'INT')
+
+
+def migration4(m):
+    """Add retry scheduling columns to all models.
+
+    Rows flagged by failed_scrape before this were never retried, so they are
+    put back in the queue for the retry scheduler to deal with. The
+    dead_letters table is created by create_all().
+    """
+    for table in ('composers', 'pieces', 'scores'):
+        added = [m.add_column(table, 'attempts', 'INT DEFAULT 0'),
+                 m.add_column(table, 'last_error', 'STRING'),
+                 m.add_column(table, 'next_attempt_at', 'FLOAT')]
+        if any(added):
+            m.update_in_batches(table, 'failed_scrape = 0', 'failed_scrape = 1 AND attempts IS 0')
+
+
+def migration5(m):
+    """Add parser version stamping columns to pieces.
+
+    Pieces scraped before this have no stamp, so the first incremental re-parse
+    redoes all of them.
+    """
+    m.add_column('pieces', 'parser_version', 'STRING')
+    m.add_column('pieces', 'html_hash', 'STRING')
+
+
+def migration6(m):
+    """Compress the html_dump and json_metadata of every piece.
+
+    The compression runs inside SQLite through a registered function, a
+    range of ids at a time. Rows already compressed hold BLOBs and are
+    skipped, so this does nothing on a database written since. If anything
+    was compressed, the database is vacuumed at the end to give the freed
+    pages back to the file system.
+    """
+    m.conn.create_function('zlib_compress', 1, CompressedText.compress, deterministic=True)
+    compressed = 0
+    for column in ('html_dump', 'json_metadata'):
+        compressed += m.update_in_batches('pieces', '{0} = zlib_compress({0})'.format(column),
+                                          "typeof({}) = 'text'".format(column))
+    if compressed:
+        m.conn.execute("""VACUUM;""")
+
+
+def migration7(m):
+    """Add wiki revision columns to composers and pieces.
+
+    The sync_state table is created by create_all(). Databases that already
+    hold the composer list are marked as such, which used to be guessed from
+    the number of composers.
+    """
+    added = [m.add_column(table, column, definition)
+             for table in ('composers', 'pieces')
+             for column, definition in (('rev_id', 'INT'), ('rev_timestamp', 'STRING'))]
+    if any(added):
+        m.conn.execute("""INSERT OR IGNORE INTO sync_state (name, value)
+                          SELECT 'composer_list_scraped', '1' FROM composers LIMIT 1;""")
+        m.conn.commit()
+
+
+def migration8(m):
+    """Index the scores of each piece.
+
+    The normalized metadata tables, see normalize.py, are created by
+    create_all(), and filled by 'scripts.py backfill-metadata'.
+    """
+    m.conn.execute("""CREATE INDEX IF NOT EXISTS ix_scores_piece_id ON scores (piece_id);""")
+    m.conn.commit()
+
+
+def migration9(m):
+    """Create the partial indexes over the work queues, see db_setup.py."""
+    for statement in partial_index_statements():
+        m.conn.execute(statement)
+    m.conn.commit()
+
+
+def migration10(m):
+    """Add work lease columns to all models, see lease.Leases."""
+    for table in ('composers', 'pieces', 'scores'):
+        m.add_column(table, 'lease_owner', 'STRING')
+        m.add_column(table, 'lease_expires', 'FLOAT')
+        m.conn.execute("""CREATE INDEX IF NOT EXISTS ix_{0}_lease_owner ON {0} (lease_owner);""".format(table))
+    m.conn.commit()
+
+
+def migration11(m):
+    """Mark the pieces whose metadata is in the normalized tables, see normalize.py."""
+    if m.add_column('pieces', 'metadata_normalized', 'BOOLEAN DEFAULT 0'):
+        m.update_in_batches('pieces', 'metadata_normalized = 1',
+                            'metadata_normalized IS NOT 1 AND id IN (SELECT piece_id FROM piece_fields)')
+
+
+def migration12(m):
+    """Keep every edition of the normalized metadata, in the editions tables instead of score_fields.
+
+    The pieces are normalized again by 'scripts.py backfill-metadata', or as
+    they are downloaded.
+    """
+    if m.add_column('metadata_links', 'edition_id', 'INTEGER REFERENCES editions (id)'):
+        m.update_in_batches('pieces', 'metadata_normalized = 0', 'metadata_normalized IS NOT 0')
+    m.conn.execute("""DROP TABLE IF EXISTS score_fields;""")
+    m.conn.commit()
+
+
+MIGRATIONS = [migration1, migration2, migration3, migration4, migration5, migration6, migration7, migration8,
+              migration9, migration10, migration11, migration12]
+
+
+def migrate(path=None, batch_size=MIGRATION_BATCH_SIZE):
+    """Run the migrations that haven't finished on the SQLite database at path.
+
+    Args:
+        path: the database file. Defaults to that of db.engine.
+        batch_size: the ids per UPDATE of data migrations.
+
+    Returns: the schema version the database is at.
+    """
+    logger = logging.getLogger(LOG_NAME)
+    path = path or engine.url.database
+    with _migration_lock(path):
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                                version INTEGER PRIMARY KEY,
+                                name STRING NOT NULL,
+                                started_at FLOAT,
+                                finished_at FLOAT,
+                                added_columns STRING);""")
+            if 'added_columns' not in MigrationContext(conn, 0).columns('schema_version'):
+                conn.execute("""ALTER TABLE schema_version ADD added_columns STRING;""")
+            conn.commit()
+            started = {version: (finished_at, added_columns) for version, finished_at, added_columns
+                       in conn.execute("""SELECT version, finished_at, added_columns FROM schema_version;""")}
+            for version, migration in enumerate(MIGRATIONS, 1):
+                finished_at, added_columns = started.get(version, (None, None))
+                if finished_at:
+                    continue
+                resumed = version in started
+                logger.info("{} migration {}, {}.".format("Resuming" if resumed else "Running", version,
+                                                         migration.__name__))
+                if not resumed:
+                    conn.execute("""INSERT INTO schema_version (version, name, started_at) VALUES (?, ?, ?);""",
+                                 (version, migration.__name__, time.time()))
+                    conn.commit()
+                added = added_columns.split(',') if added_columns else ()
+                migration(MigrationContext(conn, version, added, batch_size))
+                conn.execute("""UPDATE schema_version SET finished_at = ? WHERE version = ?;""",
+                             (time.time(), version))
+                conn.commit()
+            return len(MIGRATIONS)
+        finally:
+            conn.close()
+
+
+@contextmanager
+def _migration_lock(path):
+    """Hold an exclusive lock on a file beside the database at path, waiting for other workers' migrations."""
+    with open(path + '.migrate-lock', 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logging.getLogger(LOG_NAME).info("Waiting for another worker to finish migrating {}.".format(path))
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
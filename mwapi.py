@@ -0,0 +1,154 @@
+from collections import namedtuple
+from urllib.parse import quote, unquote, urlencode, urlparse
+import logging
+
+from settings import API_URL, API_BATCH_SIZE, API_CATEGORY_LIMIT, LOG_NAME
+from globals import DEFAULT_REQUESTER
+
+# Where the wiki serves its articles. Page URLs in the database are relative to the domain.
+WIKI_PATH = '/wiki/index.php/'
+
+# Characters MediaWiki leaves unescaped in article URLs, see wfUrlencode().
+_URL_SAFE = ";@$!*(),/~:"
+
+# The latest revision of a page, as returned by MediaWikiAPI.fetch_pages(). html is the
+# rendered page content, which PiecePage parses like a full page.
+PageRevision = namedtuple('PageRevision', ('title', 'html', 'rev_id', 'rev_timestamp'))
+
+
+class MediaWikiAPIError(Exception):
+    def __init__(self, code, info):
+        super().__init__("{}: {}".format(code, info))
+        self.code = code
+        self.info = info
+
+
+def title_to_url(title):
+    """Return the relative URL MediaWiki links a page title to."""
+    return WIKI_PATH + quote(title.replace(' ', '_'), safe=_URL_SAFE)
+
+
+def url_to_title(url):
+    """Return the page title of an article URL, relative or absolute."""
+    path = urlparse(url).path
+    if WIKI_PATH in path:
+        path = path.split(WIKI_PATH, 1)[1]
+    return unquote(path).replace('_', ' ')
+
+
+class MediaWikiAPI:
+    """Client for the wiki's action API (api.php).
+
+    Lists category members up to category_limit per request and fetches the
+    rendered content of up to batch_size pages per request, following the
+    'continue' protocol for anything that doesn't fit in one response. This
+    takes a small fraction of the requests of crawling the rendered pages, and
+    so a small fraction of the rate limited wall time.
+    """
+
+    def __init__(self, api_url=API_URL, requester=None, batch_size=API_BATCH_SIZE,
+                 category_limit=API_CATEGORY_LIMIT):
+        """Create a MediaWikiAPI
+
+        Args:
+            api_url: the absolute URL of api.php.
+            requester: the requester to make requests with. Defaults to DEFAULT_REQUESTER.
+            batch_size: titles per page content request.
+            category_limit: members per category listing request.
+        """
+        self.api_url = api_url
+        self.batch_size = batch_size
+        self.category_limit = category_limit
+        self._requester = requester if requester else DEFAULT_REQUESTER
+        self._logger = logging.getLogger(LOG_NAME)
+
+    def query(self, **params):
+        """Make an action=query request, following continuations.
+
+        Yields: the 'query' part of each response.
+        """
+        params = dict(params, action='query', format='json')
+        params['continue'] = ''
+        while True:
+            # The same query answers differently as the wiki is edited, so it is never cached.
+            resp = self._requester.get(self.api_url + '?' + urlencode(sorted(params.items())), use_cache=False)
+            resp.raise_for_status()
+            result = resp.json()
+            if 'error' in result:
+                raise MediaWikiAPIError(result['error'].get('code'), result['error'].get('info'))
+            if 'warnings' in result:
+                self._logger.warning("MediaWiki API warnings: {}".format(result['warnings']))
+            yield result.get('query', {})
+            if 'continue' not in result:
+                return
+            params.update(result['continue'])
+
+    def iter_category_members(self, category_title, member_type='page'):
+        """Yield lists of (title, url) tuples of a category's members, one response at a time.
+
+        Args:
+            category_title: the category, including its 'Category:' prefix.
+            member_type: 'page', 'subcat' or 'file'.
+        """
+        for query in self.query(list='categorymembers', cmtitle=category_title, cmtype=member_type,
+                                cmprop='title', cmlimit=self.category_limit):
+            yield [(member['title'], title_to_url(member['title'])) for member in query.get('categorymembers', [])]
+
+    def fetch_pages(self, urls):
+        """Fetch the rendered content of the latest revision of many pages.
+
+        Returns: {url: PageRevision} for every page that exists. Missing pages
+            are left out.
+        """
+        return self._batched_pages(urls, prop='revisions|info', rvprop='content|ids|timestamp', rvparse=1)
+
+    def fetch_revisions(self, urls):
+        """Like fetch_pages(), but only fetch the revision IDs and timestamps. html is None."""
+        return self._batched_pages(urls, prop='revisions', rvprop='ids|timestamp')
+
+    def fetch_categories(self, urls):
+        """Return {url: [category title, ...]} of the categories many pages are in."""
+        categories = {}
+        for url, page in self._batched_query_pages(urls, prop='categories', cllimit='max'):
+            categories.setdefault(url, []).extend(c['title'] for c in page.get('categories', []))
+        return categories
+
+    def recent_changes(self, since, namespaces=(0, 14)):
+        """Yield the edits and page creations made since an ISO 8601 timestamp, oldest first.
+
+        Every change is a dict with at least 'type' ('edit' or 'new'), 'ns',
+        'title', 'revid' and 'timestamp'.
+        """
+        for query in self.query(list='recentchanges', rcstart=since, rcdir='newer', rctype='edit|new',
+                                rcnamespace='|'.join(str(ns) for ns in namespaces),
+                                rcprop='title|ids|timestamp', rclimit=self.category_limit):
+            for change in query.get('recentchanges', []):
+                yield change
+
+    def _batched_pages(self, urls, **params):
+        pages = {}
+        for url, page in self._batched_query_pages(urls, **params):
+            if not page.get('revisions'):
+                continue
+            revision = page['revisions'][0]
+            pages[url] = PageRevision(page['title'], revision.get('*', '') if 'rvparse' in params else None,
+                                      revision.get('revid'), revision.get('timestamp'))
+        return pages
+
+    def _batched_query_pages(self, urls, **params):
+        """Query pages batch_size titles at a time.
+
+        Yields: a (url, page) tuple for every page in every response, except
+            missing pages. A page can come up again in later continuations.
+        """
+        urls = list(urls)
+        for start in range(0, len(urls), self.batch_size):
+            urls_by_title = {url_to_title(url): url for url in urls[start:start + self.batch_size]}
+            for query in self.query(titles='|'.join(urls_by_title), **params):
+                # The API answers under the normalized title, e.g. with its first letter capitalized.
+                for normalized in query.get('normalized', []):
+                    if normalized['from'] in urls_by_title:
+                        urls_by_title[normalized['to']] = urls_by_title.pop(normalized['from'])
+                for page in query.get('pages', {}).values():
+                    if 'missing' not in page and page['title'] in urls_by_title:
+                        yield urls_by_title[page['title']], page
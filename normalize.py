@@ -0,0 +1,213 @@
+"""Parsed piece metadata in indexed tables, one row per value, instead of JSON blobs.
+
+PiecePage.extract() gives metadata in the form
+    {'Genre': {'text': 'Sacred, Motet', 'links': [(text, url), ...]}, ...,
+     'movements': {CPDL#: name},
+     'scores': [{'dl_links': [url, ...], 'meta': {'CPDL#': '00134', 'Editor': {...}}}, ...]}
+which is stored as json_metadata. save_metadata() spreads it over the
+piece_fields, movements, editions, edition_links, edition_fields and
+metadata_links tables, so pieces can be looked up by any field with an
+index (see pieces_with_field()), and load_metadata() puts it back together
+without decoding any JSON, e.g. for the downloaders. Every edition is kept,
+with all its links in page order, so the rebuilt metadata equals the
+stored one, except that 'movements' and 'scores' are always there.
+
+json_metadata is still written, and the tables can be rebuilt from it:
+pieces are marked metadata_normalized once they are in the tables, even if
+they have no fields at all, and load_metadata() normalizes the others
+first.
+"""
+import json
+import logging
+from collections import OrderedDict
+
+from sqlalchemy import false, true
+
+from db import Piece, PieceField, Movement, Edition, EditionLink, EditionField, MetadataLink
+from keyset import iter_batches
+from settings import LOG_NAME, KEYSET_BATCH_SIZE
+
+# Keys of the metadata that are not fields of the 'General Information' section.
+_NOT_FIELDS = ('movements', 'scores')
+
+
+def save_metadata(session, pieces):
+    """Replace the normalized metadata of pieces. The caller commits.
+
+    Args:
+        session: the session to write in.
+        pieces: a dict of piece id to its metadata, as stored in json_metadata.
+    """
+    if not pieces:
+        return
+    piece_ids = list(pieces)
+    _delete(session, piece_ids)
+    session.query(Piece).filter(Piece.id.in_(piece_ids))\
+        .update({Piece.metadata_normalized: True}, synchronize_session=False)
+    edition_ids = _insert_editions(session, {piece_id: len(metadata.get('scores', []))
+                                             for piece_id, metadata in pieces.items()})
+
+    rows = {PieceField: [], Movement: [], EditionLink: [], EditionField: [], MetadataLink: []}
+    for piece_id, metadata in pieces.items():
+        for name, value in metadata.items():
+            if name not in _NOT_FIELDS:
+                rows[PieceField].append(dict(_field_row(name, value), piece_id=piece_id))
+                rows[MetadataLink].extend(_link_rows(piece_id, None, name, value))
+        for cpdl_number, name in metadata.get('movements', {}).items():
+            rows[Movement].append({'piece_id': piece_id, 'cpdl_number': cpdl_number, 'name': name})
+        for edition_id, edition in zip(edition_ids[piece_id], metadata.get('scores', [])):
+            rows[EditionLink].extend({'edition_id': edition_id, 'url': url} for url in edition.get('dl_links', []))
+            for name, value in edition.get('meta', {}).items():
+                rows[EditionField].append(dict(_field_row(name, value), edition_id=edition_id))
+                rows[MetadataLink].extend(_link_rows(piece_id, edition_id, name, value))
+
+    for model, model_rows in rows.items():
+        if model_rows:
+            session.execute(model.__table__.insert(), model_rows)
+
+
+def load_metadata(session, piece_ids):
+    """Return {piece id: metadata} of the pieces, rebuilt from the normalized tables.
+
+    The metadata is that stored in json_metadata. Pieces that are scraped but
+    not normalized yet are normalized first, and the caller commits. Unscraped
+    pieces are left out.
+    """
+    piece_ids = set(piece_ids)
+    if not piece_ids:
+        return {}
+    normalized = {piece_id for piece_id, in session.query(Piece.id)
+                  .filter(Piece.id.in_(piece_ids), Piece.metadata_normalized == true())}
+    if normalized != piece_ids:
+        normalized |= backfill_pieces(session, piece_ids - normalized)
+
+    links = {}
+    for piece_id, edition_id, field, text, url in session.query(
+            MetadataLink.piece_id, MetadataLink.edition_id, MetadataLink.field, MetadataLink.text, MetadataLink.url)\
+            .filter(MetadataLink.piece_id.in_(piece_ids)).order_by(MetadataLink.id):
+        links.setdefault((piece_id, edition_id, field), []).append([text, url])
+
+    pieces = {piece_id: {} for piece_id in normalized}
+    for piece_id, name, value, structured in session.query(
+            PieceField.piece_id, PieceField.name, PieceField.value, PieceField.structured)\
+            .filter(PieceField.piece_id.in_(piece_ids)).order_by(PieceField.id):
+        pieces[piece_id][name] = _field_value(value, structured, links.get((piece_id, None, name), []))
+    for metadata in pieces.values():
+        metadata['movements'], metadata['scores'] = {}, []
+
+    for piece_id, cpdl_number, name in session.query(Movement.piece_id, Movement.cpdl_number, Movement.name)\
+            .filter(Movement.piece_id.in_(piece_ids)).order_by(Movement.id):
+        if piece_id in pieces:
+            pieces[piece_id]['movements'][cpdl_number] = name
+
+    editions = {}
+    for edition_id, piece_id in session.query(Edition.id, Edition.piece_id)\
+            .filter(Edition.piece_id.in_(piece_ids)).order_by(Edition.id):
+        if piece_id in pieces:
+            editions[edition_id] = (piece_id, {'dl_links': [], 'meta': OrderedDict()})
+            pieces[piece_id]['scores'].append(editions[edition_id][1])
+    for edition_id, url in session.query(EditionLink.edition_id, EditionLink.url)\
+            .join(Edition, Edition.id == EditionLink.edition_id)\
+            .filter(Edition.piece_id.in_(piece_ids)).order_by(EditionLink.id):
+        if edition_id in editions:
+            editions[edition_id][1]['dl_links'].append(url)
+    for edition_id, name, value, structured in session.query(
+            EditionField.edition_id, EditionField.name, EditionField.value, EditionField.structured)\
+            .join(Edition, Edition.id == EditionField.edition_id)\
+            .filter(Edition.piece_id.in_(piece_ids)).order_by(EditionField.id):
+        if edition_id in editions:
+            piece_id, edition = editions[edition_id]
+            edition['meta'][name] = _field_value(value, structured, links.get((piece_id, edition_id, name), []))
+    return pieces
+
+
+def stored_metadata(session, piece_ids):
+    """Return {piece id: metadata} of the pieces, decoded from json_metadata. Unscraped pieces are left out."""
+    rows = session.query(Piece.id, Piece.json_metadata)\
+        .filter(Piece.id.in_(set(piece_ids)))\
+        .filter(Piece.json_metadata != None)
+    return {piece_id: json.loads(metadata) for piece_id, metadata in rows}
+
+
+def backfill_pieces(session, piece_ids):
+    """Normalize the json_metadata of the given pieces. The caller commits.
+
+    Returns: the set of ids of the pieces normalized, those that were scraped.
+    """
+    metadata = stored_metadata(session, piece_ids)
+    save_metadata(session, metadata)
+    return set(metadata)
+
+
+def backfill_metadata(session, batch_size=KEYSET_BATCH_SIZE):
+    """Normalize every scraped piece that is not marked metadata_normalized yet.
+
+    Commits after every batch, so it can be stopped and run again.
+
+    Returns: the number of pieces normalized.
+    """
+    logger = logging.getLogger(LOG_NAME)
+    pieces = session.query(Piece.id, Piece.json_metadata)\
+        .filter(Piece.json_metadata != None)\
+        .filter(Piece.metadata_normalized == false())
+    done = 0
+    for batch in iter_batches(pieces, Piece.id, batch_size):
+        save_metadata(session, {piece.id: json.loads(piece.json_metadata) for piece in batch})
+        session.commit()
+        done += len(batch)
+        logger.info("Normalized the metadata of {} pieces.".format(done))
+    return done
+
+
+def pieces_with_field(session, name, value):
+    """Return a query of the pieces whose field name has the given text, e.g. ('Language', 'Latin')."""
+    return session.query(Piece)\
+        .filter(Piece.id.in_(session.query(PieceField.piece_id)
+                             .filter(PieceField.name == name, PieceField.value == value)))
+
+
+def pieces_linking_to(session, url):
+    """Return a query of the pieces with a link to url in their fields, e.g. a category."""
+    return session.query(Piece)\
+        .filter(Piece.id.in_(session.query(MetadataLink.piece_id)
+                             .filter(MetadataLink.url == url, MetadataLink.edition_id == None)))
+
+
+def _delete(session, piece_ids):
+    """Delete the normalized rows of pieces."""
+    edition_ids = session.query(Edition.id).filter(Edition.piece_id.in_(piece_ids))
+    for model in (EditionLink, EditionField):
+        session.query(model).filter(model.edition_id.in_(edition_ids)).delete(synchronize_session=False)
+    for model in (PieceField, Movement, MetadataLink, Edition):
+        session.query(model).filter(model.piece_id.in_(piece_ids)).delete(synchronize_session=False)
+
+
+def _insert_editions(session, counts):
+    """Insert counts[piece_id] editions for each piece, which has none. Returns {piece id: [edition id, ...]}."""
+    rows = [{'piece_id': piece_id} for piece_id, count in counts.items() for _ in range(count)]
+    if not rows:
+        return {piece_id: [] for piece_id in counts}
+    session.execute(Edition.__table__.insert(), rows)
+    # Ids are given in insertion order, so each piece gets back its editions in page order.
+    edition_ids = {piece_id: [] for piece_id in counts}
+    for edition_id, piece_id in session.query(Edition.id, Edition.piece_id)\
+            .filter(Edition.piece_id.in_(list(counts))).order_by(Edition.id):
+        edition_ids[piece_id].append(edition_id)
+    return edition_ids
+
+
+def _field_row(name, value):
+    if isinstance(value, dict):
+        return {'name': name, 'value': value.get('text'), 'structured': True}
+    return {'name': name, 'value': value, 'structured': False}
+
+
+def _link_rows(piece_id, edition_id, name, value):
+    if not isinstance(value, dict):
+        return []
+    return [{'piece_id': piece_id, 'edition_id': edition_id, 'field': name, 'text': text, 'url': url}
+            for text, url in value.get('links', [])]
+
+
+def _field_value(value, structured, links):
+    return {'text': value, 'links': links} if structured else value
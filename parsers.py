@@ -2,10 +2,44 @@ from bs4 import BeautifulSoup
 from bs4.element import Tag as bsTag
 from bs4.element import NavigableString as bsString
 from main import DEFAULT_REQUESTER
+from concurrent.futures import ThreadPoolExecutor
+from html import unescape
+import hashlib
+import json
 import logging
-from settings import LOG_NAME, EXTENSIONS
+import re
+from settings import LOG_NAME, EXTENSIONS, HTML_PARSER
 from requester import RippingError
 
+# Tree builders BeautifulSoup can use, fastest first.
+HTML_PARSERS = ('lxml', 'html.parser', 'html5lib')
+
+# str.endswith() takes a tuple, which checks every extension in one C call.
+EXTENSION_SUFFIXES = tuple(EXTENSIONS)
+
+# Version of each component PiecePage parses. Bump a component's version whenever
+# a change to the parser changes its output, so the re-parse script only redoes
+# the pieces and components that are affected.
+PARSER_VERSIONS = {'metadata': 1, 'movements': 1, 'scores': 1}
+PARSER_COMPONENTS = tuple(sorted(PARSER_VERSIONS))
+
+
+def parser_version_stamp(versions=PARSER_VERSIONS):
+    """Return the versions as the string stored in Piece.parser_version."""
+    return json.dumps(versions, sort_keys=True)
+
+
+def html_hash(raw_html):
+    """Return the hash of a page stored in Piece.html_hash, or None if there is no page."""
+    if raw_html is None:
+        return None
+    return hashlib.sha1(raw_html.encode('utf-8')).hexdigest()
+
+
+def has_score_extension(href):
+    """Return True if href links to a score file."""
+    return bool(href) and href.endswith(EXTENSION_SUFFIXES)
+
 
 class PageRequestFailure(Exception):
     def __init__(self, *args, **kwargs):
@@ -17,6 +51,11 @@ class PageParseFailure(Exception):
         self.original_exception = kwargs.get('original')
 
 
+def make_soup(html, parser=None):
+    """Build a BeautifulSoup tree with the given tree builder, or the one set in settings."""
+    return BeautifulSoup(html, parser if parser else HTML_PARSER)
+
+
 def replace_all(string, old_lst, new):
     """Replace any substring in old_lst that occurs in string with new."""
     for substring in old_lst:
@@ -29,18 +68,41 @@ class BaseParser:
     """Some defaults for parsers."""
     __PARSER_NAME__ = "BaserParser"
 
-    def __init__(self, page_url, raw_html=None, requester=None):
+    def __init__(self, page_url, raw_html=None, requester=None, parser=None):
+        """Create a parser for a page, downloading it unless raw_html is given.
+
+        Args:
+            page_url: the URL of the page.
+            raw_html: the page's HTML, if already downloaded.
+            requester: the requester to download the page with.
+            parser: the BeautifulSoup tree builder to use, one of HTML_PARSERS.
+                Defaults to settings.HTML_PARSER.
+        """
         self.url = page_url
         self._requester = requester if requester else DEFAULT_REQUESTER
-        if raw_html:
+        self._html_parser = parser if parser else HTML_PARSER
+        self._soup = None
+        if raw_html is not None:
             self.raw_html = raw_html
-            self.soup = BeautifulSoup(raw_html, 'html5lib')
         else:
             self.raw_response = self._get_page()
             self.raw_html = self.raw_response.text
-            self.soup = BeautifulSoup(self.raw_response.text, 'html5lib')
         self._logger = logging.getLogger(LOG_NAME)
 
+    @property
+    def soup(self):
+        """The parse tree of the whole page, built on first use."""
+        if self._soup is None:
+            self._soup = make_soup(self.raw_html, self._html_parser)
+        return self._soup
+
+    def release(self):
+        """Free the parse tree and the response. raw_html is kept."""
+        if self._soup is not None:
+            self._soup.decompose()
+            self._soup = None
+        self.raw_response = None
+
     def __repr__(self):
         return '{}("{}")'.format(self.__PARSER_NAME__, self.url)
 
@@ -65,6 +127,10 @@ class PiecePage(BaseParser):
     __PARSER_NAME__ = "PiecePage"
     _FILE_FORMATS = ('PDF', )
 
+    # MediaWiki markup around the page content. See _parse_content().
+    _CONTENT_START = '<div id="mw-content-text"'
+    _CONTENT_END = '<div class="printfooter">'
+
     def parse_metadata(self):
         try:
             return self._parse_metadata()
@@ -74,21 +140,107 @@ class PiecePage(BaseParser):
             raise PageParseFailure("Failed to parse page at {}".format(self.url),
                                    original=e)
 
+    def extract(self):
+        """Parse the metadata and the scores in a single pass, then free the parse tree.
+
+        Only the page's content region is parsed, and its sections are collected
+        in one walk over it. Gives the same results as parse_metadata() and
+        parse_scores() for a fraction of the CPU time and memory.
+
+        Returns: a (metadata, scores) tuple.
+        """
+        results = self.extract_components(PARSER_COMPONENTS)
+        metadata = results['metadata']
+        metadata['movements'] = results['movements']
+        return metadata, results['scores']
+
+    def extract_components(self, components):
+        """Like extract(), but only parse some of the components in PARSER_VERSIONS.
+
+        Returns: {component: result} for every component asked for.
+        """
+        try:
+            return self._extract(components)
+        except RippingError:
+            raise
+        except Exception as e:
+            raise PageParseFailure("Failed to parse page at {}".format(self.url),
+                                   original=e)
+        finally:
+            self.release()
+
+    def _extract(self, components):
+        content = self._parse_content()
+        results = {}
+        try:
+            sections = self._collect_sections(content)
+            if 'metadata' in components:
+                results['metadata'] = self._metadata_from(sections['General_Information'])
+            if 'movements' in components:
+                results['movements'] = self._movements_from(sections['movements']) if 'movements' in sections else {}
+            if 'scores' in components:
+                results['scores'] = self._scores_from(sections['Music_files'])
+        finally:
+            content.decompose()
+        return results
+
+    def _parse_content(self):
+        """Parse only the mw-content-text div of the page.
+
+        The div is cut out of the raw HTML using the markup MediaWiki puts around
+        it, so the tree builder never sees the rest of the page. If the markers
+        are missing the whole page is parsed instead.
+        """
+        html = self.raw_html
+        start = html.find(self._CONTENT_START)
+        end = html.find(self._CONTENT_END, start)
+        if start != -1 and end != -1:
+            html = html[start:end]
+        return make_soup(html, self._html_parser)
+
+    @staticmethod
+    def _collect_sections(content):
+        """Walk the page's headings and content once, sorting elements into sections.
+
+        A section holds the elements following its heading up to the next h2,
+        like the walks in _parse_metadata() and _parse_scores(). The sections are
+        'General_Information', 'Music_files' and 'movements'.
+        """
+        first_heading = content.find('span', class_='mw-headline')
+        if first_heading is None:
+            raise ValueError("Page has no section headings.")
+        container = first_heading.parent.parent
+
+        sections, open_sections = {}, []
+        for child in container.children:
+            if child.name == 'h2':
+                open_sections = []
+            for section in open_sections:
+                section.append(child)
+            if child.name not in ('h2', 'h3', 'h4', 'h5', 'h6'):
+                continue
+            for span in child.find_all('span', id=True):
+                name = 'movements' if 'movement' in span['id'].lower() else span['id']
+                if name in ('General_Information', 'Music_files', 'movements') and name not in sections:
+                    sections[name] = []
+                    open_sections.append(sections[name])
+        if open_sections:
+            # The page-long walks fail the same way when a section never ends.
+            raise ValueError("A section is not closed by an h2.")
+        return sections
+
     def _parse_metadata(self):
         """Parse the metadata off the page which applies to all files on the page."""
         table_header = self.soup.find('span', id='General_Information').parent
-        table_walker = table_header.nextSibling
-        metadata_paragraphs = []
-        while table_walker.name != 'h2':
-            if table_walker.name == 'p':
-                metadata_paragraphs.append(table_walker)
-            table_walker = table_walker.nextSibling
+        metadata = self._metadata_from(self._section_after(table_header))
+        metadata['movements'] = self._parse_movement_metadata()
+        return metadata
 
+    def _metadata_from(self, section):
         metadata = {}
-        for entry in metadata_paragraphs:
-            metadata.update(self.parse_metadata_table_row(entry))
-
-        metadata['movements'] = self._parse_movement_metadata()
+        for entry in section:
+            if entry.name == 'p':
+                metadata.update(self.parse_metadata_table_row(entry))
         return metadata
 
     def _parse_movement_metadata(self):
@@ -96,19 +248,30 @@ class PiecePage(BaseParser):
         table_header = self.soup.find('span', {'id': lambda x: x and 'movement' in x.lower()})
         if not table_header:
             return {}
-        table_header = table_header.parent
-        table_walker = table_header.nextSibling
+        return self._movements_from(self._section_after(table_header.parent))
+
+    @staticmethod
+    def _movements_from(section):
         movement_metadata = {}
         mov_name, cpdl = None, None
-        while table_walker.name != 'h2':
+        for table_walker in section:
             if table_walker.name == 'p':
                 mov_name = table_walker.text.strip()
             if table_walker.name == 'ul':
                 cpdl = table_walker.find('b').text.replace('CPDL #', '').replace(':', '')
                 movement_metadata[cpdl] = mov_name
-            table_walker = table_walker.nextSibling
         return movement_metadata
 
+    @staticmethod
+    def _section_after(table_header):
+        """Return the siblings following a heading, up to the next h2."""
+        table_walker = table_header.nextSibling
+        section = []
+        while table_walker.name != 'h2':
+            section.append(table_walker)
+            table_walker = table_walker.nextSibling
+        return section
+
     def parse_scores(self):
         try:
             return self._parse_scores()
@@ -158,12 +321,9 @@ class PiecePage(BaseParser):
     def _parse_scores(self):
         """Return list of PDFs on page with metadata associated with each pdf."""
         table_header = self.soup.find('span', id='Music_files').parent
-        table_walker = table_header.nextSibling
-        score_info = []
-        while table_walker.name != 'h2':
-            score_info.append(table_walker)
-            table_walker = table_walker.nextSibling
+        return self._scores_from(self._section_after(table_header))
 
+    def _scores_from(self, score_info):
         i = 0
         scores = []
         while i < len(score_info):
@@ -186,7 +346,7 @@ class PiecePage(BaseParser):
                     continue
                 if s.name == 'ul':
                     # Get links to scores.
-                    dl_links = s.find_all('a', {'href': lambda x : x and any(x.endswith(y) for y in EXTENSIONS)})
+                    dl_links = s.find_all('a', href=has_score_extension)
                     parsed_score['dl_links'] = [a.get('href') for a in dl_links]
 
                     # Find CPDL number
@@ -202,7 +362,7 @@ class PiecePage(BaseParser):
                         meta['submitted'] = posted.text.split(' ')[-1][:-1]
                 if s.name == 'dl':
                     for dd in s.find_all('dd'):
-                        dl_links = dd.find_all('a', {'href': lambda x: x and any(x.endswith(y) for y in EXTENSIONS)})
+                        dl_links = dd.find_all('a', href=has_score_extension)
                         parsed_score['dl_links'].extend([a.get('href') for a in dl_links])
                         meta.update(self.parse_metadata_table_row(dd))
                 parsed_score['meta'] = meta
@@ -240,33 +400,70 @@ class CategoryPage(BaseParser):
     __PARSER_NAME__ = "CategoryPage"
     __TARGET_LINK_CLASS__ = None
 
+    # The "next 200" pagination link, found in the raw HTML before the page is parsed.
+    _NEXT_PAGE_LINK = re.compile(r'<a href="([^"]+)"[^>]*>next 200</a>')
+
     def get_all_in_category(self):
         """Return a list of the URL's associated with this category.
 
         target_link_class: the class of the kind of links to scrape off the page.
         """
-        all_urls = []
-        current_page = self.soup
-        counter = 1
-
-        while True:
-            category_table = self._get_first_category_div(current_page)
-            category_list = category_table.find_all('a')
-            for link in category_list:
-                page_link = link.get('href')
-                name = link.text
-                all_urls.append((name, page_link))
-
-            self._logger.info("Scraped {} pages of links from {}".format(counter, self.url))
-            counter += 1
-
-            next_page = self._get_next_page_url(current_page)
-            if not next_page:
-                break
-
-            raw_response = self._requester.get(next_page)
-            current_page = BeautifulSoup(raw_response.text, 'html5lib')
-        return all_urls
+        return [link for page_links in self.iter_category() for link in page_links]
+
+    def iter_category(self):
+        """Yield the (name, url) links of the category one "next 200" page at a time.
+
+        The next page is requested in a background thread as soon as its URL is
+        found in the raw HTML, so it downloads while the current page is parsed
+        and its links are consumed. Only one page is held at a time. The parsed
+        page has the last word: if its next page URL is another one, e.g. that
+        of the subcategory list on a page with both, the prefetch is dropped.
+        """
+        html, counter = self.raw_html, 1
+        prefetcher = ThreadPoolExecutor(max_workers=1)
+        try:
+            while html:
+                next_url = self._scan_next_page_url(html)
+                prefetch = prefetcher.submit(self._requester.get, next_url) if next_url else None
+                links, parsed_next_url = self.parse_links_page(html)
+                if parsed_next_url != next_url:
+                    if prefetch:
+                        prefetch.cancel()
+                    prefetch = prefetcher.submit(self._requester.get, parsed_next_url) if parsed_next_url else None
+
+                self._logger.info("Scraped {} pages of links from {}".format(counter, self.url))
+                counter += 1
+                yield links
+                html = prefetch.result().text if prefetch else None
+        finally:
+            # Don't block an abandoned iteration on a prefetch nobody will read.
+            prefetcher.shutdown(wait=False)
+
+    def parse_links_page(self, html):
+        """Parse one page of the category.
+
+        Returns: a ([(name, url), ...], next_page_url) tuple. next_page_url is
+            None on the last page.
+        """
+        page = make_soup(html, self._html_parser)
+        try:
+            return self._get_page_links(page), self._get_next_page_url(page)
+        finally:
+            page.decompose()
+
+    def _scan_next_page_url(self, html):
+        """Return the URL of the first "next 200" link in the raw HTML, or None if it isn't found.
+
+        Only a guess at the _get_next_page_url() of the parsed page, to start
+        downloading it early.
+        """
+        match = self._NEXT_PAGE_LINK.search(html)
+        return unescape(match.group(1)) if match else None
+
+    def _get_page_links(self, page):
+        """Return a list of (name, url) tuples for the links on one page of the category."""
+        category_table = self._get_first_category_div(page)
+        return [(link.text, link.get('href')) for link in category_table.find_all('a')]
 
     def _get_first_category_div(self, page):
         """Get the first div on the page with links.
@@ -0,0 +1,354 @@
+"""Scrape composers, pieces and scores at the same time, as a pipeline of stages.
+
+WebScraper and AsyncWebScraper go through the work queues one after the
+other: no piece is scraped before every composer is, and no score is
+downloaded before every piece is. Here the stages all run from the start:
+
+    composers --(piece links)--> pieces --(score links)--> scores
+
+Each stage has a feeder thread, which claims rows of its work queue with
+lease.Leases and puts them on a bounded queue, and its own number of worker
+threads, which take rows off that queue and do the network work: list a
+composer's pieces, download and parse a piece page, download a score. What
+they get goes on another bounded queue to the writer thread, which saves it
+with the WebScraper methods, in the only session results are written with.
+Piece links saved by a composer worker are claimed by the piece feeder on
+its next pass, and the scores of a saved piece by the score feeder, so the
+first scores download soon after the start rather than once every page of
+the site has been scraped.
+
+A full queue blocks whoever puts on it, so a feeder never gets more than a
+queue ahead of its workers and the workers wait for the writer rather than
+pile up results in memory. A feeder polls its work queue until the stage
+before it is done and a pass after that found nothing left. A stage is
+done once its workers have stopped and the writer has saved all they sent;
+the writer then sets its done event.
+
+Every row claimed is leased under one owner, and one heartbeat renews
+them all from the start of Pipeline.run() until the writer has saved the
+last result, however long rows wait in a queue.
+
+A RippingError, or the exit of commit_session() on a TERM signal, stops
+every thread and is raised again by Pipeline.run().
+"""
+import logging
+import queue
+import threading
+from contextlib import closing
+
+from sqlalchemy import false
+from sqlalchemy.orm import load_only
+
+from db import Composer, Piece, Score, DB_SESSION
+from parsers import ComposerPage, PiecePage, PageRequestFailure, PageParseFailure
+from requester import RippingError
+from scraper import WebScraper, download_score
+from globals import commit_session, DEFAULT_REQUESTER
+from retry import RetryScheduler
+from keyset import expunge_batch
+from lease import Leases
+from normalize import load_metadata
+from settings import LOG_NAME, PIPELINE_COMPOSER_WORKERS, PIPELINE_PIECE_WORKERS, PIPELINE_SCORE_WORKERS, \
+    PIPELINE_QUEUE_SIZE, PIPELINE_POLL_INTERVAL, LEASE_DURATION
+
+# Seconds between checks for a stopped pipeline while waiting on a queue.
+_WAIT = 0.5
+
+
+class Stage:
+    """A stage of the pipeline: where its work comes from and what its workers do with it."""
+
+    def __init__(self, name, model, pending, prepare, work, workers, queue_size, upstream=None):
+        """Create a Stage
+
+        Args:
+            name: the name of the stage, for threads and logs.
+            model: the model of its work queue.
+            pending: function(session) returning a query of the rows left to work on.
+            prepare: function(session, batch) returning the arguments of work
+                for each claimed row, in the feeder thread.
+            work: function(row, *args) doing the network work on a row, in a
+                worker thread, and sending the results to the writer.
+            workers: the number of worker threads.
+            queue_size: the most rows waiting for a worker.
+            upstream: the Stage whose results are this stage's work, if any.
+        """
+        self.name = name
+        self.model = model
+        self.pending = pending
+        self.prepare = prepare
+        self.work = work
+        self.workers = workers
+        self.upstream = upstream
+        self.queue = queue.Queue(queue_size)
+        self.done = threading.Event()
+
+
+class Pipeline:
+    """Runs the composer, piece and score stages at once, see the module docstring."""
+
+    def __init__(self, session_factory=DB_SESSION, requester=None, composer_workers=PIPELINE_COMPOSER_WORKERS,
+                 piece_workers=PIPELINE_PIECE_WORKERS, score_workers=PIPELINE_SCORE_WORKERS,
+                 queue_size=PIPELINE_QUEUE_SIZE, poll_interval=PIPELINE_POLL_INTERVAL, lease_duration=LEASE_DURATION,
+                 revision_api=None):
+        """Create a Pipeline
+
+        Args:
+            session_factory: makes the sessions of the writer and feeders.
+            requester: the requester to download pages and scores with.
+                Defaults to DEFAULT_REQUESTER. It is shared by every worker.
+            composer_workers: threads listing the pieces of composers.
+            piece_workers: threads downloading and parsing piece pages.
+            score_workers: threads downloading scores.
+            queue_size: the most rows waiting in a stage, and results waiting
+                for the writer. Feeders claim this many rows at a time.
+            poll_interval: seconds a feeder waits for new work from the
+                stage before it when its work queue is empty.
+            lease_duration: seconds a claim lasts without being renewed.
+            revision_api: a mwapi.MediaWikiAPI to record the wiki revision of
+                the pieces with, see WebScraper.
+        """
+        self._session_factory = session_factory
+        self._requester = requester if requester else DEFAULT_REQUESTER
+        self._session = session_factory()
+        self._leases = Leases(self._session, duration=lease_duration)
+        self._scraper = WebScraper(self._session, self._requester, leases=self._leases, revision_api=revision_api)
+        self._queue_size = queue_size
+        self._poll_interval = poll_interval
+        self._writes = queue.Queue(queue_size)
+        self._stopped = threading.Event()
+        self._error = None
+        self._logger = logging.getLogger(LOG_NAME)
+
+        composers = Stage('composers', Composer, self._pending_composers, self._prepare_rows,
+                          self._scrape_composer, composer_workers, queue_size)
+        pieces = Stage('pieces', Piece, self._pending_pieces, self._prepare_pieces,
+                       self._scrape_piece, piece_workers, queue_size, upstream=composers)
+        scores = Stage('scores', Score, self._pending_scores, self._prepare_scores,
+                       self._download_score, score_workers, queue_size, upstream=pieces)
+        self.stages = [composers, pieces, scores]
+
+    def run(self):
+        """Scrape everything left to scrape, and return once every stage is done.
+
+        Assumes the composer list was scraped with WebScraper.scrape_composer_list().
+        """
+        heartbeat = self._leases.keep_alive()
+        writer = self._start('pipeline-writer', self._write_loop)
+        stage_threads = []
+        for stage in self.stages:
+            threads = [self._start('{}-feeder'.format(stage.name), self._feed, stage)]
+            threads.extend(self._start('{}-worker-{}'.format(stage.name, i), self._work, stage)
+                           for i in range(stage.workers))
+            stage_threads.append((stage, threads))
+        try:
+            # Stages finish in order, as each waits for the one before it.
+            for stage, threads in stage_threads:
+                for thread in threads:
+                    thread.join()
+                self._write(self._finish_stage, stage)
+            self._put(self._writes, None)
+            writer.join()
+        finally:
+            # Workers still in a request are daemons and are left behind, but
+            # nothing uses the writer's session once the writer has stopped.
+            self._stopped.set()
+            writer.join()
+            heartbeat.stop()
+            self._leases.release()
+            self._session.close()
+        if self._error is not None:
+            raise self._error
+
+    def _start(self, name, target, *args):
+        """Start a thread running target(*args). Whatever it raises stops the pipeline."""
+        def run():
+            try:
+                target(*args)
+            except BaseException as e:
+                if not isinstance(e, (SystemExit, RippingError)):
+                    self._logger.exception("Pipeline thread {} failed.".format(name))
+                if self._error is None:
+                    self._error = e
+                self._stopped.set()
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        thread.start()
+        return thread
+
+    def _put(self, q, item):
+        """Put item on q, waiting while it is full. Returns False if the pipeline stopped first."""
+        while not self._stopped.is_set():
+            try:
+                q.put(item, timeout=_WAIT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        """Take an item off q, waiting while it is empty. Returns None if the pipeline stopped first."""
+        while not self._stopped.is_set():
+            try:
+                return q.get(timeout=_WAIT)
+            except queue.Empty:
+                pass
+        return None
+
+    def _write(self, func, *args):
+        """Have the writer thread call func(*args)."""
+        return self._put(self._writes, (func, args))
+
+    def _feed(self, stage):
+        """Claim the work of stage and queue it for its workers until there is none left."""
+        # Claimed rows stay loaded through the commits of stage.prepare(), for the workers.
+        session = self._session_factory(expire_on_commit=False)
+        leases = Leases(session, self._leases.owner, self._leases.duration)
+        try:
+            while not self._stopped.is_set():
+                upstream_done = stage.upstream is None or stage.upstream.done.is_set()
+                claimed = self._feed_pass(stage, session, leases)
+                if claimed is None:
+                    return
+                if not claimed:
+                    if upstream_done:
+                        break
+                    stage.upstream.done.wait(self._poll_interval)
+        finally:
+            session.close()
+        for _ in range(stage.workers):
+            self._put(stage.queue, None)
+
+    def _feed_pass(self, stage, session, leases):
+        """Claim and queue the rows of stage's work queue once. Returns the number queued, or None if stopped."""
+        # run() keeps the leases renewed and releases them.
+        claims = leases.iter_claims(stage.pending(session), stage.model, self._queue_size,
+                                    expunge=False, release=False, renew=False)
+        queued = 0
+        with closing(claims):
+            for batch in claims:
+                items = stage.prepare(session, batch)
+                # Rows go to other threads, so they must leave the feeder's session first.
+                expunge_batch(session, batch)
+                for item in items:
+                    if not self._put(stage.queue, item):
+                        return None
+                queued += len(items)
+        return queued
+
+    def _work(self, stage):
+        """Work on rows of stage until its feeder is done."""
+        while True:
+            item = self._get(stage.queue)
+            if item is None:
+                return
+            row = item[0]
+            try:
+                stage.work(*item)
+            except RippingError:
+                raise
+            except Exception as e:
+                self._logger.warning("Pipeline stage {} failed on {}".format(stage.name, row.url))
+                self._write(self._save_failure, row, e)
+
+    def _write_loop(self):
+        """Save the results sent by the workers, in the order they were sent."""
+        try:
+            while True:
+                write = self._get(self._writes)
+                if write is None:
+                    return
+                func, args = write
+                try:
+                    func(*args)
+                except RippingError:
+                    raise
+                except Exception as e:
+                    # The row stays leased until the end of the run, and is picked up by the next one.
+                    self._logger.warning("Failed to save results with {}: {}".format(func.__name__, e))
+                    self._session.rollback()
+        finally:
+            # Give back the connection, which SQLite only lets this thread use.
+            self._session.close()
+
+    def _finish_stage(self, stage):
+        self._logger.info("Pipeline stage {} is done.".format(stage.name))
+        stage.done.set()
+
+    @staticmethod
+    def _pending_composers(session):
+        return RetryScheduler.eligible(session.query(Composer), Composer)\
+            .filter(Composer.all_scraped == false())\
+            .options(load_only(Composer.id, Composer.name, Composer.url))
+
+    @staticmethod
+    def _pending_pieces(session):
+        return RetryScheduler.eligible(session.query(Piece), Piece)\
+            .filter(Piece.scraped == false())\
+            .options(load_only(Piece.id, Piece.name, Piece.url, Piece.composer_id))
+
+    @staticmethod
+    def _pending_scores(session):
+        return RetryScheduler.eligible(session.query(Score), Score)\
+            .filter(Score.downloaded == false())\
+            .options(load_only(Score.id, Score.url, Score.piece_id))
+
+    @staticmethod
+    def _prepare_rows(session, batch):
+        return [(row,) for row in batch]
+
+    def _prepare_pieces(self, session, batch):
+        """Pair each piece with the wiki revision of its page, looked up for the whole batch before it is downloaded."""
+        revisions = self._scraper._fetch_revisions(piece.url for piece in batch)
+        return [(piece, revisions.get(piece.url)) for piece in batch]
+
+    @staticmethod
+    def _prepare_scores(session, batch):
+        """Pair each score with the metadata of its piece, loaded for the whole batch at once."""
+        metadata = load_metadata(session, {score.piece_id for score in batch})
+        # Saves the pieces load_metadata() normalized, so the feeder doesn't hold a write lock while queueing.
+        session.commit()
+        return [(score, metadata.get(score.piece_id, {})) for score in batch]
+
+    # Workers. Rows are detached from any session, and only read, except for
+    # the download statistics download_score() sets on scores.
+
+    def _scrape_composer(self, composer):
+        """Save the piece links of a composer a page at a time, so the piece stage can start on them."""
+        piece_count = 0
+        for page_links in ComposerPage(composer.url, requester=self._requester).iter_category():
+            self._write(self._scraper._add_composer_pieces, composer, page_links)
+            piece_count += len(page_links)
+        self._write(self._finish_composer, composer, piece_count)
+
+    def _scrape_piece(self, piece, revision):
+        try:
+            piece_page = PiecePage(piece.url, requester=self._requester)
+            metadata, scores = piece_page.extract()
+        except (PageRequestFailure, PageParseFailure) as e:
+            self._write(self._save_piece_failure, piece, e)
+            return
+        self._write(self._save_piece, piece, piece_page, scores, metadata, revision)
+
+    def _download_score(self, score, metadata):
+        file_path = download_score(score, metadata, self._requester)
+        self._write(self._save_download, score, metadata, file_path)
+
+    # Writes, run by the writer thread. merge() loads each row into the
+    # writer's session, with whatever the workers set on it.
+
+    def _finish_composer(self, composer, piece_count):
+        self._scraper._finish_composer(self._session.merge(composer), piece_count)
+
+    def _save_piece(self, piece, piece_page, scores, metadata, revision):
+        self._scraper._save_piece(self._session.merge(piece), piece_page, scores, metadata, revision)
+
+    def _save_piece_failure(self, piece, e):
+        self._scraper._save_piece_failure(self._session.merge(piece), e)
+
+    def _save_download(self, score, metadata, file_path):
+        self._scraper._save_download(self._session.merge(score), metadata, file_path)
+        commit_session(self._session)
+
+    def _save_failure(self, row, e):
+        self._scraper._save_failure(self._session.merge(row), e)
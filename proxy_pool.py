@@ -0,0 +1,124 @@
+from collections import deque
+import threading
+import time
+
+from settings import PROXY_MAX_FAILURES, PROXY_COOLDOWN, PROXY_MAX_COOLDOWN, PROXY_LATENCY_WINDOW
+
+
+class ProxyHealth:
+    """Request history of a single proxy."""
+
+    def __init__(self, proxy, window):
+        self.proxy = proxy
+        self.latencies = deque(maxlen=window)  # Seconds to response headers of recent successes.
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.consecutive_failures = 0
+        self.strikes = 0  # Times quarantined since the proxy last proved healthy.
+        self.quarantined_until = 0
+
+    def percentile(self, pct):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+    def error_rate(self):
+        return (self.errors + self.timeouts) / self.requests if self.requests else 0.0
+
+
+class ProxyPool:
+    """Tracks the health of every proxy and steers requests toward healthy ones.
+
+    Records latency percentiles, errors and timeouts per proxy. Proxies are
+    weighted by speed and success rate when several are free at once. After
+    max_failures consecutive failures a proxy is quarantined, for cooldown
+    seconds the first time and twice as long on each further strike, up to
+    max_cooldown. When its cool-down is over its next request is a probe: a
+    success re-admits it and clears its strikes, a failure quarantines it again.
+
+    A None proxy stands for a direct connection and is never quarantined.
+    """
+
+    def __init__(self, proxy_list, max_failures=PROXY_MAX_FAILURES, cooldown=PROXY_COOLDOWN,
+                 max_cooldown=PROXY_MAX_COOLDOWN, window=PROXY_LATENCY_WINDOW):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self._health = {p: ProxyHealth(p, window) for p in proxy_list}
+        self._lock = threading.Lock()
+
+    def available(self):
+        """Return a (proxies, wait_time) tuple.
+
+        proxies are the proxies that may take a request now. If every proxy is
+        quarantined, they are the ones whose cool-down ends first and wait_time
+        is the seconds left until then.
+        """
+        now = time.time()
+        with self._lock:
+            ready = [h.proxy for h in self._health.values() if h.quarantined_until <= now]
+            if ready:
+                return ready, 0
+            soonest = min(h.quarantined_until for h in self._health.values())
+            return [h.proxy for h in self._health.values() if h.quarantined_until == soonest], soonest - now
+
+    def weight(self, proxy):
+        """Selection weight of a proxy. Faster and more reliable proxies weigh more."""
+        health = self._health[proxy]
+        median = health.percentile(50)
+        speed = 1.0 / max(median, 0.05) if median is not None else 1.0
+        return speed * (1.0 - health.error_rate()) + 1e-3
+
+    def record_success(self, proxy, latency):
+        with self._lock:
+            health = self._health[proxy]
+            health.requests += 1
+            health.latencies.append(latency)
+            health.consecutive_failures = 0
+            health.strikes = 0
+
+    def record_failure(self, proxy, timeout=False):
+        with self._lock:
+            health = self._health[proxy]
+            health.requests += 1
+            if timeout:
+                health.timeouts += 1
+            else:
+                health.errors += 1
+            health.consecutive_failures += 1
+            # A proxy on probation goes straight back to quarantine.
+            if proxy is not None and (health.strikes or health.consecutive_failures >= self.max_failures):
+                cooldown = min(self.cooldown * 2 ** health.strikes, self.max_cooldown)
+                health.quarantined_until = time.time() + cooldown
+                health.strikes += 1
+                health.consecutive_failures = 0
+
+    def stats(self):
+        """Return a list of per-proxy stat dicts, healthiest first."""
+        now = time.time()
+        with self._lock:
+            rows = [{'proxy': h.proxy or 'direct',
+                     'requests': h.requests,
+                     'errors': h.errors,
+                     'timeouts': h.timeouts,
+                     'error_rate': round(h.error_rate(), 3),
+                     'p50': h.percentile(50),
+                     'p95': h.percentile(95),
+                     'quarantined_for': max(0, round(h.quarantined_until - now)),
+                     'strikes': h.strikes}
+                    for h in self._health.values()]
+        return sorted(rows, key=lambda r: (r['quarantined_for'], r['error_rate'], r['p50'] or 0))
+
+    def format_stats(self):
+        """Return stats() as a printable table."""
+        lines = ['{:<32} {:>8} {:>6} {:>8} {:>7} {:>7} {:>11}'.format(
+            'proxy', 'requests', 'errors', 'timeouts', 'p50', 'p95', 'quarantine')]
+        for row in self.stats():
+            lines.append('{:<32} {:>8} {:>6} {:>8} {:>7} {:>7} {:>10}s'.format(
+                row['proxy'], row['requests'], row['errors'], row['timeouts'],
+                '-' if row['p50'] is None else '{:.2f}'.format(row['p50']),
+                '-' if row['p95'] is None else '{:.2f}'.format(row['p95']),
+                row['quarantined_for']))
+        return '\n'.join(lines)
@@ -1,20 +1,194 @@
-from collections import deque
-from random import shuffle, randint
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from random import random, randint, choices
+from urllib.parse import urlparse
+import asyncio
+import threading
 import time
 import requests
-from settings import CW_DOMAIN
+from requests.adapters import HTTPAdapter
+from proxy_pool import ProxyPool
+from settings import CW_DOMAIN, MAX_CONCURRENCY, SESSION_POOL_SIZE, SESSION_IDLE_TIMEOUT, REQUEST_TIMEOUT, \
+    THROTTLE_MAX_RETRIES
 
 
 class RippingError(Exception):
     pass
 
 
+class FuzzedRateLimiter:
+    """Paces requests with a fuzzed token bucket for every (proxy, host) pair.
+
+    Each bucket holds a single token. Once spent, the token refills after a
+    random number of seconds drawn from fuzz_range, or from the throttle if
+    one is given. A request goes through whichever proxy's bucket for the
+    target host refills first, so throughput grows with the number of proxies
+    while each proxy keeps its fuzzed pacing.
+    """
+
+    def __init__(self, fuzz_range, throttle=None):
+        """Create a FuzzedRateLimiter
+
+        Args:
+            fuzz_range: an upper and lower bound for fuzzing. ex: (5, 10)
+            throttle: optional throttle.AdaptiveThrottle deciding the gaps instead.
+        """
+        self.fuzz_range = tuple(fuzz_range)
+        self.throttle = throttle
+        self._next_free = {}  # (proxy, host) -> time.time() when the token refills.
+        self._lock = threading.Lock()
+
+    def reserve(self, host, proxies, weight=None, not_before=0):
+        """Spend the token of the proxy that is free first for host.
+
+        Args:
+            host: the netloc the request is going to.
+            proxies: candidate proxies. None stands for a direct connection.
+            weight: optional function giving each proxy's selection weight.
+                Used to choose between proxies that are free at the same time.
+            not_before: time.time() before which no request may start.
+
+        Returns: a (proxy, wait_time) tuple. The caller must sleep wait_time
+            seconds before making its request through proxy.
+        """
+        now = time.time()
+        if self.throttle is not None:
+            not_before = max(not_before, self.throttle.not_before(host))
+        with self._lock:
+            starts = {p: max(self._next_free.get((p, host), 0), now, not_before) for p in proxies}
+            earliest = min(starts.values())
+            free = [p for p in proxies if starts[p] == earliest]
+            if weight is None or len(free) == 1:
+                proxy = free[int(random() * len(free))]
+            else:
+                proxy = choices(free, weights=[weight(p) for p in free])[0]
+            self._next_free[(proxy, host)] = earliest + self._gap(host)
+        return proxy, earliest - now
+
+    def _gap(self, host):
+        if self.throttle is not None:
+            return self.throttle.gap(host)
+        return randint(*self.fuzz_range)
+
+
+def _release_on_close(resp, release):
+    """Call release() once a streamed response is closed, e.g. by a with block."""
+    close = resp.close
+
+    def close_and_release():
+        resp.close = close
+        try:
+            close()
+        finally:
+            release()
+    resp.close = close_and_release
+
+
+class SessionPool:
+    """Keeps a pooled keep-alive requests.Session for every (proxy, host) pair.
+
+    Reusing sessions means consecutive requests through the same proxy to the
+    same host skip the TCP and TLS handshakes. A session is leased with
+    acquire() for each request and given back with release() once its
+    response is read, which for a streamed download can be long after. Sessions
+    that sit unused for longer than idle_timeout seconds are closed, but never
+    while a lease is out.
+    """
+
+    def __init__(self, pool_size=SESSION_POOL_SIZE, idle_timeout=SESSION_IDLE_TIMEOUT):
+        """Create a SessionPool
+
+        Args:
+            pool_size: the most connections each session keeps open.
+            idle_timeout: seconds a session may go unused before it is closed.
+        """
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._sessions = {}  # (proxy, host) -> [session, time.time() of last use, leases out]
+        self._closed_counts = {'requests': 0, 'connections': 0}
+        self._lock = threading.Lock()
+
+    def acquire(self, proxy, host):
+        """Lease the session for the pair, creating it if needed. Call release() once done with it."""
+        now = time.time()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._sessions.get((proxy, host))
+            if entry is None:
+                entry = [self._new_session(), now, 0]
+                self._sessions[(proxy, host)] = entry
+            entry[1] = now
+            entry[2] += 1
+            return entry[0]
+
+    def release(self, proxy, host):
+        """Give back a lease of acquire(). The session counts as idle from now on, if no other lease is out."""
+        with self._lock:
+            entry = self._sessions.get((proxy, host))
+            if entry is not None:
+                entry[1] = time.time()
+                entry[2] -= 1
+
+    def connection_stats(self):
+        """Return how many requests were made and how many connections they opened.
+
+        Every request beyond the first on a connection reused it and skipped a handshake.
+        ex: {'requests': 120, 'connections': 4, 'reused': 116, 'sessions': 2}
+        """
+        with self._lock:
+            stats = dict(self._closed_counts)
+            for session, _, _ in self._sessions.values():
+                for key, count in self._count_session(session).items():
+                    stats[key] += count
+            stats['sessions'] = len(self._sessions)
+        stats['reused'] = stats['requests'] - stats['connections']
+        return stats
+
+    def close(self):
+        """Close every session and its open connections."""
+        with self._lock:
+            for key in list(self._sessions):
+                self._close_session(key)
+
+    def _new_session(self):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _evict_idle(self, now):
+        for key, (_, last_used, leases) in list(self._sessions.items()):
+            if not leases and now - last_used > self.idle_timeout:
+                self._close_session(key)
+
+    def _close_session(self, key):
+        session, _, _ = self._sessions.pop(key)
+        for name, count in self._count_session(session).items():
+            self._closed_counts[name] += count
+        session.close()
+
+    @staticmethod
+    def _count_session(session):
+        """Sum the urllib3 request and connection counters of a session's pools."""
+        counts = {'requests': 0, 'connections': 0}
+        for adapter in set(session.adapters.values()):
+            managers = [adapter.poolmanager] + list(adapter.proxy_manager.values())
+            for manager in managers:
+                for pool_key in manager.pools.keys():
+                    pool = manager.pools.get(pool_key)
+                    if pool is not None:
+                        counts['requests'] += pool.num_requests
+                        counts['connections'] += pool.num_connections
+        return counts
+
+
 class ProxiedFuzzedRequester:
     """Makes requests using a list of proxies and fuzzing."""
 
     __RIPPING_TEXT__ = """You have reached this message because the site ripping ban script has been triggered. Site ripping is forbidden; repeated offenders will be banned indefinitely."""
 
-    def __init__(self, proxy_list=None, fuzz_range=None):
+    def __init__(self, proxy_list=None, fuzz_range=None, domain=CW_DOMAIN, cache=None, throttle=None):
         """Create a ProxiedFuzzedRequester
 
         Args:
@@ -22,58 +196,193 @@ class ProxiedFuzzedRequester:
                 ex: ['http://178.151.193.9:8080', 'http://178.151.193.9:8080']
             fuzz_range: an upper and lower bound for fuzzing
                 ex: [2, 15], (5, 10)
+            domain: the domain relative URLs are resolved against.
+                ex: 'http://localhost:8000' to scrape a local stub server.
+            cache: a cache.ResponseCache to answer plain page requests from.
+            throttle: a throttle.AdaptiveThrottle to adapt the fuzzing to how
+                the server is coping. fuzz_range only sets its starting rate.
         """
         self.fuzz_range = (3, 15) if fuzz_range is None else tuple(fuzz_range)
-        self._proxy_list = [] if proxy_list is None else proxy_list
-        self._ordered_proxies = deque(proxy_list)
-        shuffle(self._ordered_proxies)
+        self._proxy_list = [] if proxy_list is None else list(proxy_list)
+        self.proxy_pool = ProxyPool(self._proxy_list or [None])
+        self._domain = domain
+        self._cache = cache
+        self.throttle = throttle
+        self._limiter = FuzzedRateLimiter(self.fuzz_range, throttle)
+        self._sessions = SessionPool()
 
-        self._last_get = 0  # time.time() of last GET request.
-        self._next_get = 0  # only time.time() greater than this can make next request.
+    def get(self, url, use_cache=True, **kwargs):
+        """Make a request using the first free proxy and respecting the fuzzing time.
 
-    def get(self, url, **kwargs):
-        """Make a request using the next proxy and respecting the fuzzing time.
-
-        Assumes relative URLS are relative to http://imslp.org
+        Assumes relative URLS are relative to the requester's domain. Pass
+        use_cache=False for answers that must be fresh, e.g. API queries.
         """
+        url = self._absolute_url(url)
+        cached, entry, kwargs = self._check_cache(url, kwargs, use_cache)
+        if cached is not None:
+            return cached
+
+        for attempt in range(THROTTLE_MAX_RETRIES + 1):
+            # Wait until some proxy is allowed to make another request to this host.
+            proxy, wait_time = self._reserve(url)
+            if wait_time > 0:
+                time.sleep(wait_time)
 
-        # Wait until we are allowed to make another request, if needed.
-        wait_time = self._next_get - time.time()
-        if wait_time > 0:
-            time.sleep(wait_time)
+            resp = self._fetch(url, proxy, **kwargs)
+            if not self._should_retry(resp, attempt):
+                break
+        return self._update_cache(url, entry, resp, kwargs, use_cache)
 
-        # If url is relative, assume it.
+    def _absolute_url(self, url):
+        """If url is relative, assume it."""
         if url.startswith("/"):
-            url = CW_DOMAIN + url
+            return self._domain + url
+        return url
 
-        # Get another proxy
-        proxy = self._get_next_proxy()
+    def _uses_cache(self, kwargs, use_cache=True):
+        """Only plain page requests are cached; streamed downloads and custom headers are not."""
+        return use_cache and self._cache is not None and not kwargs.get('stream') and not kwargs.get('headers')
 
-        # get the stuff using requests
-        resp = requests.get(url, proxies=proxy, **kwargs)
-        self._check_anti_ripping(resp)
+    def _check_cache(self, url, kwargs, use_cache=True):
+        """Return a (cached_response, entry, kwargs) tuple. See ResponseCache.before_request()."""
+        if not self._uses_cache(kwargs, use_cache):
+            return None, None, kwargs
+        headers = {}
+        cached, entry = self._cache.before_request(url, headers)
+        if headers:
+            kwargs = dict(kwargs, headers=headers)
+        return cached, entry, kwargs
+
+    def _update_cache(self, url, entry, resp, kwargs, use_cache=True):
+        """Return the response to use for a request checked with _check_cache()."""
+        if entry is None and not self._uses_cache(kwargs, use_cache):
+            return resp
+        return self._cache.after_request(url, entry, resp)
 
-        # set the fuzzing
-        self._set_next_get()
+    def _should_retry(self, resp, attempt):
+        """Whether to try again after the server asked us to slow down.
+
+        The throttle has already pushed the next attempt back by then.
+        """
+        if self.throttle is None or attempt >= THROTTLE_MAX_RETRIES or resp.status_code not in (429, 503):
+            return False
+        resp.close()
+        return True
+
+    def _reserve(self, url):
+        """Reserve the next request slot for url. See FuzzedRateLimiter.reserve()."""
+        host = urlparse(url).netloc
+        proxies, wait_time = self.proxy_pool.available()
+        return self._limiter.reserve(host, proxies, self.proxy_pool.weight, time.time() + wait_time)
+
+    def _fetch(self, url, proxy, **kwargs):
+        """GET url through proxy right away and check the result for a ripping ban.
+
+        The outcome is recorded in the proxy pool. Server errors and failures to
+        connect count against the proxy. The pooled session is held until the
+        response is read, or closed if it is streamed.
+        """
+        host = urlparse(url).netloc
+        session = self._sessions.acquire(proxy, host)
+        try:
+            resp = self._send(session, url, proxy, host, **kwargs)
+        except BaseException:
+            self._sessions.release(proxy, host)
+            raise
+        if kwargs.get('stream'):
+            _release_on_close(resp, lambda: self._sessions.release(proxy, host))
+        else:
+            self._sessions.release(proxy, host)
         return resp
 
-    def _set_next_get(self):
-        """Set last_get to now and next_get to now + random fuzz time."""
-        self._last_get = time.time()
-        self._next_get = self._last_get + randint(*self.fuzz_range)
+    def _send(self, session, url, proxy, host, **kwargs):
+        """Does the work of _fetch() with a leased session."""
+        proxies = {'http': proxy} if proxy else {}
+        kwargs.setdefault('timeout', REQUEST_TIMEOUT)
+        start = time.time()
+        try:
+            resp = session.get(url, proxies=proxies, **kwargs)
+        except requests.Timeout:
+            self.proxy_pool.record_failure(proxy, timeout=True)
+            if self.throttle is not None:
+                self.throttle.push_back(host)
+            raise
+        except requests.ConnectionError:
+            self.proxy_pool.record_failure(proxy)
+            raise
+        latency = time.time() - start
+        if resp.status_code >= 500 or resp.status_code == 407:
+            self.proxy_pool.record_failure(proxy)
+        else:
+            self.proxy_pool.record_success(proxy, latency)
+        if self.throttle is not None:
+            if self._is_ripping_page(resp):
+                # However healthy its status, the ban page is the strongest pushback there is.
+                self.throttle.back_off(host)
+            else:
+                self.throttle.record(host, resp.status_code, latency, resp.headers.get('Retry-After'))
+        self._check_anti_ripping(resp)
+        return resp
+
+    def connection_stats(self):
+        """See SessionPool.connection_stats()."""
+        return self._sessions.connection_stats()
 
-    def _get_next_proxy(self):
-        """Get the next proxy. Refill and shuffle the deque if needed."""
-        if not self._proxy_list:
-            return {}
-        if not self._ordered_proxies:
-            self._ordered_proxies = deque(self._proxy_list)
-            shuffle(self._ordered_proxies)
-        return {'http': self._ordered_proxies.pop()}
+    def close(self):
+        """Close all pooled connections."""
+        self._sessions.close()
+
+    def _is_ripping_page(self, resp):
+        content_type = resp.headers.get("Content-Type", "")
+        return 'text/html' in content_type and self.__RIPPING_TEXT__ in resp.text
 
     def _check_anti_ripping(self, resp):
-        content_type = resp.headers.get("Content-Type")
-        if 'text/html' in content_type and self.__RIPPING_TEXT__ in resp.text:
+        if self._is_ripping_page(resp):
             with open('ripping_page.html', 'wb') as f:
                 f.write(resp.content)
             raise RippingError("Ripping detected. Exiting.")
+
+
+class AsyncRequester:
+    """Asyncio front-end to a ProxiedFuzzedRequester.
+
+    Request slots are reserved through the wrapped requester's rate limiter and
+    waited for on the event loop. The blocking GET itself runs in a thread pool,
+    so proxy rotation, fuzzing and the anti-ripping check behave exactly as
+    they do for the blocking requester.
+    """
+
+    def __init__(self, requester, max_concurrency=MAX_CONCURRENCY):
+        """Create an AsyncRequester
+
+        Args:
+            requester: the ProxiedFuzzedRequester to make requests with.
+            max_concurrency: the most blocking calls allowed to run at once.
+        """
+        self.requester = requester
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency)
+
+    async def get(self, url, use_cache=True, **kwargs):
+        """Make a request without blocking the event loop. See ProxiedFuzzedRequester.get()."""
+        url = self.requester._absolute_url(url)
+        cached, entry, kwargs = await self.run_blocking(self.requester._check_cache, url, kwargs, use_cache)
+        if cached is not None:
+            return cached
+
+        for attempt in range(THROTTLE_MAX_RETRIES + 1):
+            proxy, wait_time = self.requester._reserve(url)
+            if wait_time > 0:
+                await asyncio.sleep(wait_time)
+            resp = await self.run_blocking(self.requester._fetch, url, proxy, **kwargs)
+            if not self.requester._should_retry(resp, attempt):
+                break
+        return await self.run_blocking(self.requester._update_cache, url, entry, resp, kwargs, use_cache)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) in the thread pool and return its result."""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    def close(self):
+        """Shut down the thread pool once running calls have finished."""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,56 @@
+from random import uniform
+import time
+
+from sqlalchemy import or_, false
+
+from db import DeadLetter
+from settings import RETRY_BUDGET, RETRY_BASE_DELAY, RETRY_MAX_DELAY
+
+
+class RetryScheduler:
+    """Schedules retries of failed composers, pieces and scores in the database.
+
+    Every failure bumps the row's attempts, stores the error and pushes its
+    next_attempt_at back exponentially: base_delay seconds after the first
+    failure, doubling each time up to max_delay. Once a row has failed budget
+    times, or right away if the failure is permanent, it is copied to the
+    dead_letters table and flagged failed_scrape, so the scrape loops stop
+    selecting it.
+    """
+
+    def __init__(self, session, budget=RETRY_BUDGET, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self._session = session
+        self.budget = budget
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @staticmethod
+    def eligible(query, model):
+        """Filter query down to rows of model that are due to be worked on."""
+        return query\
+            .filter(model.failed_scrape == false())\
+            .filter(or_(model.next_attempt_at == None, model.next_attempt_at <= time.time()))
+
+    def record_failure(self, row, error, permanent=False):
+        """Schedule row for another attempt, or dead-letter it if it is out of retries.
+
+        Pass permanent=True for errors no retry can get past, to dead-letter
+        the row now. Does not commit the session.
+        """
+        row.attempts = (row.attempts or 0) + 1
+        row.last_error = str(error)[:1000]
+        if permanent or row.attempts >= self.budget:
+            row.failed_scrape = True
+            row.next_attempt_at = None
+            self._session.add(DeadLetter(table_name=row.__tablename__, row_id=row.id, url=row.url,
+                                         attempts=row.attempts, last_error=row.last_error,
+                                         created=time.time()))
+            return
+        delay = min(self.base_delay * 2 ** (row.attempts - 1), self.max_delay)
+        row.next_attempt_at = time.time() + uniform(0.9, 1.1) * delay
+
+    @staticmethod
+    def record_success(row):
+        """Clear the retry state of a row that was worked on successfully."""
+        row.last_error = None
+        row.next_attempt_at = None
@@ -2,13 +2,36 @@ import logging
 import json
 import urllib
 import os
+import time
+import requests
 from unidecode import unidecode
+from sqlalchemy import false
+from sqlalchemy.orm import load_only
 
-from parsers import ComposerPage, ComposerListPage, PiecePage, PageRequestFailure, PageParseFailure
+from parsers import ComposerPage, ComposerListPage, PiecePage, PageRequestFailure, PageParseFailure, \
+    EXTENSION_SUFFIXES, parser_version_stamp, html_hash
 from db import Composer, Piece, Score
-from settings import COMPOSER_LIST_URL, LOG_NAME, DOWNLOAD_PATH, EXTENSIONS
+from requester import RippingError
+from settings import COMPOSER_LIST_URL, LOG_NAME, DOWNLOAD_PATH, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_MAX_RESUMES
 from globals import commit_session, DEFAULT_REQUESTER
+from retry import RetryScheduler
+from mwapi import url_to_title
+from sync import set_sync_state, COMPOSER_LIST_SCRAPED
+from url_index import UrlIndex
+from bulk import insert_ignore
+from lease import Leases
+from normalize import save_metadata, load_metadata
 
+# Client errors worth another try later: the server timed out or asked us to slow down.
+_RETRIABLE_CLIENT_ERRORS = (408, 429)
+
+
+class DownloadRejected(Exception):
+    """A score that will never download: its link is not a score file, or the server refused it.
+
+    WebScraper._save_failure() dead-letters the score right away rather than
+    retrying it.
+    """
 
 def get_dl_path(metadata):
     """Computes and creates the path for a file to be downloaded."""
@@ -21,45 +44,154 @@ def get_dl_path(metadata):
     composer = composer.replace('/', '-')
     composer = composer.replace(' ', '_')
 
-    download_dir = os.path.join(DOWNLOAD_PATH, composer)
+    # Scores of the same piece may be downloaded by several threads at once.
+    download_dir = os.path.join(DOWNLOAD_PATH, composer, piece)
+    os.makedirs(download_dir, exist_ok=True)
+    return download_dir
 
-    if not os.path.exists(download_dir):
-        os.mkdir(download_dir)
 
-    download_dir = os.path.join(download_dir, piece)
-    if not os.path.exists(download_dir):
-        os.mkdir(download_dir)
+def download_score(score, metadata, requester=DEFAULT_REQUESTER):
+    """Stream a score into the directory given by get_dl_path().
 
+    The file is written in DOWNLOAD_CHUNK_SIZE chunks to a '.part' file which is
+    renamed to the final name once complete. A transfer interrupted by a dropped
+    connection, a timeout or a server error, or a '.part' file left over from an
+    earlier run, is resumed with a Range request, up to DOWNLOAD_MAX_RESUMES
+    times. Client errors (4xx) fail right away. Sets download_rate (bytes/sec)
+    and resume_count on the score.
+
+    Returns: the download directory, or False if the score was not downloaded.
+    Raises: DownloadRejected if it never will be, see download_file().
+    """
+    download_dir, download_rate, resume_count = download_file(score.url, metadata, requester)
+    if download_rate is not None:
+        score.download_rate = download_rate
+    score.resume_count = resume_count
     return download_dir
 
 
-def download_score(score, metadata):
+def download_file(link, metadata, requester=DEFAULT_REQUESTER):
+    """Does the work of download_score() on plain values, so it can run in any thread.
+
+    Returns: a (download directory or False, download_rate, resume_count)
+        tuple. download_rate is None if the file was not downloaded.
+    Raises: DownloadRejected if link is not a score file, or the server
+        answered a client error other than a timeout or a 429.
+    """
+    if not link.endswith(EXTENSION_SUFFIXES):
+        raise DownloadRejected("Not a score file: {}".format(link))
     download_dir = get_dl_path(metadata)
-    file_paths = []
-    link = score.url
-    if not any(link.endswith(x) for x in EXTENSIONS):
-        return False
     filename = link.split('/')[-1]
-    try:
-        data = DEFAULT_REQUESTER.get(link)
-    except Exception:
+    file_path = os.path.join(download_dir, filename)
+    part_path = file_path + '.part'
+
+    resumes, transferred, error = 0, 0, None
+    start = time.time()
+    for attempt in range(DOWNLOAD_MAX_RESUMES + 1):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset:
+            resumes += 1
+        try:
+            transferred += _stream_to_part(requester, link, part_path, offset)
+            error = None
+            break
+        except RippingError:
+            raise
+        except Exception as e:
+            error = e
+            if not _is_transient(e):
+                break
+    if error is not None:
+        if _is_rejection(error):
+            raise DownloadRejected("Failed to download score at {}: {}".format(link, error))
         logger = logging.getLogger(LOG_NAME)
-        logger.warning("Failed to download score at {}".format(link))
+        logger.warning("Failed to download score at {}: {}".format(link, error))
+        return False, None, resumes
+
+    os.replace(part_path, file_path)
+    return download_dir, transferred / max(time.time() - start, 1e-6), resumes
+
+
+def _stream_to_part(requester, link, part_path, offset):
+    """Stream link into part_path, starting at byte offset. Returns the bytes written.
+
+    Raises an IOError if the transfer ends before the whole file arrived.
+    """
+    headers = {'Range': 'bytes={}-'.format(offset)} if offset else {}
+    resp = requester.get(link, stream=True, headers=headers)
+    try:
+        if offset and resp.status_code == 416:
+            if _content_range_total(resp.headers.get('Content-Range')) == offset:
+                # The part file already holds the whole file.
+                return 0
+            # The part file is not a start of the file on the server, so start over.
+            os.remove(part_path)
+            raise IOError("Part file of {} does not match the file on the server".format(link))
+        resp.raise_for_status()
+        # Servers that ignore the Range header send the whole file again.
+        mode = 'ab' if resp.status_code == 206 else 'wb'
+        written = 0
+        with open(part_path, mode) as f:
+            for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                written += len(chunk)
+        expected = resp.headers.get('Content-Length')
+        if expected is not None and written < int(expected):
+            raise IOError("Got {} of {} bytes from {}".format(written, expected, link))
+        return written
+    finally:
+        resp.close()
+
+
+def _is_transient(error):
+    """Whether a failed transfer is worth resuming: a dropped connection, a timeout, a short read or a 5xx."""
+    if isinstance(error, requests.HTTPError):
+        return error.response is None or error.response.status_code >= 500
+    # requests' ConnectionError, Timeout and ChunkedEncodingError are IOErrors too.
+    return isinstance(error, IOError)
+
+
+def _is_rejection(error):
+    """Whether a failed transfer will fail again however often it is retried: a client error."""
+    if not isinstance(error, requests.HTTPError) or error.response is None:
         return False
+    status = error.response.status_code
+    return 400 <= status < 500 and status not in _RETRIABLE_CLIENT_ERRORS
 
-    file_path = os.path.join(download_dir, filename)
-    with open(file_path, 'wb') as f:
-        f.write(data.content)
-    file_paths.append(os.path.relpath(file_path, DOWNLOAD_PATH))
 
-    return download_dir
+def _content_range_total(content_range):
+    """Return the total size in a Content-Range header, e.g. 'bytes */1234', or None if unknown."""
+    total = (content_range or '').rpartition('/')[2].strip()
+    return int(total) if total.isdigit() else None
 
 
 class WebScraper:
 
-    def __init__(self, db_session):
-        """Connect to SQL DB"""
+    def __init__(self, db_session, requester=None, api=None, leases=None, revision_api=None):
+        """Connect to SQL DB
+
+        Args:
+            db_session: the SQLAlchemy session to save results with.
+            requester: the requester to download pages and scores with.
+                Defaults to DEFAULT_REQUESTER.
+            api: a mwapi.MediaWikiAPI. If given, composers and pieces are scraped
+                through the API in batches instead of page by page.
+            leases: the lease.Leases to claim work with, so other workers
+                sharing the database don't scrape the same rows. Defaults to
+                leases under this process's name.
+            revision_api: a mwapi.MediaWikiAPI to record the wiki revision of
+                the pages scraped as HTML with, a batch per request, so that
+                sync.WikiSync doesn't queue them all again. Defaults to api.
+        """
         self._session = db_session
+        self._requester = requester if requester else DEFAULT_REQUESTER
+        self._api = api
+        self._revision_api = revision_api if revision_api else api
+        self.leases = leases if leases else Leases(db_session)
+        # URLs already in the database, loaded on first use.
+        self._piece_urls = UrlIndex(db_session, Piece)
+        self._score_urls = UrlIndex(db_session, Score)
+        self._retries = RetryScheduler(db_session)
         self._logger = logging.getLogger(LOG_NAME)
 
     def scrape_pieces_from_list(self, piece_list):
@@ -76,7 +208,7 @@ class WebScraper:
         """Quick and dirty way to download a lot of files. Does not use database."""
         for piece_url in piece_list:
             try:
-                pp = PiecePage(piece_url)
+                pp = PiecePage(piece_url, requester=self._requester)
                 scores, metadata = pp.parse_scores(), pp.parse_metadata()
             except PageRequestFailure:
                 self._logger.warning("Failed to GET {}".format(piece_url))
@@ -87,7 +219,7 @@ class WebScraper:
 
             for score in scores:
                 score['piece_url'] = piece_url
-                file_paths = download_score(score, metadata)
+                file_paths = download_score(score, metadata, self._requester)
                 score['file_paths'] = file_paths
 
             download_dir = get_dl_path(metadata)
@@ -111,156 +243,286 @@ class WebScraper:
         and scrape them.
 
         Ignores a composer if it's 'all_scraped' variable is set to true. This means that
-        the composer has already had all piece links scraped off the page.
+        the composer has already had all piece links scraped off the page. Composers
+        that failed are skipped until the retry scheduler makes them eligible again.
 
         Assumes database has already been populated with composer information
         using the scrape_composer_list() method.
         """
-        composers = self._session.query(Composer).all()
-        for db_comp in composers:
-            if not db_comp.all_scraped:
+        composers = RetryScheduler.eligible(self._session.query(Composer), Composer)\
+            .filter(Composer.all_scraped == false())\
+            .options(load_only(Composer.id, Composer.name, Composer.url, Composer.all_scraped))
+        for batch in self.leases.iter_claims(composers, Composer):
+            for db_comp in batch:
                 try:
                     self.scrape_composer(db_comp)
-                except Exception:
+                except RippingError:
+                    raise
+                except Exception as e:
                     self._logger.warn("Failed to scrape composer {}".format(db_comp.name))
+                    self._save_failure(db_comp, e)
+            if self._revision_api:
+                self._stamp_revisions([c for c in batch if c.all_scraped])
+
+    def _stamp_revisions(self, rows):
+        """Record the latest wiki revision of composers or pieces."""
+        rows = {row.url: row for row in rows}
+        for url, revision in self._fetch_revisions(rows).items():
+            rows[url].rev_id, rows[url].rev_timestamp = revision.rev_id, revision.rev_timestamp
+        commit_session(self._session)
+
+    def _fetch_revisions(self, urls):
+        """Return {url: mwapi.PageRevision} of the latest revision of pages, if there is a revision_api.
+
+        Pages whose revision is unknown are only checked again by a full sync,
+        so a failed lookup is just logged.
+        """
+        if not self._revision_api:
+            return {}
+        urls = list(urls)
+        try:
+            return self._revision_api.fetch_revisions(urls)
+        except RippingError:
+            raise
+        except Exception as e:
+            self._logger.warning("Failed to look up the revisions of {} pages: {}".format(len(urls), e))
+            return {}
 
     def scrape_all_pieces(self):
         """Scrapes all pieces that are not yet scraped.
 
-        Ignores any piece with 'scraped' set to True.
+        Ignores any piece with 'scraped' set to True, and failed pieces that
+        are not yet due for a retry.
 
         Assumes database has already been populated with pieces by scrape_all_composers.
         """
-        pieces = self._session.query(Piece)\
-            .filter(Piece.scraped == False)\
-            .filter(Piece.failed_scrape == False)
-        for db_piece in pieces:
-            try:
-                self.scrape_piece(db_piece)
-            except Exception:
-                self._logger.warn("Failed to scrape piece {}".format(db_piece.name))
+        pieces = RetryScheduler.eligible(self._session.query(Piece), Piece)\
+            .filter(Piece.scraped == false())\
+            .options(load_only(Piece.id, Piece.name, Piece.url, Piece.composer_id))
+        if self._api:
+            for batch in self.leases.iter_claims(pieces, Piece, self._api.batch_size):
+                self.scrape_piece_batch(batch)
+            return
+        for batch in self.leases.iter_claims(pieces, Piece):
+            # Looked up before the pages are downloaded, so an edit made in between is seen by the next sync.
+            revisions = self._fetch_revisions(db_piece.url for db_piece in batch)
+            for db_piece in batch:
+                try:
+                    self.scrape_piece(db_piece, revisions.get(db_piece.url))
+                except RippingError:
+                    raise
+                except Exception as e:
+                    self._logger.warn("Failed to scrape piece {}".format(db_piece.name))
+                    self._save_failure(db_piece, e)
 
 
     def scrape_composer(self, db_composer):
         """Get all pieces related to a composer into the database."""
 
-        # Download and parse the composer page
-        composer_page = ComposerPage(db_composer.url)
-        # Get all the pieces related to this composer
-        all_pieces = composer_page.get_all_in_category()
-
-        pieces_to_add = []
-        for piece in all_pieces:
+        if self._api:
+            link_pages = self._api.iter_category_members(url_to_title(db_composer.url))
+        else:
+            # Download and parse the composer page
+            link_pages = ComposerPage(db_composer.url, requester=self._requester).iter_category()
+        # Save the pieces related to this composer a page of links at a time, so an
+        # interrupted composer keeps the pieces found so far.
+        piece_count = 0
+        for page_links in link_pages:
+            self._add_composer_pieces(db_composer, page_links)
+            piece_count += len(page_links)
+        self._finish_composer(db_composer, piece_count)
+
+    def _add_composer_pieces(self, db_composer, piece_links):
+        """Add a batch of (name, url) piece links scraped off a composer page to the database."""
+        # The index only saves sending known URLs; the insert skips any it missed.
+        pieces_to_add = {}
+        for piece in piece_links:
             name, url = piece
-            if not self._piece_in_database(url):
-                db_piece = Piece(name=name, url=url, composer=db_composer)
-                pieces_to_add.append(db_piece)
+            if url not in pieces_to_add and not self._piece_in_database(url):
+                pieces_to_add[url] = {'name': name, 'url': url, 'composer_id': db_composer.id}
 
-        self._session.add_all(pieces_to_add)
-        db_composer.all_scraped = True
+        insert_ignore(self._session, Piece, pieces_to_add.values())
         commit_session(self._session)
+        self._piece_urls.update(pieces_to_add)
 
-        piece_count = len(all_pieces)
+    def _finish_composer(self, db_composer, piece_count):
+        """Mark a composer scraped once every page of its category has been saved."""
+        db_composer.all_scraped = True
+        self._retries.record_success(db_composer)
+        commit_session(self._session)
         self._logger.info("Successfully scraped {} piece links for {}".format(piece_count, db_composer.name))
 
-    def scrape_piece(self, db_piece):
+    def scrape_piece(self, db_piece, revision=None):
         """Scrape a piece page associated with a database piece entry.
 
         Populates the database with Score objects based on what is parsed
-        off the page.
+        off the page. revision is the mwapi.PageRevision of the page looked
+        up just before, if any.
         """
 
         # Download and parse the piece page
         try:
-            piece_page = PiecePage(db_piece.url)
-            scores = piece_page.parse_scores()
-            metadata = piece_page.parse_metadata()
+            piece_page = PiecePage(db_piece.url, requester=self._requester)
+            metadata, scores = piece_page.extract()
         except (PageRequestFailure, PageParseFailure) as e:
-            if isinstance(e, PageParseFailure):
-                self._logger.warning("Failed to parse page at {}".format(db_piece.url))
-            else:
-                self._logger.warning("Failed to download piece page at {}:".format(db_piece.url))
-            self._logger.warning(e.original_exception)
-            db_piece.failed_scrape = True
-            commit_session(self._session)
+            self._save_piece_failure(db_piece, e)
+            return
+        self._save_piece(db_piece, piece_page, scores, metadata, revision)
+
+    def scrape_piece_batch(self, db_pieces):
+        """Scrape many pieces with one MediaWiki API request per api.batch_size pieces.
+
+        The rendered content returned by the API goes through the same
+        PiecePage extraction as a downloaded page.
+        """
+        try:
+            revisions = self._api.fetch_pages(db_piece.url for db_piece in db_pieces)
+        except RippingError:
+            raise
+        except Exception as e:
+            for db_piece in db_pieces:
+                self._save_piece_failure(db_piece, PageRequestFailure("API request failed", original=e))
             return
 
+        for db_piece in db_pieces:
+            revision = revisions.get(db_piece.url)
+            if not revision or not revision.html:
+                error = LookupError("Page missing from API response: {}".format(db_piece.url))
+                self._save_piece_failure(db_piece, PageRequestFailure(str(error), original=error))
+                continue
+            try:
+                piece_page = PiecePage(db_piece.url, revision.html, requester=self._requester)
+                metadata, scores = piece_page.extract()
+            except PageParseFailure as e:
+                self._save_piece_failure(db_piece, e)
+                continue
+            try:
+                self._save_piece(db_piece, piece_page, scores, metadata, revision)
+            except RippingError:
+                raise
+            except Exception as e:
+                self._logger.warning("Failed to scrape piece {}".format(db_piece.name))
+                self._save_failure(db_piece, e)
+
+    def _save_piece_failure(self, db_piece, e):
+        """Schedule a retry of a piece whose page could not be downloaded or parsed."""
+        if isinstance(e, PageParseFailure):
+            self._logger.warning("Failed to parse page at {}".format(db_piece.url))
+        else:
+            self._logger.warning("Failed to download piece page at {}:".format(db_piece.url))
+        self._logger.warning(e.original_exception)
+        self._save_failure(db_piece, e.original_exception or e)
+
+    def _save_failure(self, row, e):
+        """Schedule a retry of the row, recovering the session first if a flush failed.
+
+        A DownloadRejected dead-letters the row without retries.
+        """
+        if not self._session.is_active:
+            self._session.rollback()
+        self._retries.record_failure(row, e, permanent=isinstance(e, DownloadRejected))
+        commit_session(self._session)
+
+    def _save_piece(self, db_piece, piece_page, scores, metadata, revision=None):
+        """Add the scores parsed off a piece page to the database and mark it scraped.
+
+        revision is the mwapi.PageRevision the page came from, if it is known.
+        """
         # Create scores associated with this piece.
-        scores_to_add = []
+        scores_to_add = {}
         for score in scores:
             for dli in score.get('dl_links', []):
-                if not self._score_in_database(dli):
-                    db_score = Score(piece=db_piece, composer=db_piece.composer)
-                    db_score.url = dli
-                    db_score.file_format = dli.split('.')[-1]
-                    db_score.name = score.get('meta', {}).get('CPDL#', '')
-                    scores_to_add.append(db_score)
-        self._session.add_all(scores_to_add)
+                if dli not in scores_to_add and not self._score_in_database(dli):
+                    scores_to_add[dli] = {'url': dli,
+                                          'piece_id': db_piece.id,
+                                          'composer_id': db_piece.composer_id,
+                                          'file_format': dli.split('.')[-1],
+                                          'name': score.get('meta', {}).get('CPDL#', '')}
+        added = insert_ignore(self._session, Score, scores_to_add.values())
+        self._session.expire(db_piece, ['scores'])
 
         # Save scraping data in DB.
         metadata['scores'] = scores
         db_piece.json_metadata = json.dumps(metadata)
+        save_metadata(self._session, {db_piece.id: metadata})
         db_piece.html_dump = piece_page.get_raw_html()
+        db_piece.parser_version = parser_version_stamp()
+        db_piece.html_hash = html_hash(db_piece.html_dump)
+        if revision:
+            db_piece.rev_id, db_piece.rev_timestamp = revision.rev_id, revision.rev_timestamp
         db_piece.scraped = True
+        self._retries.record_success(db_piece)
         commit_session(self._session)
-        self._logger.info("Successfully scraped {} scores from piece {}.".format(len(scores_to_add), db_piece.name))
+        self._score_urls.update(scores_to_add)
+        self._logger.info("Successfully scraped {} scores from piece {}.".format(added, db_piece.name))
 
 
     def download_all_scores(self):
-        for i, score in enumerate(self._session.query(Score).filter(Score.downloaded == False)):
-            try:
-                db_piece = score.piece
-                metadata = json.loads(db_piece.json_metadata)
-                file_path = download_score(score, metadata)
-                if not file_path:
-                    score.failed_scrape = True
-                    self._logger.warn("Failed to download score at {}".format(score.url))
-                    continue
-                json_out = {'piece_metadata': metadata}
-                with open(os.path.join(file_path, 'meta.json'), 'w') as f:
-                    json.dump(json_out, f, indent=4)
-
-                score.file_path = str(file_path)
-                score.downloaded = True
-                self._logger.info("Successfully downloaded score at {}".format(score.url))
-            finally:
-                if i % 10 == 0:
-                    self._session.commit()
+        """Download every score that is not downloaded yet and is due for an attempt."""
+        scores = RetryScheduler.eligible(self._session.query(Score), Score)\
+            .filter(Score.downloaded == false())\
+            .options(load_only(Score.id, Score.url, Score.piece_id))
+        for batch in self.leases.iter_claims(scores, Score):
+            metadata = load_metadata(self._session, {score.piece_id for score in batch})
+            for i, score in enumerate(batch):
+                try:
+                    piece_metadata = metadata.get(score.piece_id, {})
+                    file_path = download_score(score, piece_metadata, self._requester)
+                    self._save_download(score, piece_metadata, file_path)
+                except DownloadRejected as e:
+                    self._logger.warning(str(e))
+                    self._save_failure(score, e)
+                finally:
+                    if i % 10 == 0:
+                        self._session.commit()
 
         self._session.commit()
 
+    def _save_download(self, score, metadata, file_path):
+        """Record the outcome of download_score() on the score."""
+        if not file_path:
+            self._retries.record_failure(score, "Failed to download score at {}".format(score.url))
+            self._logger.warn("Failed to download score at {}".format(score.url))
+            return
+        json_out = {'piece_metadata': metadata}
+        with open(os.path.join(file_path, 'meta.json'), 'w') as f:
+            json.dump(json_out, f, indent=4)
+
+        score.file_path = str(file_path)
+        score.downloaded = True
+        self._retries.record_success(score)
+        self._logger.info("Successfully downloaded score at {}".format(score.url))
+
 
 
     def scrape_composer_list(self, composer_list_url=COMPOSER_LIST_URL):
         """Get all the composers into the database.
 
-        Assumes database is empty. Will crash if it tries to add a composer
-        that already exists in the database, by the unique constraint on
-        composer URLs.
+        Composers already in the database are left as they are, so this can be
+        run again to pick up new composers.
         """
-        composer_page = ComposerListPage(composer_list_url)
+        composer_page = ComposerListPage(composer_list_url, requester=self._requester)
         all_composers = composer_page.get_all_in_category()
 
+        composers_to_add = []
         for composer in all_composers:
             name, url = composer
             url_split = [x for x in url.split('/') if x]
             url_split[-1] = 'Category:' + url_split[-1] + '_compositions'
             url = '/' + '/'.join(url_split)
-            db_comp = Composer(name=name, url=url)
-            self._session.add(db_comp)
+            composers_to_add.append({'name': name, 'url': url})
+        insert_ignore(self._session, Composer, composers_to_add)
 
+        set_sync_state(self._session, COMPOSER_LIST_SCRAPED, '1')
         commit_session(self._session)
         self._logger.info("Successfully scraped all composer links")
 
     def _piece_in_database(self, piece_url):
         """Return True if piece with given URL is already in database."""
-        result = self._session.query(Piece).filter(Piece.url == piece_url).count()
-        return result == 1
-
+        return piece_url in self._piece_urls
 
     def _score_in_database(self, score_url):
-        result = self._session.query(Score).filter(Score.url == score_url).count()
-        return result == 1
+        return score_url in self._score_urls
 
 
 class SearchAPIScraper:
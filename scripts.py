@@ -1,11 +1,20 @@
 """Contains assorted scripts that have been used on the data-dump over time."""
 from db import *
-from parsers import PiecePage
+from parsers import PiecePage, PageParseFailure, PARSER_VERSIONS, PARSER_COMPONENTS, parser_version_stamp, \
+    html_hash
 from scraper import get_dl_path
+from keyset import iter_batches, iter_rows
+from normalize import save_metadata, backfill_metadata
+from settings import LOG_NAME, LOG_FILE
+from sqlalchemy import func, or_
 from sqlalchemy.orm.exc import NoResultFound
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import argparse
 import json
+import logging
 import os
 import shutil
+import time
 
 
 def isolate_reiner_files(target_folder):
@@ -58,7 +67,8 @@ def re_parse_metadata():
     the information is necessary.
     """
     session = DB_SESSION()
-    for piece in session.query(Piece):
+    pieces = session.query(Piece.id, Piece.url, Piece.html_dump, Piece.json_metadata)
+    for piece in iter_rows(pieces, Piece.id):
         # Initialization for this loop
         url, raw_html = piece.url, piece.html_dump
         if not piece.json_metadata:
@@ -75,5 +85,170 @@ def re_parse_metadata():
         with open(os.path.join(get_dl_path(old_metadata), 'meta.json'), 'w') as f:
             json.dump(new_metadata, f)
 
+
+def parallel_re_parse_metadata(workers=os.cpu_count(), batch_size=200, full=False, verify_hashes=False):
+    """Re parses the metadata and scores of scraped pieces in a process pool.
+
+    Only pieces whose parser_version stamp is out of date are re-parsed, and
+    only for the components (see parsers.PARSER_VERSIONS) whose version was
+    bumped. A piece whose html_dump no longer matches its html_hash, or that
+    has no stamp, is re-parsed in full.
+
+    Batches of pieces are read by primary key and handed to the workers, with
+    at most two batches per worker in flight so memory stays bounded. This
+    process is the only writer: it bulk-updates json_metadata and the stamps
+    and rewrites each piece's meta.json as results come back.
+
+    Args:
+        workers: the number of worker processes.
+        batch_size: the number of pieces sent to a worker at once.
+        full: re-parse every component of every piece.
+        verify_hashes: also check the html_hash of pieces whose stamp is up to
+            date. Every page is read from the database, but unchanged ones are
+            still not parsed.
+    """
+    logger = logging.getLogger(LOG_NAME)
+    session = DB_SESSION()
+    stale_only = not (full or verify_hashes)
+    total = _stale_pieces(session.query(func.count(Piece.id)), stale_only).scalar()
+    done, skipped, failed = 0, 0, 0
+    start = time.time()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        batches = _piece_html_batches(session, batch_size, stale_only)
+        pending = set()
+        while True:
+            while len(pending) < 2 * workers:
+                batch = next(batches, None)
+                if batch is None:
+                    break
+                pending.add(pool.submit(_re_parse_batch, batch, full))
+            if not pending:
+                break
+
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                results = future.result()
+                batch_skipped, batch_failed = _write_re_parsed(session, results, logger)
+                skipped += batch_skipped
+                failed += batch_failed
+                done += len(results)
+            rate = done / max(time.time() - start, 1e-6)
+            logger.info("Checked {}/{} pieces, {} unchanged, {} failed ({:.1f} pieces/sec)".format(
+                done, total, skipped, failed, rate))
+    logger.info("Checked {} pieces for re-parsing, {} unchanged, {} failed.".format(done, skipped, failed))
+
+
+def _stale_pieces(query, stale_only):
+    """Filter a Piece query down to scraped pieces, and to those with an outdated stamp if stale_only."""
+    query = query.filter(Piece.json_metadata != None)
+    if stale_only:
+        query = query.filter(or_(Piece.parser_version == None, Piece.parser_version != parser_version_stamp()))
+    return query
+
+
+def _piece_html_batches(session, batch_size, stale_only):
+    """Yield lists of (id, url, html_dump, json_metadata, parser_version, html_hash) rows,
+    paging by primary key."""
+    columns = (Piece.id, Piece.url, Piece.html_dump, Piece.json_metadata, Piece.parser_version, Piece.html_hash)
+    for batch in iter_batches(_stale_pieces(session.query(*columns), stale_only), Piece.id, batch_size):
+        yield [tuple(row) for row in batch]
+
+
+def _stale_components(raw_html, parser_version, stored_hash):
+    """Return the components of a piece that have to be re-parsed."""
+    if parser_version is None or stored_hash != html_hash(raw_html):
+        return PARSER_COMPONENTS
+    stamped = json.loads(parser_version)
+    return tuple(c for c in PARSER_COMPONENTS if stamped.get(c) != PARSER_VERSIONS[c])
+
+
+def _re_parse_batch(batch, full=False):
+    """Worker for parallel_re_parse_metadata().
+
+    Returns: a list of dicts, one per piece, with its 'id', 'url' and an
+        'error', which is None unless the piece failed. Pieces that didn't fail
+        also have their 'html_hash', the 'path_metadata' they were downloaded
+        under and their merged 'metadata' (None if nothing needed re-parsing).
+    """
+    results = []
+    for row in batch:
+        try:
+            results.append(_re_parse_piece(row, full))
+        except PageParseFailure as e:
+            results.append({'id': row[0], 'url': row[1], 'error': str(e.original_exception)})
+        except Exception as e:
+            # Raised in the worker, it would abort the whole run from future.result().
+            results.append({'id': row[0], 'url': row[1], 'error': '{}: {}'.format(type(e).__name__, e)})
+    return results
+
+
+def _re_parse_piece(row, full):
+    """Re-parse one row of _piece_html_batches(). Returns its result for _re_parse_batch()."""
+    piece_id, url, raw_html, json_metadata, parser_version, stored_hash = row
+    if not raw_html:
+        # There is nothing to parse, and the page is not downloaded again.
+        raise ValueError("no html_dump stored")
+    old_metadata = json.loads(json_metadata)
+    result = {'id': piece_id, 'url': url, 'html_hash': html_hash(raw_html), 'metadata': None, 'error': None,
+              'path_metadata': {k: old_metadata.get(k, {}) for k in ('Composer', 'Title')}}
+
+    components = PARSER_COMPONENTS if full else _stale_components(raw_html, parser_version, stored_hash)
+    if not components:
+        return result
+    parsed = PiecePage(url, raw_html).extract_components(components)
+
+    # Keep the components that are up to date from the stored metadata.
+    metadata = parsed['metadata'] if 'metadata' in parsed else old_metadata
+    metadata['movements'] = parsed.get('movements', old_metadata.get('movements', {}))
+    metadata['scores'] = parsed.get('scores', old_metadata.get('scores', []))
+    result['metadata'] = metadata
+    return result
+
+
+def _write_re_parsed(session, results, logger):
+    """Save the results of one _re_parse_batch(). Returns a (skipped, failed) tuple."""
+    mappings, normalized, skipped, failed = [], {}, 0, 0
+    for result in results:
+        if result['error']:
+            logger.warning("Failed to re-parse {}: {}".format(result['url'], result['error']))
+            failed += 1
+            continue
+        mapping = {'id': result['id'], 'parser_version': parser_version_stamp(), 'html_hash': result['html_hash']}
+        if result['metadata'] is None:
+            skipped += 1
+        else:
+            mapping['json_metadata'] = json.dumps(result['metadata'])
+            normalized[result['id']] = result['metadata']
+            with open(os.path.join(get_dl_path(result['path_metadata']), 'meta.json'), 'w') as f:
+                json.dump(dict(result['metadata'], url=result['url']), f)
+        mappings.append(mapping)
+    session.bulk_update_mappings(Piece, mappings)
+    save_metadata(session, normalized)
+    session.commit()
+    return skipped, failed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Scripts run over the scraped database.")
+    parser.add_argument('script', choices=('re-parse', 're-parse-serial', 'backfill-metadata'))
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="Worker processes for re-parse.")
+    parser.add_argument('--batch-size', type=int, default=200,
+                        help="Pieces sent to a worker at once, or normalized at once by backfill-metadata.")
+    parser.add_argument('--full', action='store_true',
+                        help="Re-parse every piece, whatever its parser version.")
+    parser.add_argument('--verify-hashes', action='store_true',
+                        help="Also re-parse up to date pieces whose html_dump changed.")
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
-    re_parse_metadata()
+    args = parse_args()
+    logging.basicConfig(filename=LOG_FILE, level=logging.INFO)
+    if args.script == 're-parse':
+        parallel_re_parse_metadata(args.workers, args.batch_size, args.full, args.verify_hashes)
+    elif args.script == 're-parse-serial':
+        re_parse_metadata()
+    elif args.script == 'backfill-metadata':
+        backfill_metadata(DB_SESSION(), args.batch_size)
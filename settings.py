@@ -4,12 +4,60 @@ EXTENSIONS = ['.pdf', '.mid', '.midi', 'xml', 'mxl', '.mus', '.musx',
               '.sib', '.cap', '.capx', '.ly', '.mscz', '.zip', '.enc', '.nwc']
 EXTENSIONS.extend([e.upper() for e in EXTENSIONS])
 
+HTML_PARSER = 'lxml'  # BeautifulSoup tree builder: 'lxml', 'html.parser' or 'html5lib'.
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Bytes held in memory at once while downloading a score.
+DOWNLOAD_MAX_RESUMES = 5  # Range requests tried before giving up on a score.
+
+RETRY_BUDGET = 5  # Failures before a composer, piece or score is dead-lettered.
+RETRY_BASE_DELAY = 10 * 60  # Seconds before the first retry. Doubles on each further failure.
+RETRY_MAX_DELAY = 24 * 60 * 60
+
+URL_INDEX_BLOOM_THRESHOLD = 2000000  # Rows of a table whose URLs are held in a set rather than a Bloom filter.
+URL_INDEX_FALSE_POSITIVE_RATE = 0.001  # Share of new URLs the Bloom filter sends to the database.
+
 PROXY_LIST = []
 FUZZ_RANGE = (0, 10)
+MAX_CONCURRENCY = 8  # Requests kept in flight by the async scraper.
+PIPELINE_COMPOSER_WORKERS = 2  # Threads of each stage of the pipeline scraper.
+PIPELINE_PIECE_WORKERS = 8
+PIPELINE_SCORE_WORKERS = 8
+PIPELINE_QUEUE_SIZE = 100  # Rows waiting between stages of the pipeline scraper, and results waiting to be saved.
+PIPELINE_POLL_INTERVAL = 5  # Seconds a pipeline stage waits for work from the one before it.
+ADAPTIVE_THROTTLE = True  # Adapt the fuzzing to server pushback. FUZZ_RANGE then sets the starting rate.
+THROTTLE_MIN_RATE = 1.0 / 60  # Requests/sec per proxy.
+THROTTLE_MAX_RATE = 0.5  # Requests/sec per proxy the rate can climb to, above the 0.2 of FUZZ_RANGE.
+THROTTLE_INCREASE = 0.005  # Added to the rate after every healthy response.
+THROTTLE_DECREASE = 0.5  # Rate multiplier on pushback (429/503/403, Retry-After, slow responses).
+THROTTLE_LATENCY_LIMIT = 10  # Seconds. Slower responses count as pushback.
+THROTTLE_MAX_RETRIES = 3  # Times a 429/503 response is retried after backing off.
+REQUEST_TIMEOUT = 60  # Seconds to wait on a proxy before counting a timeout.
+PROXY_MAX_FAILURES = 3  # Consecutive failures before a proxy is quarantined.
+PROXY_COOLDOWN = 60  # Seconds of a first quarantine. Doubles on each further strike.
+PROXY_MAX_COOLDOWN = 60 * 60
+PROXY_LATENCY_WINDOW = 100  # Recent requests used for a proxy's latency percentiles.
+SESSION_POOL_SIZE = 4  # Keep-alive connections kept per proxy/host pair.
+SESSION_IDLE_TIMEOUT = 300  # Seconds before an unused proxy/host session is closed.
+CACHE_DIR = '/home/lexpar/Documents/DDMAL/media_grabber/downloads/http_cache'  # None disables the page cache.
+CACHE_TTL = 7 * 24 * 60 * 60  # Seconds a cached page is used without revalidation.
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+
 SQLITE_FILE = '/home/lexpar/Documents/DDMAL/media_grabber/downloads/db.sqlite'
 LOG_FILE = '/home/lexpar/Documents/DDMAL/media_grabber/downloads/log'
 #SQLITE_FILE = '/mnt/imslp/db.sqlite'
 #LOG_FILE = '/mnt/imslp/grabber.log'
+DATABASE_URL = 'sqlite:////{}'.format(SQLITE_FILE)  # Or e.g. 'postgresql://scraper@localhost/cpdl'.
+LEASE_DURATION = 10 * 60  # Seconds a worker holds the rows it claimed. Renewed every third of that.
+LEASE_BATCH_SIZE = 20  # Rows a worker claims at a time, so the others get their share of a short queue.
+KEYSET_BATCH_SIZE = 500  # Rows loaded at once by the loops over a table, see keyset.py.
+MIGRATION_BATCH_SIZE = 20000  # Rows of a table a migration updates per transaction, by id range.
+DB_COMPRESSION_LEVEL = 6  # zlib level of the html_dump and json_metadata columns.
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_SYNCHRONOUS = 'NORMAL'  # With WAL, only the log is synced, at checkpoints.
+SQLITE_CACHE_SIZE = -64000  # Page cache, in KiB when negative.
+SQLITE_MMAP_SIZE = 256 * 1024 ** 2  # Bytes of the database file read through mmap.
+SQLITE_TEMP_STORE = 'MEMORY'  # Where temporary tables and indexes go.
+SQLITE_BUSY_TIMEOUT = 30 * 1000  # Milliseconds a worker waits for another to finish writing.
 
 LOG_NAME = 'web_scraper'
 
@@ -17,3 +65,7 @@ EMAIL_ADRR = 'alex.parmentier@mail.com'
 EMAIL_PASS = 'dsfdsf'
 
 COMPOSER_LIST_URL = 'http://www1.cpdl.org/wiki/index.php/Category:Composers'
+API_URL = 'http://www3.cpdl.org/wiki/api.php'  # MediaWiki action API of the wiki.
+API_BATCH_SIZE = 50  # Titles per prop=revisions request, the API's limit for normal users.
+API_CATEGORY_LIMIT = 500  # Category members per list=categorymembers request.
+SYNC_RC_MAX_AGE = 90 * 24 * 60 * 60  # Seconds of history the wiki keeps in recentchanges ($wgRCMaxAge).
@@ -0,0 +1,152 @@
+import datetime
+import logging
+
+from sqlalchemy import true
+
+from db import Composer, Piece, SyncState
+from mwapi import title_to_url
+from bulk import upsert
+from keyset import iter_batches
+from settings import LOG_NAME, SYNC_RC_MAX_AGE
+
+# SyncState names.
+COMPOSER_LIST_SCRAPED = 'composer_list_scraped'
+RECENT_CHANGES_WATERMARK = 'recentchanges_watermark'
+
+# Namespaces of articles and categories.
+NS_MAIN = 0
+NS_CATEGORY = 14
+
+_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# Most URLs put in one IN (...) clause, below SQLite's limit on query parameters.
+_IN_CHUNK = 500
+
+# Column values that put a piece back in the scrape queue, clearing any retry state.
+_REQUEUED = {'scraped': False, 'failed_scrape': False, 'attempts': 0, 'next_attempt_at': None}
+
+
+def get_sync_state(session, name):
+    """Return the value stored under name, or None."""
+    state = session.query(SyncState).get(name)
+    return state.value if state else None
+
+
+def set_sync_state(session, name, value):
+    """Store value under name. The caller commits."""
+    session.merge(SyncState(name=name, value=value))
+
+
+class WikiSync:
+    """Queues the composers and pieces that changed on the wiki since the last sync.
+
+    Changes are read from list=recentchanges, starting at the watermark left
+    by the last successful sync:
+        - an edited piece is queued for a re-scrape if its revision differs
+          from the one it was scraped from,
+        - a new piece is added to the composer whose category it is in,
+        - a new '... compositions' category is added as a composer,
+        - an edited category is queued to have its members listed again.
+    The queued rows are then scraped by the usual WebScraper loops.
+
+    recentchanges only goes back SYNC_RC_MAX_AGE seconds. If there is no
+    watermark or it is older than that, every scraped piece's revision is
+    checked against the wiki in batches instead, and every composer is
+    listed again.
+    """
+
+    def __init__(self, session, api):
+        self._session = session
+        self._api = api
+        self._logger = logging.getLogger(LOG_NAME)
+
+    def sync(self):
+        """Queue everything that changed. Returns the number of pieces queued or added."""
+        started = datetime.datetime.utcnow()
+        watermark = get_sync_state(self._session, RECENT_CHANGES_WATERMARK)
+        oldest = started - datetime.timedelta(seconds=SYNC_RC_MAX_AGE)
+        if watermark and datetime.datetime.strptime(watermark, _TIMESTAMP_FORMAT) > oldest:
+            queued = self.sync_recent_changes(watermark)
+        else:
+            self._logger.info("No usable sync watermark, checking the revision of every piece.")
+            queued = self.sync_all_revisions()
+
+        set_sync_state(self._session, RECENT_CHANGES_WATERMARK, started.strftime(_TIMESTAMP_FORMAT))
+        self._session.commit()
+        self._logger.info("Sync queued {} pieces.".format(queued))
+        return queued
+
+    def sync_recent_changes(self, since):
+        """Queue the pages changed since an ISO 8601 timestamp."""
+        articles, categories = {}, {}
+        for change in self._api.recent_changes(since, (NS_MAIN, NS_CATEGORY)):
+            # Changes come oldest first, so each page ends up with its latest revision.
+            changes = articles if change['ns'] == NS_MAIN else categories
+            changes[title_to_url(change['title'])] = change
+
+        self._sync_categories(categories)
+        queued = self._sync_articles(articles)
+        self._session.commit()
+        return queued
+
+    def sync_all_revisions(self):
+        """Compare the revision of every scraped piece with the wiki's, in batches."""
+        queued = 0
+        pieces = self._session.query(Piece.id, Piece.url, Piece.rev_id).filter(Piece.scraped == true())
+        for batch in iter_batches(pieces, Piece.id, self._api.batch_size):
+            batch = {p.url: p for p in batch}
+            changed = [batch[url].id for url, revision in self._api.fetch_revisions(batch).items()
+                       if batch[url].rev_id != revision.rev_id]
+            if changed:
+                self._session.query(Piece).filter(Piece.id.in_(changed))\
+                    .update(_REQUEUED, synchronize_session=False)
+                queued += len(changed)
+            self._session.commit()
+
+        # New pieces only show up by listing every category again.
+        self._session.query(Composer).update({Composer.all_scraped: False}, synchronize_session=False)
+        self._session.commit()
+        return queued
+
+    def _sync_categories(self, changes):
+        """Queue edited composer categories and add new ones, in one upsert."""
+        known = self._by_url(Composer, changes)
+        rows = []
+        for url, change in changes.items():
+            composer = known.get(url)
+            if composer is None and change['title'].endswith(' compositions'):
+                name = change['title'].split(':', 1)[-1][:-len(' compositions')]
+            elif composer is not None and composer.rev_id != change['revid']:
+                name = composer.name
+            else:
+                continue
+            rows.append({'name': name, 'url': url, 'all_scraped': False,
+                         'rev_id': change['revid'], 'rev_timestamp': change['timestamp']})
+        upsert(self._session, Composer, rows, ('all_scraped', 'rev_id', 'rev_timestamp'))
+
+    def _sync_articles(self, changes):
+        """Queue edited pieces and add new ones, in one upsert. Returns how many pieces were queued or added."""
+        known = self._by_url(Piece, changes)
+        rows = [dict(_REQUEUED, name=piece.name, url=url, composer_id=piece.composer_id)
+                for url, piece in known.items() if piece.rev_id != changes[url]['revid']]
+
+        # Pages we don't know might be pieces created since the last sync. They
+        # belong to the composers whose '... compositions' categories they are in.
+        unknown = [url for url in changes if url not in known]
+        categories = self._api.fetch_categories(unknown) if unknown else {}
+        category_urls = {title_to_url(c) for titles in categories.values() for c in titles}
+        composers = self._by_url(Composer, category_urls)
+        for url in unknown:
+            composer = next((composers[title_to_url(c)] for c in categories.get(url, [])
+                             if title_to_url(c) in composers), None)
+            if composer is not None:
+                rows.append(dict(_REQUEUED, name=changes[url]['title'], url=url, composer_id=composer.id))
+        return upsert(self._session, Piece, rows, _REQUEUED)
+
+    def _by_url(self, model, urls):
+        """Return {url: row} of the rows of model with any of the urls."""
+        urls, rows = list(urls), {}
+        for start in range(0, len(urls), _IN_CHUNK):
+            for row in self._session.query(model).filter(model.url.in_(urls[start:start + _IN_CHUNK])):
+                rows[row.url] = row
+        return rows
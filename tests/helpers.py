@@ -0,0 +1,25 @@
+"""Databases for tests."""
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db import Base, Composer, Piece
+from db_setup import configure_engine
+
+
+def temp_database(directory):
+    """Create a database with the latest schema in directory. Returns its sessionmaker."""
+    engine = configure_engine(create_engine('sqlite:///' + os.path.join(directory, 'test.sqlite')))
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)
+
+
+def add_fixture_pieces(session, manifest):
+    """Add a composer and an unscraped piece for every fixture piece. Returns the pieces."""
+    composer = Composer(name='Fixtures', url=manifest['categories'][0])
+    pieces = [Piece(name=url, url=url, composer=composer, scraped=False, failed_scrape=False)
+              for url in manifest['pieces']]
+    session.add_all(pieces)
+    session.commit()
+    return pieces
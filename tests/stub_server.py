@@ -0,0 +1,119 @@
+"""A local HTTP server standing in for the wiki in tests.
+
+Serves the fixture corpus at the URLs in fixtures/manifest.json, the
+routes added with StubServer.route(), and a few bytes named after the path
+for any other score URL. Point a requester at it with
+ProxiedFuzzedRequester(domain=server.url).
+"""
+import json
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from parsers import EXTENSION_SUFFIXES
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures')
+
+
+class StubServer:
+    """Serves the fixture corpus on 127.0.0.1 from a background thread.
+
+    Every request is recorded in requests as a (path, headers) tuple, path
+    including the query string. Set latency to make every fixture page take
+    that many seconds to answer.
+
+    ex:
+        with StubServer() as server:
+            requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=server.url)
+    """
+
+    def __init__(self, fixture_dir=FIXTURE_DIR):
+        with open(os.path.join(fixture_dir, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.manifest = manifest
+        self.requests = []
+        self.latency = 0
+        self._pages = {}
+        for url, path in manifest['pages'].items():
+            with open(os.path.join(fixture_dir, path), 'rb') as f:
+                # Fragments are not sent to the server.
+                self._pages[url.split('#')[0]] = f.read()
+        self._routes = {}
+        self._httpd = ThreadingHTTPServer(('127.0.0.1', 0), _handler(self))
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._httpd.server_address[1])
+
+    def route(self, path, respond):
+        """Answer requests for path, whatever their query, with respond(query, headers).
+
+        respond returns a (status, headers, body) tuple. query is a dict of
+        the query string parameters.
+        """
+        self._routes[path] = respond
+
+    def requests_to(self, path):
+        """Return the recorded requests whose path, without the query string, is path."""
+        return [(p, headers) for p, headers in self.requests if urlsplit(p).path == path]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def respond(self, path, headers):
+        """Return the (status, headers, body) answer to a GET of path."""
+        split = urlsplit(path)
+        if split.path in self._routes:
+            return self._routes[split.path](dict(parse_qsl(split.query)), headers)
+        if path in self._pages:
+            time.sleep(self.latency)
+            return 200, {'Content-Type': 'text/html; charset=UTF-8'}, self._pages[path]
+        if split.path.endswith(EXTENSION_SUFFIXES):
+            return file_response('score:{}'.format(split.path).encode(), headers)
+        return 404, {'Content-Type': 'text/html; charset=UTF-8'}, b'Not found'
+
+
+def file_response(body, headers):
+    """Answer a GET of a file with body, honouring a 'bytes=N-' Range header."""
+    match = re.match(r'bytes=(\d+)-$', headers.get('Range', ''))
+    if not match:
+        return 200, {'Content-Type': 'application/octet-stream'}, body
+    start = int(match.group(1))
+    if start >= len(body):
+        return 416, {'Content-Range': 'bytes */{}'.format(len(body))}, b''
+    return 206, {'Content-Type': 'application/octet-stream',
+                 'Content-Range': 'bytes {}-{}/{}'.format(start, len(body) - 1, len(body))}, body[start:]
+
+
+def _handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            headers = dict(self.headers.items())
+            server.requests.append((self.path, headers))
+            status, response_headers, body = server.respond(self.path, headers)
+            self.send_response(status)
+            for name, value in response_headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
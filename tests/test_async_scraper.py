@@ -0,0 +1,83 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from db import Piece, Score
+from lease import Leases
+from requester import ProxiedFuzzedRequester
+from async_scraper import AsyncWebScraper
+from tests.helpers import temp_database, add_fixture_pieces
+from tests.stub_server import StubServer
+
+
+class AsyncWebScraperTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = mock.patch('scraper.DOWNLOAD_PATH', self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=self.server.url)
+        self.session_factory = temp_database(self.directory)
+        self.session = self.session_factory()
+        self.addCleanup(self.session.close)
+        add_fixture_pieces(self.session, self.server.manifest)
+        self.scraper = AsyncWebScraper(self.session, requester, max_concurrency=4)
+        self.addCleanup(self.scraper.close)
+
+    def test_scrapes_pieces_and_downloads_scores(self):
+        self.scraper.run(self.scraper.scrape_all_pieces())
+        # Some fixture pages link scores on the real site, which the stub can't serve.
+        self.session.query(Score).filter(~Score.url.startswith('/')).delete(synchronize_session=False)
+        self.session.commit()
+        self.scraper.run(self.scraper.download_all_scores())
+
+        self.assertTrue(self.session.query(Piece).filter(Piece.scraped).count())
+        scores = self.session.query(Score).all()
+        self.assertTrue(scores)
+        for score in scores:
+            self.assertTrue(score.downloaded, score.url)
+            self.assertIsNotNone(score.download_rate)
+            self.assertEqual(score.resume_count, 0)
+            with open(os.path.join(score.file_path, score.url.split('/')[-1]), 'rb') as f:
+                self.assertEqual(f.read(), 'score:{}'.format(score.url).encode())
+        score_requests = [path for path, _ in self.server.requests if path not in self.server.manifest['pieces']]
+        self.assertEqual(sorted(score_requests), sorted(score.url for score in scores))
+
+    def test_leases_are_renewed_until_the_workers_are_done(self):
+        # The last pieces are still being fetched well after the last claim.
+        self.server.latency = 1.5
+        leases = self.scraper._scraper.leases
+        leases.duration = 1.0
+        running = threading.Event()
+        running.set()
+
+        def steal():
+            # Only claims the rows of the scraper whose leases ran out, and keeps them.
+            session = self.session_factory()
+            thief = Leases(session, 'thief')
+            while running.is_set():
+                thief.claim(session.query(Piece).filter(Piece.lease_owner == leases.owner), Piece)
+                running.wait(0.1)
+            session.close()
+
+        thread = threading.Thread(target=steal)
+        thread.start()
+        try:
+            self.scraper.run(self.scraper.scrape_all_pieces())
+        finally:
+            running.clear()
+            thread.join()
+
+        self.assertEqual(self.session.query(Piece).filter(Piece.lease_owner != None).count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
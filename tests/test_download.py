@@ -0,0 +1,135 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from db import DeadLetter, Piece, Score
+from requester import ProxiedFuzzedRequester
+from scraper import DownloadRejected, WebScraper, download_file, get_dl_path
+from tests.helpers import temp_database
+from tests.stub_server import StubServer, file_response
+
+SCORE = '/wiki/images/score.pdf'
+BODY = b'%PDF-' + bytes(range(256)) * 40
+
+
+class DownloadFileTest(unittest.TestCase):
+    """download_file() against the stub server."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch('scraper.DOWNLOAD_PATH', directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        self.requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=self.server.url)
+        self.addCleanup(self.requester.close)
+        self.file_path = os.path.join(get_dl_path({}), 'score.pdf')
+
+    def _respond_with(self, *statuses):
+        """Answer SCORE with each of statuses in turn, then with the file."""
+        statuses = list(statuses)
+
+        def respond(query, headers):
+            if statuses:
+                return statuses.pop(0), {}, b'Error'
+            return file_response(BODY, headers)
+        self.server.route(SCORE, respond)
+
+    def _write_part(self, content):
+        with open(self.file_path + '.part', 'wb') as f:
+            f.write(content)
+
+    def _downloaded(self):
+        with open(self.file_path, 'rb') as f:
+            return f.read()
+
+    def test_client_error_is_rejected_without_retrying(self):
+        self._respond_with(404)
+        with self.assertRaises(DownloadRejected):
+            download_file(SCORE, {}, self.requester)
+        self.assertEqual(len(self.server.requests_to(SCORE)), 1)
+
+    def test_too_many_requests_fails_for_now(self):
+        self._respond_with(429)
+        self.assertEqual(download_file(SCORE, {}, self.requester), (False, None, 0))
+        self.assertEqual(len(self.server.requests_to(SCORE)), 1)
+
+    def test_link_to_a_page_is_rejected(self):
+        with self.assertRaises(DownloadRejected):
+            download_file('/wiki/index.php/Not_a_score', {}, self.requester)
+        self.assertEqual(self.server.requests, [])
+
+    def test_server_error_is_retried(self):
+        self._respond_with(503, 500)
+        download_dir, download_rate, resumes = download_file(SCORE, {}, self.requester)
+        self.assertTrue(download_dir)
+        self.assertEqual(len(self.server.requests_to(SCORE)), 3)
+        self.assertEqual(self._downloaded(), BODY)
+
+    def test_resumes_part_file(self):
+        self._respond_with()
+        self._write_part(BODY[:1000])
+        download_dir, download_rate, resumes = download_file(SCORE, {}, self.requester)
+        self.assertEqual(resumes, 1)
+        self.assertEqual(self.server.requests_to(SCORE)[0][1]['Range'], 'bytes=1000-')
+        self.assertEqual(self._downloaded(), BODY)
+
+    def test_complete_part_file(self):
+        self._respond_with()
+        self._write_part(BODY)
+        self.assertTrue(download_file(SCORE, {}, self.requester)[0])
+        self.assertEqual(len(self.server.requests_to(SCORE)), 1)
+        self.assertEqual(self._downloaded(), BODY)
+
+    def test_part_file_longer_than_file_starts_over(self):
+        self._respond_with()
+        self._write_part(BODY + b'garbage')
+        self.assertTrue(download_file(SCORE, {}, self.requester)[0])
+        self.assertEqual(len(self.server.requests_to(SCORE)), 2)
+        self.assertEqual(self._downloaded(), BODY)
+
+
+class DownloadAllScoresTest(unittest.TestCase):
+    """WebScraper.download_all_scores() on scores that fail for good and for now."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch('scraper.DOWNLOAD_PATH', directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        self.server.route('/wiki/images/missing.pdf', lambda query, headers: (404, {}, b'Not found'))
+        self.server.route('/wiki/images/down.pdf', lambda query, headers: (500, {}, b'Error'))
+        requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=self.server.url)
+        self.addCleanup(requester.close)
+        self.session = temp_database(directory.name)()
+        self.addCleanup(self.session.close)
+        piece = Piece(name='Piece', url='/wiki/index.php/Piece', scraped=True)
+        self.session.add_all(Score(name=url, url=url, piece=piece) for url in
+                             ('/wiki/images/missing.pdf', '/wiki/images/down.pdf', '/wiki/index.php/Not_a_score'))
+        self.session.commit()
+        self.scraper = WebScraper(self.session, requester)
+
+    def _score(self, url):
+        return self.session.query(Score).filter(Score.url == url).one()
+
+    def test_rejected_scores_are_dead_lettered_at_once(self):
+        self.scraper.download_all_scores()
+
+        for url in ('/wiki/images/missing.pdf', '/wiki/index.php/Not_a_score'):
+            score = self._score(url)
+            self.assertEqual((score.attempts, score.failed_scrape, score.downloaded), (1, True, False))
+        self.assertEqual({d.url for d in self.session.query(DeadLetter)},
+                         {'/wiki/images/missing.pdf', '/wiki/index.php/Not_a_score'})
+        down = self._score('/wiki/images/down.pdf')
+        self.assertEqual((down.attempts, down.failed_scrape), (1, False))
+        self.assertIsNotNone(down.next_attempt_at)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from sqlalchemy import create_engine
+
+from db import Base
+from migrations import MigrationContext, migrate, _migration_lock
+
+
+class MigrateTest(unittest.TestCase):
+    """migrate() on a database from before the first migration."""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'legacy.sqlite')
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE composers (id INTEGER PRIMARY KEY, name STRING, url STRING UNIQUE,
+                                        all_scraped BOOLEAN, all_downloaded BOOLEAN);
+                CREATE TABLE pieces (id INTEGER PRIMARY KEY, name STRING, url STRING UNIQUE, composer_id INT,
+                                     json_metadata STRING, html_dump STRING, scraped BOOLEAN, all_downloaded BOOLEAN);
+                CREATE TABLE scores (id INTEGER PRIMARY KEY, name STRING, url STRING UNIQUE, composer_id INT,
+                                     piece_id INT, downloaded BOOLEAN, file_path STRING);""")
+            conn.executemany("""INSERT INTO pieces (id, url, scraped, all_downloaded) VALUES (?, ?, 1, 1);""",
+                             [(i, '/p{}'.format(i)) for i in range(1, 11)])
+        engine = create_engine('sqlite:///' + self.path)
+        Base.metadata.create_all(engine)
+        engine.dispose()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        self.addCleanup(conn.close)
+        return conn
+
+    def _count(self, sql):
+        return self._connect().execute(sql).fetchone()[0]
+
+    def test_migrates_legacy_database(self):
+        self.assertEqual(migrate(self.path, batch_size=3), 12)
+        # migration1 reset the progress made before it.
+        self.assertEqual(self._count("""SELECT COUNT(*) FROM pieces WHERE scraped = 0;"""), 10)
+        self.assertEqual(self._count("""SELECT COUNT(*) FROM schema_version WHERE finished_at IS NOT NULL;"""), 12)
+
+    def test_unfinished_migration_without_new_columns_keeps_data(self):
+        migrate(self.path)
+        with self._connect() as conn:
+            conn.execute("""UPDATE pieces SET scraped = 1, failed_scrape = 1, attempts = 5;""")
+            # As left by a worker that started the migrations but hasn't finished them yet.
+            conn.execute("""UPDATE schema_version SET finished_at = NULL, added_columns = NULL;""")
+
+        migrate(self.path)
+        self.assertEqual(self._count("""SELECT COUNT(*) FROM pieces WHERE scraped = 1 AND failed_scrape = 1;"""), 10)
+
+    def test_interrupted_migration_finishes_its_data_changes(self):
+        with mock.patch.object(MigrationContext, 'update_in_batches', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                migrate(self.path)
+        self.assertEqual(self._count("""SELECT COUNT(*) FROM pieces WHERE scraped = 1;"""), 10)
+
+        migrate(self.path)
+        self.assertEqual(self._count("""SELECT COUNT(*) FROM pieces WHERE scraped = 0;"""), 10)
+
+    def test_waits_for_other_migrations(self):
+        lock = _migration_lock(self.path)
+        lock.__enter__()
+        migration = threading.Thread(target=migrate, args=(self.path,))
+        migration.start()
+        migration.join(0.2)
+        self.assertTrue(migration.is_alive())
+        self.assertEqual(self._count("""SELECT COUNT(*) FROM sqlite_master WHERE name = 'schema_version';"""), 0)
+
+        lock.__exit__(None, None, None)
+        migration.join()
+        self.assertEqual(self._count("""SELECT COUNT(*) FROM schema_version WHERE finished_at IS NOT NULL;"""), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
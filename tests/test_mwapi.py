@@ -0,0 +1,49 @@
+import json
+import tempfile
+import unittest
+
+from cache import ResponseCache
+from mwapi import MediaWikiAPI, title_to_url
+from requester import ProxiedFuzzedRequester
+from tests.stub_server import StubServer
+
+
+class MediaWikiAPITest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        self.server.route('/api.php', self._revisions)
+        self.rev_id = 100
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=self.server.url,
+                                                cache=ResponseCache(cache_dir.name))
+        self.addCleanup(self.requester.close)
+        self.api = MediaWikiAPI(self.server.url + '/api.php', requester=self.requester)
+
+    def _revisions(self, query, headers):
+        """Answer prop=revisions with a new revision of every title each time."""
+        self.rev_id += 1
+        pages = {str(i): {'title': title, 'revisions': [{'revid': self.rev_id, 'timestamp': '2020-01-01T00:00:00Z'}]}
+                 for i, title in enumerate(query['titles'].split('|'))}
+        return 200, {'Content-Type': 'application/json'}, json.dumps({'query': {'pages': pages}}).encode()
+
+    def test_fetch_revisions_bypasses_cache(self):
+        url = title_to_url('Ave Maria (Josquin des Prez)')
+        first = self.api.fetch_revisions([url])
+        second = self.api.fetch_revisions([url])
+
+        requests = self.server.requests_to('/api.php')
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(requests[0][0], requests[1][0])
+        self.assertEqual((first[url].rev_id, second[url].rev_id), (101, 102))
+        # The page cache is still used for plain pages.
+        page = self.server.manifest['pieces'][0]
+        self.requester.get(page)
+        self.requester.get(page)
+        self.assertEqual(len(self.server.requests_to(page)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from db import Piece, Score
+from normalize import load_metadata, backfill_pieces, backfill_metadata
+from requester import ProxiedFuzzedRequester
+from scraper import WebScraper
+from tests.helpers import temp_database, add_fixture_pieces
+from tests.stub_server import StubServer
+
+
+class NormalizeTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch('scraper.DOWNLOAD_PATH', directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.session = temp_database(directory.name)()
+        self.addCleanup(self.session.close)
+
+    def test_meta_json_is_stored_metadata(self):
+        server = StubServer().start()
+        self.addCleanup(server.stop)
+        requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=server.url)
+        self.addCleanup(requester.close)
+        piece = add_fixture_pieces(self.session, server.manifest)[0]
+        scraper = WebScraper(self.session, requester)
+        scraper.scrape_piece(piece)
+        stored = json.loads(piece.json_metadata)
+        # Some fixture pages link scores on the real site, which the stub can't serve.
+        self.session.query(Score).filter(~Score.url.startswith('/')).delete(synchronize_session=False)
+        self.session.query(Piece).filter(Piece.id != piece.id).update({Piece.scraped: True})
+        self.session.commit()
+
+        scraper.download_all_scores()
+
+        scores = self.session.query(Score).filter(Score.downloaded).all()
+        self.assertTrue(scores)
+        for score in scores:
+            with open(os.path.join(score.file_path, 'meta.json')) as f:
+                self.assertEqual(json.load(f), {'piece_metadata': stored})
+
+    def test_load_metadata_is_stored_metadata(self):
+        server = StubServer().start()
+        self.addCleanup(server.stop)
+        requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=server.url)
+        self.addCleanup(requester.close)
+        add_fixture_pieces(self.session, server.manifest)
+        WebScraper(self.session, requester).scrape_all_pieces()
+        pieces = self.session.query(Piece).filter(Piece.json_metadata != None).all()
+        stored = {piece.id: json.loads(piece.json_metadata) for piece in pieces}
+        # Every edition is kept, even those without a score link.
+        self.assertTrue(any(len(metadata['scores']) > 100 for metadata in stored.values()))
+
+        self.assertEqual(load_metadata(self.session, stored), stored)
+        self.session.query(Piece).update({Piece.metadata_normalized: False})
+        self.assertEqual(load_metadata(self.session, stored), stored)
+
+    def test_piece_without_fields_is_normalized_once(self):
+        piece = Piece(url='/wiki/index.php/Empty', scraped=True, json_metadata=json.dumps({'movements': {}, 'scores': []}))
+        self.session.add(piece)
+        self.session.commit()
+
+        with mock.patch('normalize.backfill_pieces', wraps=backfill_pieces) as backfill:
+            self.assertEqual(load_metadata(self.session, [piece.id]), {piece.id: {'movements': {}, 'scores': []}})
+            self.assertEqual(load_metadata(self.session, [piece.id]), {piece.id: {'movements': {}, 'scores': []}})
+        self.assertEqual(backfill.call_count, 1)
+        self.assertEqual(backfill_metadata(self.session), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
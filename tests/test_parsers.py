@@ -0,0 +1,119 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from async_scraper import AsyncWebScraper
+from parsers import ComposerPage, PiecePage, HTML_PARSERS, html_hash
+from requester import ProxiedFuzzedRequester
+from tests.helpers import temp_database
+from tests.stub_server import StubServer, FIXTURE_DIR
+
+
+class CategoryPagerTest(unittest.TestCase):
+    """Following the "next 200" links of a category when the raw HTML has another pager before the parsed one."""
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        self.url = self.server.manifest['categories'][0]
+        first_page = self.server.respond(self.url, {})[2].decode('utf-8')
+        # Nothing is served at /wrong, so following it fails the iteration.
+        first_page = first_page.replace('<div id="mw-content-text"',
+                                        '<div id="siteNotice"><a href="/wrong">next 200</a></div><div id="mw-content-text"', 1)
+        self.server.route(self.url, lambda query, headers: (200, {'Content-Type': 'text/html; charset=UTF-8'},
+                                                            first_page.encode('utf-8')))
+        self.requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=self.server.url)
+        self.addCleanup(self.requester.close)
+
+    def _expected(self):
+        second_url = next(url for url in self.server.manifest['pages'] if 'pagefrom=' in url)
+        second_page = ComposerPage(second_url, requester=self.requester)
+        return second_page.parse_links_page(second_page.raw_html)[0]
+
+    def test_follows_the_parsed_next_page(self):
+        pages = list(ComposerPage(self.url, requester=self.requester).iter_category())
+
+        self.assertEqual(len(pages), 2)
+        self.assertEqual(pages[1], self._expected())
+
+    def test_async_follows_the_parsed_next_page(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        session = temp_database(directory.name)()
+        self.addCleanup(session.close)
+        scraper = AsyncWebScraper(session, self.requester)
+        self.addCleanup(scraper.close)
+
+        async def collect():
+            return [links async for links in scraper._iter_category(self.url)]
+
+        pages = scraper.run(collect())
+
+        self.assertEqual(len(pages), 2)
+        self.assertEqual(pages[1], self._expected())
+
+
+class ParserEquivalenceTest(unittest.TestCase):
+    """Every tree builder of HTML_PARSERS gives the same results on the fixture pages."""
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        self.requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=self.server.url)
+        self.addCleanup(self.requester.close)
+
+    @staticmethod
+    def _call(method):
+        """Return what method returns, or the type of the exception it raises."""
+        try:
+            return method()
+        except Exception as e:
+            return type(e)
+
+    def _assert_equivalent(self, url, results):
+        reference, expected = HTML_PARSERS[0], results[HTML_PARSERS[0]]
+        for parser in HTML_PARSERS[1:]:
+            with self.subTest(url=url, parser=parser):
+                self.assertEqual(results[parser], expected, "{} differs from {}".format(parser, reference))
+
+    def test_piece_pages(self):
+        for url in self.server.manifest['pieces']:
+            with open(os.path.join(FIXTURE_DIR, self.server.manifest['pages'][url]), encoding='utf-8') as f:
+                html = f.read()
+            results = {}
+            for parser in HTML_PARSERS:
+                results[parser] = [self._call(PiecePage(url, html, parser=parser).parse_metadata),
+                                   self._call(PiecePage(url, html, parser=parser).parse_scores)]
+            self._assert_equivalent(url, results)
+
+    def test_categories(self):
+        for url in self.server.manifest['categories']:
+            results = {parser: self._call(ComposerPage(url, requester=self.requester, parser=parser)
+                                          .get_all_in_category)
+                       for parser in HTML_PARSERS}
+            self.assertTrue(results[HTML_PARSERS[0]])
+            self._assert_equivalent(url, results)
+
+
+class RawHtmlTest(unittest.TestCase):
+
+    def test_empty_page_is_not_downloaded(self):
+        requester = mock.Mock()
+        page = PiecePage('/wiki/index.php/Empty', '', requester=requester)
+        requester.get.assert_not_called()
+        self.assertEqual(page.raw_html, '')
+
+
+class HtmlHashTest(unittest.TestCase):
+
+    def test_hashes_pages(self):
+        self.assertEqual(html_hash(u'<p>caf\xe9</p>'), html_hash(u'<p>caf\xe9</p>'))
+        self.assertNotEqual(html_hash(u'<p>a</p>'), html_hash(u'<p>b</p>'))
+
+    def test_no_page_has_no_hash(self):
+        self.assertIsNone(html_hash(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from urllib.parse import urlsplit
+
+from db import Composer, Piece, Score
+from lease import Leases
+from pipeline import Pipeline
+from requester import ProxiedFuzzedRequester
+from tests.helpers import temp_database, add_fixture_pieces
+from tests.stub_server import StubServer
+
+
+class _StubRequester(ProxiedFuzzedRequester):
+    """Sends every request to the stub server, including those for absolute score URLs."""
+
+    def _absolute_url(self, url):
+        split = urlsplit(url)
+        return self._domain + split.path + ('?' + split.query if split.query else '')
+
+
+class PipelineLeaseTest(unittest.TestCase):
+    """Pipeline.run() against the stub server, with leases shorter than the wait for a worker."""
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = mock.patch('scraper.DOWNLOAD_PATH', directory.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.session_factory = temp_database(directory.name)
+        self.session = self.session_factory()
+        self.addCleanup(self.session.close)
+        add_fixture_pieces(self.session, self.server.manifest)
+        self.session.query(Composer).update({Composer.all_scraped: True})
+        self.session.commit()
+        self.requester = _StubRequester(fuzz_range=(0, 0), domain=self.server.url)
+        self.addCleanup(self.requester.close)
+
+    def test_leases_are_renewed_until_the_writer_is_done(self):
+        # One piece worker takes about twice the lease to get through the
+        # pieces, which were all claimed and queued in the feeder's first pass.
+        self.server.latency = 0.3
+        pipeline = Pipeline(self.session_factory, self.requester, composer_workers=1, piece_workers=1,
+                            score_workers=4, poll_interval=0.1, lease_duration=1.0)
+        owner = pipeline._leases.owner
+        running = threading.Event()
+        running.set()
+
+        def steal():
+            # Only claims the rows of the pipeline whose leases ran out, and keeps them.
+            session = self.session_factory()
+            thief = Leases(session, 'thief')
+            while running.is_set():
+                for model in (Piece, Score):
+                    thief.claim(session.query(model).filter(model.lease_owner == owner), model)
+                running.wait(0.1)
+            session.close()
+
+        thread = threading.Thread(target=steal)
+        thread.start()
+        try:
+            pipeline.run()
+        finally:
+            running.clear()
+            thread.join()
+
+        self.assertEqual(self.session.query(Piece).filter(Piece.lease_owner == 'thief').count(), 0)
+        self.assertEqual(self.session.query(Score).filter(Score.lease_owner == 'thief').count(), 0)
+        for url in self.server.manifest['pieces']:
+            self.assertEqual(len(self.server.requests_to(urlsplit(url).path)), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
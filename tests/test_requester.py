@@ -0,0 +1,81 @@
+import asyncio
+import time
+import unittest
+
+from requester import ProxiedFuzzedRequester, AsyncRequester, SessionPool
+from tests.stub_server import StubServer
+
+
+class RequesterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        self.requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=self.server.url)
+        self.addCleanup(self.requester.close)
+        self.page = self.server.manifest['pieces'][0]
+
+    def test_get_resolves_relative_urls_against_domain(self):
+        resp = self.requester.get(self.page)
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('General Information', resp.text)
+        self.assertEqual([path for path, _ in self.server.requests], [self.page])
+
+    def test_async_get(self):
+        async_requester = AsyncRequester(self.requester, max_concurrency=4)
+        self.addCleanup(async_requester.close)
+
+        async def get_all():
+            return await asyncio.gather(*(async_requester.get(url) for url in self.server.manifest['pieces']))
+
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        responses = loop.run_until_complete(get_all())
+        self.assertEqual([resp.status_code for resp in responses], [200] * len(self.server.manifest['pieces']))
+        self.assertEqual(len(self.server.requests), len(self.server.manifest['pieces']))
+
+
+class SessionPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SessionPool(idle_timeout=0)
+        self.addCleanup(self.pool.close)
+
+    def _sessions(self):
+        return self.pool.connection_stats()['sessions']
+
+    def test_leased_sessions_are_not_evicted(self):
+        session = self.pool.acquire(None, 'a')
+        time.sleep(0.01)
+        self.pool.acquire(None, 'b')
+        self.assertEqual(self._sessions(), 2)
+        self.assertIs(self.pool.acquire(None, 'a'), session)
+
+    def test_released_sessions_are_evicted_once_idle(self):
+        self.pool.acquire(None, 'a')
+        self.pool.release(None, 'a')
+        time.sleep(0.01)
+        self.pool.acquire(None, 'b')
+        self.assertEqual(self._sessions(), 1)
+
+    def test_streamed_response_holds_its_session_until_closed(self):
+        with StubServer() as server:
+            requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=server.url)
+            self.addCleanup(requester.close)
+            requester._sessions = self.pool
+            page = server.manifest['pieces'][0]
+            resp = requester.get(page, stream=True)
+            time.sleep(0.01)
+            # Another host, which evicts the idle sessions.
+            requester.get(server.url.replace('127.0.0.1', 'localhost') + page)
+            self.assertEqual(self._sessions(), 2)
+            self.assertIn(b'General Information', resp.content)
+
+            resp.close()
+            time.sleep(0.01)
+            requester.get(page)
+            self.assertEqual(self._sessions(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
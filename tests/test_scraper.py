@@ -0,0 +1,81 @@
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+from db import Piece
+from mwapi import MediaWikiAPI, url_to_title
+from requester import ProxiedFuzzedRequester
+from scraper import WebScraper
+from tests.helpers import temp_database, add_fixture_pieces
+from tests.stub_server import StubServer
+
+
+class APIScrapeTest(unittest.TestCase):
+    """WebScraper.scrape_all_pieces() through a stub of api.php serving the fixture pages."""
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        self.server.route('/api.php', self._pages)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.session = temp_database(directory.name)()
+        self.addCleanup(self.session.close)
+        # The scraper expunges the rows it is done with, so only their URLs are kept.
+        self.urls = [piece.url for piece in add_fixture_pieces(self.session, self.server.manifest)]
+        requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=self.server.url)
+        self.addCleanup(requester.close)
+        api = MediaWikiAPI(self.server.url + '/api.php', requester=requester, batch_size=4)
+        self.scraper = WebScraper(self.session, requester, api=api)
+
+    def _pages(self, query, headers):
+        """Answer prop=revisions|info with the fixture page of every title."""
+        pages = {}
+        for i, title in enumerate(query['titles'].split('|')):
+            html = self.server.respond(self._url_of(title), {})[2]
+            pages[str(i)] = {'title': title, 'revisions': [{'revid': 1000 + i, 'timestamp': '2020-01-01T00:00:00Z',
+                                                            '*': html.decode('utf-8')}]}
+        return 200, {'Content-Type': 'application/json'}, json.dumps({'query': {'pages': pages}}).encode()
+
+    def _url_of(self, title):
+        return next(url for url in self.server.manifest['pieces'] if url_to_title(url) == title)
+
+    def _scraped(self):
+        return {piece.url for piece in self.session.query(Piece).filter(Piece.scraped)}
+
+    def test_scrapes_pieces_in_batches(self):
+        self.scraper.scrape_all_pieces()
+
+        self.assertEqual(len(self.server.requests_to('/api.php')), 2)
+        self.assertEqual(len(self.server.requests), 2)
+        scraped = self._scraped()
+        self.assertIn(self.urls[0], scraped)
+        for piece in self.session.query(Piece):
+            if piece.url in scraped:
+                self.assertIsNotNone(piece.rev_id)
+            else:
+                # The fixture pages that don't parse.
+                self.assertEqual(piece.attempts, 1)
+
+    def test_failure_to_save_a_piece_only_fails_that_piece(self):
+        save_piece = WebScraper._save_piece
+        broken = self.urls[0]
+
+        def failing_save_piece(scraper, db_piece, *args):
+            if db_piece.url == broken:
+                raise OSError("Disk full")
+            return save_piece(scraper, db_piece, *args)
+
+        with mock.patch.object(WebScraper, '_save_piece', failing_save_piece):
+            self.scraper.scrape_all_pieces()
+
+        scraped = self._scraped()
+        self.assertNotIn(broken, scraped)
+        self.assertIn(self.urls[1], scraped)
+        failed = self.session.query(Piece).filter(Piece.url == broken).one()
+        self.assertEqual((failed.attempts, failed.last_error), (1, "Disk full"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import json
+import os
+import unittest
+from unittest import mock
+
+from scripts import _re_parse_batch
+from tests.stub_server import FIXTURE_DIR
+
+
+class ReParseBatchTest(unittest.TestCase):
+    """_re_parse_batch() on rows of _piece_html_batches(), some of them broken."""
+
+    def setUp(self):
+        with open(os.path.join(FIXTURE_DIR, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.url = manifest['pieces'][0]
+        with open(os.path.join(FIXTURE_DIR, manifest['pages'][self.url]), encoding='utf-8') as f:
+            self.html = f.read()
+
+    def test_broken_rows_fail_alone(self):
+        batch = [(1, self.url, None, '{}', None, None),
+                 (2, self.url, self.html, None, None, None),
+                 (3, self.url, self.html, '{}', None, None),
+                 (4, self.url, '', '{}', None, None)]
+
+        # A row without html_dump, or an empty one, must not be downloaded again.
+        with mock.patch('parsers.DEFAULT_REQUESTER') as requester:
+            results = _re_parse_batch(batch, full=True)
+        requester.get.assert_not_called()
+
+        self.assertEqual([result['id'] for result in results], [1, 2, 3, 4])
+        self.assertIn('no html_dump stored', results[0]['error'])
+        self.assertIn('TypeError', results[1]['error'])
+        self.assertIsNone(results[2]['error'])
+        self.assertTrue(results[2]['metadata']['scores'])
+        self.assertIn('no html_dump stored', results[3]['error'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+import json
+import tempfile
+import unittest
+
+from async_scraper import AsyncWebScraper
+from db import Composer, Piece
+from mwapi import MediaWikiAPI, title_to_url
+from requester import ProxiedFuzzedRequester
+from scraper import WebScraper
+from sync import WikiSync
+from tests.helpers import temp_database, add_fixture_pieces
+from tests.stub_server import StubServer
+
+_CHANGES = [
+    {'type': 'edit', 'ns': 0, 'title': 'Edited piece', 'revid': 9001, 'timestamp': '2020-02-01T00:00:00Z'},
+    {'type': 'edit', 'ns': 0, 'title': 'Up to date piece', 'revid': 42, 'timestamp': '2020-02-01T00:00:00Z'},
+    {'type': 'new', 'ns': 0, 'title': 'New piece', 'revid': 9002, 'timestamp': '2020-02-01T00:00:00Z'},
+    {'type': 'new', 'ns': 0, 'title': 'Unrelated page', 'revid': 9003, 'timestamp': '2020-02-01T00:00:00Z'},
+    {'type': 'edit', 'ns': 14, 'title': 'Category:Josquin compositions', 'revid': 9004,
+     'timestamp': '2020-02-01T00:00:00Z'},
+    {'type': 'new', 'ns': 14, 'title': 'Category:Newcomer compositions', 'revid': 9005,
+     'timestamp': '2020-02-01T00:00:00Z'},
+]
+
+
+class RecentChangesSyncTest(unittest.TestCase):
+    """WikiSync.sync_recent_changes() through a stub of api.php."""
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        self.server.route('/api.php', self._query)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.session = temp_database(directory.name)()
+        self.addCleanup(self.session.close)
+
+        composer = Composer(name='Josquin', url=title_to_url('Category:Josquin compositions'), all_scraped=True,
+                            rev_id=1)
+        self.session.add_all(Piece(name=title, url=title_to_url(title), composer=composer, scraped=True,
+                                   failed_scrape=True, attempts=3, rev_id=42)
+                             for title in ('Edited piece', 'Up to date piece'))
+        self.session.commit()
+        requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=self.server.url)
+        self.addCleanup(requester.close)
+        self.sync = WikiSync(self.session, MediaWikiAPI(self.server.url + '/api.php', requester=requester))
+
+    def _query(self, query, headers):
+        if query.get('list') == 'recentchanges':
+            result = {'query': {'recentchanges': _CHANGES}}
+        else:
+            pages = {str(i): {'title': title, 'categories': [{'ns': 14, 'title': 'Category:Josquin compositions'}]
+                              if title == 'New piece' else []}
+                     for i, title in enumerate(query['titles'].split('|'))}
+            result = {'query': {'pages': pages}}
+        return 200, {'Content-Type': 'application/json'}, json.dumps(result).encode()
+
+    def _piece(self, title):
+        return self.session.query(Piece).filter(Piece.url == title_to_url(title)).one()
+
+    def test_queues_edited_and_new_pages(self):
+        self.assertEqual(self.sync.sync_recent_changes('2020-01-01T00:00:00Z'), 2)
+
+        edited = self._piece('Edited piece')
+        self.assertEqual((edited.scraped, edited.failed_scrape, edited.attempts), (False, False, 0))
+        self.assertEqual(edited.name, 'Edited piece')
+        self.assertTrue(self._piece('Up to date piece').scraped)
+        new = self._piece('New piece')
+        self.assertEqual((new.scraped, new.composer.name), (False, 'Josquin'))
+        self.assertEqual(self.session.query(Piece).filter(Piece.url == title_to_url('Unrelated page')).count(), 0)
+
+        composers = {c.name: (c.all_scraped, c.rev_id) for c in self.session.query(Composer)}
+        self.assertEqual(composers, {'Josquin': (False, 9004), 'Newcomer': (False, 9005)})
+
+    def test_is_idempotent(self):
+        self.sync.sync_recent_changes('2020-01-01T00:00:00Z')
+        self.assertEqual(self.sync.sync_recent_changes('2020-01-01T00:00:00Z'), 2)
+        self.assertEqual(self.session.query(Piece).count(), 3)
+        self.assertEqual(self.session.query(Composer).count(), 2)
+
+
+class ScrapedRevisionsTest(unittest.TestCase):
+    """Pieces scraped as HTML are stamped with their revision, so the first full sync has nothing to queue."""
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        self.server.route('/api.php', self._revisions)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.session = temp_database(directory.name)()
+        self.addCleanup(self.session.close)
+        add_fixture_pieces(self.session, self.server.manifest)
+        self.requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=self.server.url)
+        self.addCleanup(self.requester.close)
+        self.api = MediaWikiAPI(self.server.url + '/api.php', requester=self.requester)
+
+    def _revisions(self, query, headers):
+        pages = {str(i): {'title': title, 'revisions': [{'revid': 7, 'timestamp': '2020-01-01T00:00:00Z'}]}
+                 for i, title in enumerate(query['titles'].split('|'))}
+        return 200, {'Content-Type': 'application/json'}, json.dumps({'query': {'pages': pages}}).encode()
+
+    def _assert_stamped(self):
+        scraped = self.session.query(Piece).filter(Piece.scraped).all()
+        self.assertTrue(scraped)
+        self.assertEqual({piece.rev_id for piece in scraped}, {7})
+        # All the pieces fit in one claimed batch.
+        self.assertEqual(len(self.server.requests_to('/api.php')), 1)
+        self.assertEqual(WikiSync(self.session, self.api).sync_all_revisions(), 0)
+
+    def test_scraper_stamps_revisions(self):
+        WebScraper(self.session, self.requester, revision_api=self.api).scrape_all_pieces()
+        self._assert_stamped()
+
+    def test_async_scraper_stamps_revisions(self):
+        scraper = AsyncWebScraper(self.session, self.requester, max_concurrency=4, revision_api=self.api)
+        self.addCleanup(scraper.close)
+        scraper.run(scraper.scrape_all_pieces())
+        self._assert_stamped()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+
+from requester import ProxiedFuzzedRequester, RippingError
+from throttle import AdaptiveThrottle
+from tests.stub_server import StubServer
+
+BAN_PAGE = '/wiki/index.php/Banned'
+
+
+class ThrottleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer().start()
+        self.addCleanup(self.server.stop)
+        ban_text = ProxiedFuzzedRequester.__RIPPING_TEXT__
+        self.server.route(BAN_PAGE, lambda query, headers: (200, {'Content-Type': 'text/html'},
+                                                            '<html>{}</html>'.format(ban_text).encode()))
+        self.throttle = AdaptiveThrottle((0, 10), min_rate=0.01, max_rate=100, increase=1)
+        self.requester = ProxiedFuzzedRequester(fuzz_range=(0, 0), domain=self.server.url, throttle=self.throttle)
+        self.addCleanup(self.requester.close)
+        self.host = self.server.url.split('//')[1]
+        # The requester saves the ban page in the working directory.
+        cwd = os.getcwd()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        os.chdir(directory.name)
+        self.addCleanup(os.chdir, cwd)
+
+    def test_healthy_responses_raise_rate(self):
+        self.requester.get(self.server.manifest['pieces'][0])
+        self.assertEqual(self.throttle.stats()[self.host]['rate'], 1.2)
+
+    def test_ripping_page_drops_rate_to_minimum(self):
+        with self.assertRaises(RippingError):
+            self.requester.get(BAN_PAGE)
+        self.assertEqual(self.throttle.stats()[self.host]['rate'], 0.01)
+
+    def test_starts_at_fuzz_rate(self):
+        self.assertEqual(AdaptiveThrottle((0, 10), max_rate=0.5).initial_rate, 0.2)
+        self.assertEqual(AdaptiveThrottle((0, 0), max_rate=0.5).initial_rate, 0.5)
+
+    def test_max_rate_caps_increase(self):
+        throttle = AdaptiveThrottle((0, 10), max_rate=0.2, increase=1)
+        for _ in range(5):
+            throttle.record('host', 200, 0.1)
+        self.assertEqual(throttle.stats()['host']['rate'], 0.2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+from email.utils import parsedate_to_datetime
+from random import uniform
+import threading
+import time
+
+from settings import THROTTLE_MIN_RATE, THROTTLE_MAX_RATE, THROTTLE_INCREASE, THROTTLE_DECREASE, \
+    THROTTLE_LATENCY_LIMIT
+
+
+class AdaptiveThrottle:
+    """AIMD controller of the request rate to each host.
+
+    The rate is in requests per second through each proxy. Every healthy
+    response raises it by a fixed increase. Pushback from the server (a 403,
+    429 or 503 status, a Retry-After header, a timeout or a response slower
+    than latency_limit) multiplies it by decrease, at most once per request
+    gap so a burst of bad responses only counts once. A Retry-After header
+    also holds every request to the host until it has passed. The ripping
+    ban page, which comes with a 200, drops the rate straight to min_rate.
+
+    The gaps handed to the rate limiter are fuzzed between half and one and a
+    half times the mean gap, so the pacing never becomes regular.
+    """
+
+    PUSHBACK_STATUSES = (403, 429, 503)
+
+    def __init__(self, fuzz_range, min_rate=THROTTLE_MIN_RATE, max_rate=THROTTLE_MAX_RATE,
+                 increase=THROTTLE_INCREASE, decrease=THROTTLE_DECREASE,
+                 latency_limit=THROTTLE_LATENCY_LIMIT):
+        """Create an AdaptiveThrottle
+
+        Args:
+            fuzz_range: the hand-tuned fuzzing bounds. Their mean gives the starting
+                rate, or max_rate if they are both 0.
+            min_rate, max_rate: bounds on the rate, in requests/sec per proxy.
+            increase: requests/sec added after each healthy response.
+            decrease: factor the rate is multiplied by on pushback.
+            latency_limit: responses slower than this many seconds count as pushback.
+        """
+        mean_gap = sum(fuzz_range) / 2.0
+        self.initial_rate = min(max(1.0 / mean_gap, min_rate), max_rate) if mean_gap else max_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_limit = latency_limit
+        self._rates = {}  # host -> requests/sec
+        self._last_cut = {}  # host -> time.time() of the last multiplicative decrease
+        self._hold_until = {}  # host -> time.time() set by Retry-After
+        self._lock = threading.Lock()
+
+    def gap(self, host):
+        """Return a fuzzed number of seconds to leave between requests through one proxy."""
+        with self._lock:
+            rate = self._rates.get(host, self.initial_rate)
+        return uniform(0.5, 1.5) / rate
+
+    def not_before(self, host):
+        """Return the time.time() before which no request may go to host."""
+        return self._hold_until.get(host, 0)
+
+    def record(self, host, status, latency, retry_after=None):
+        """Adjust the rate for host after a response."""
+        if retry_after:
+            self._hold(host, retry_after)
+        if status in self.PUSHBACK_STATUSES or retry_after or latency > self.latency_limit:
+            self.push_back(host)
+        else:
+            with self._lock:
+                rate = self._rates.get(host, self.initial_rate)
+                self._rates[host] = min(rate + self.increase, self.max_rate)
+
+    def push_back(self, host):
+        """Cut the rate for host multiplicatively."""
+        now = time.time()
+        with self._lock:
+            rate = self._rates.get(host, self.initial_rate)
+            if now - self._last_cut.get(host, 0) < 1.0 / rate:
+                return
+            self._rates[host] = max(rate * self.decrease, self.min_rate)
+            self._last_cut[host] = now
+
+    def back_off(self, host):
+        """Drop the rate for host to min_rate, e.g. once the site's ripping ban is hit."""
+        with self._lock:
+            self._rates[host] = self.min_rate
+            self._last_cut[host] = time.time()
+
+    def stats(self):
+        """Return {host: {'rate': requests/sec per proxy, 'held_for': seconds}}."""
+        now = time.time()
+        with self._lock:
+            hosts = set(self._rates) | set(self._hold_until)
+            return {h: {'rate': round(self._rates.get(h, self.initial_rate), 4),
+                        'held_for': max(0, round(self._hold_until.get(h, 0) - now))}
+                    for h in hosts}
+
+    def _hold(self, host, retry_after):
+        """Hold requests to host for the delay given by a Retry-After header."""
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+            except (TypeError, ValueError):
+                return
+        with self._lock:
+            self._hold_until[host] = max(self._hold_until.get(host, 0), time.time() + delay)
@@ -0,0 +1,102 @@
+from math import ceil, log
+import hashlib
+import logging
+
+from settings import LOG_NAME, URL_INDEX_BLOOM_THRESHOLD, URL_INDEX_FALSE_POSITIVE_RATE
+
+
+class BloomFilter:
+    """A Bloom filter of strings. Never gives false negatives, only false positives."""
+
+    def __init__(self, capacity, false_positive_rate):
+        """Create a BloomFilter
+
+        Args:
+            capacity: the number of items the filter is sized for.
+            false_positive_rate: the rate of false positives once it holds capacity items.
+        """
+        capacity = max(capacity, 1)
+        self.size = int(ceil(-capacity * log(false_positive_rate) / log(2) ** 2))
+        self.hash_count = max(1, int(round(self.size / capacity * log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def add(self, item):
+        for position in self._positions(item):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(item))
+
+    def _positions(self, item):
+        # Double hashing: the k positions are h1 + i * h2, from one digest.
+        digest = hashlib.blake2b(item.encode('utf-8'), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+
+class UrlIndex:
+    """Which URLs are already in a table, without a query per URL.
+
+    The URLs are loaded with a single scan on first use, and kept up to date
+    with add() as rows are committed. Tables up to bloom_threshold rows are held
+    in a set. Bigger ones are held in a Bloom filter, and only the URLs it
+    reports as present are checked against the database, so memory stays
+    small at the cost of a query per URL that is (or looks) already there.
+    """
+
+    def __init__(self, session, model, bloom_threshold=URL_INDEX_BLOOM_THRESHOLD,
+                 false_positive_rate=URL_INDEX_FALSE_POSITIVE_RATE):
+        """Create a UrlIndex
+
+        Args:
+            session: the SQLAlchemy session to scan and fall back to.
+            model: the model whose url column is indexed.
+            bloom_threshold: the most rows held in a set.
+            false_positive_rate: the Bloom filter's false positive rate.
+        """
+        self._session = session
+        self._model = model
+        self.bloom_threshold = bloom_threshold
+        self.false_positive_rate = false_positive_rate
+        self._urls = None  # A set, or a BloomFilter, once loaded.
+        self._added = set()  # URLs added since a Bloom filter was loaded, which it can't confirm.
+        self._logger = logging.getLogger(LOG_NAME)
+
+    def __contains__(self, url):
+        if self._urls is None:
+            self.load()
+        if isinstance(self._urls, set):
+            return url in self._urls
+        if url in self._added:
+            return True
+        return url in self._urls and self._in_database(url)
+
+    def add(self, url):
+        """Record a URL whose row has been committed."""
+        if self._urls is None:
+            return
+        self._urls.add(url)
+        if not isinstance(self._urls, set):
+            self._added.add(url)
+
+    def update(self, urls):
+        for url in urls:
+            self.add(url)
+
+    def load(self):
+        """Scan the table's URLs into memory."""
+        model = self._model
+        count = self._session.query(model.id).count()
+        if count <= self.bloom_threshold:
+            urls = set()
+        else:
+            # Leave room for the rows added while scraping.
+            urls = BloomFilter(2 * count, self.false_positive_rate)
+        for url, in self._session.query(model.url).yield_per(10000):
+            urls.add(url)
+        self._urls, self._added = urls, set()
+        self._logger.info("Loaded {} {} URLs into a {}.".format(count, model.__tablename__, type(urls).__name__))
+
+    def _in_database(self, url):
+        with self._session.no_autoflush:
+            return self._session.query(self._model.id).filter(self._model.url == url).first() is not None